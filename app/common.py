@@ -1,25 +1,120 @@
 import os
+import time
 import duckdb
+import numpy as np
+import orjson
+import pyarrow as pa
+import pyarrow.compute as pc
 from enum import Enum
 from loguru import logger
-from typing import List, Tuple
-from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+from fastapi import Query
+from fastapi.responses import Response
+from starlette.concurrency import run_in_threadpool
 from deltalake import DeltaTable, PyDeltaTableError
 
 import re
 
-@lru_cache
+from .core.settings import get_settings
+from .utility.parquetio import get_local_filesystem, get_fragment_scan_options
+from .utility.hotstore import get_hot_store
+from .utility.sharedcache import get_shared_cache
+from .utility.formats import get_output_format, get_format_response, get_batches_response, ARROW_STREAM_MEDIA_TYPE
+from .utility.elements import get_element_paths, get_projection, project_table
+from .utility.include import get_included
+from .utility.singleflight import get_single_flight
+from .utility.topk import parse_sort, top_k, scan_top_k
+from .utility.cancellation import get_cancel_token, check_batches
+from .utility.changes import (
+    SINCE_PATTERN, ChangesExpired, get_since_version, read_changes, get_current_rows, get_snapshot_changes)
+from .utility.rawjson import RESOURCE_JSON, has_resource_json, drop_resource_json, join_resource_json, \
+    append_json_element
+from .utility.textindex import TEXT, CONTENT, get_text_index
+from .utility.terminology import TerminologyError, get_terminology
+from .utility.tokens import get_value_set_mask
+from .utility.writer import PARTITION_COLUMN, commit_partitions, get_write_overlay, get_group_committer, \
+    get_resource_patient, to_table
+from .utility.memory import MEMORY_BUDGET_EXCEEDED, MemoryBudgetExceeded, get_memory_budget, get_memory_pool, \
+    check_budget
+
+_delta_tables: Dict[str, DeltaTable] = {}
+
+
 def get_delta_table(input_dir: str):
     """
+    Returns the cached handle of the delta table, tables are closed per database by close_delta_databases
 
     :param input_dir:
     :return:
     """
-    return DeltaTable(input_dir)
+    delta_table = _delta_tables.get(input_dir)
+    if delta_table is None:
+        delta_table = _delta_tables.setdefault(input_dir, DeltaTable(input_dir))
+    return delta_table
 
 
-def get_resource_data(
-        input_dir, resource, partition_column_data: List[Tuple] = None):
+def open_delta_databases(database_dirs: Iterable[str]):
+    """
+    Opens every delta table of the databases, so the first requests of a new system find warm handles
+
+    :param database_dirs:
+    :return:
+    """
+    for database_dir in database_dirs:
+        if not os.path.isdir(database_dir):
+            logger.warning(f'Database not found: {database_dir}')
+            continue
+        for entry in os.scandir(database_dir):
+            if entry.is_dir() and os.path.isdir(os.path.join(entry.path, "_delta_log")):
+                try:
+                    get_delta_table(entry.path)
+                except PyDeltaTableError as e:
+                    logger.warning(f'Table not found: {e}')
+
+
+def close_delta_databases(database_dirs: Iterable[str], config=None):
+    """
+    Drops the handles, versions, partition sizes and hot store entries of the delta tables of the databases
+
+    :param database_dirs:
+    :param config: settings of the hot store
+    :return:
+    """
+    prefixes = tuple(os.path.join(database_dir, "") for database_dir in database_dirs)
+    hot_store = get_hot_store(config.hot_store_max_bytes, config.tenant) if config is not None and config.hot_store_enabled \
+        else None
+    for input_dir in [input_dir for input_dir in list(_delta_tables) if input_dir.startswith(prefixes)]:
+        _delta_tables.pop(input_dir, None)
+        _table_versions.pop(input_dir, None)
+        _partition_sizes.pop(input_dir, None)
+        if hot_store:
+            hot_store.invalidate(input_dir)
+
+
+_table_versions: Dict[str, Tuple[float, int]] = {}
+
+
+def get_table_version(input_dir: str, ttl: float = 0.0):
+    """
+    Returns the latest version of the delta table, the cached table handle is moved forward to it.
+    The delta log is listed at most once every ttl seconds per table.
+
+    :param input_dir:
+    :param ttl:
+    :return:
+    """
+    checked_at, version = _table_versions.get(input_dir, (0.0, None))
+    now = time.monotonic()
+    if version is None or now - checked_at >= ttl:
+        delta_table = get_delta_table(input_dir)
+        delta_table.update_incremental()
+        version = delta_table.version()
+        _table_versions[input_dir] = (now, version)
+    return version
+
+
+def get_resource_dataset(
+        input_dir, resource, partition_column_data: List[Tuple] = None, io_mode: str = "default"):
     """
 
     :param input_dir:
@@ -27,6 +122,7 @@ def get_resource_data(
     :param partition_column_data: should follow delta-rs partition filter format,
     ex: ("x", "=", "a") ("x", "!=", "a") ("y", "in", ["a", "b", "c"]) ("z", "not in", ["a","b"])
     https://delta-io.github.io/delta-rs/python/api_reference.html
+    :param io_mode: "default" reads through the delta-rs storage handler, "mmap" memory maps the local files
     :return:
     """
     try:
@@ -34,22 +130,100 @@ def get_resource_data(
     except PyDeltaTableError as e:
         logger.warning(f'Table not found: {e}')
         return
-    if partition_column_data:
-        return delta_table.to_pyarrow_table(partitions=partition_column_data)
-    return delta_table.to_pyarrow_table()
+    if io_mode == "mmap":
+        return delta_table.to_pyarrow_dataset(
+            partitions=partition_column_data or None, filesystem=get_local_filesystem(delta_table.table_uri))
+    return delta_table.to_pyarrow_dataset(partitions=partition_column_data or None)
+
+
+def get_resource_data(
+        input_dir, resource, partition_column_data: List[Tuple] = None, io_mode: str = "default",
+        pre_buffer: Optional[bool] = None, hole_size_limit: Optional[int] = None,
+        range_size_limit: Optional[int] = None, columns: Dict[str, pc.Expression] = None):
+    """
+
+    :param input_dir:
+    :param resource:
+    :param partition_column_data: should follow delta-rs partition filter format,
+    ex: ("x", "=", "a") ("x", "!=", "a") ("y", "in", ["a", "b", "c"]) ("z", "not in", ["a","b"])
+    https://delta-io.github.io/delta-rs/python/api_reference.html
+    :param io_mode: "default" or "mmap", see get_resource_dataset
+    :param pre_buffer: pre-buffer and coalesce the column chunk reads, only used in "mmap" mode,
+    defaults to the io_pre_buffer setting
+    :param hole_size_limit: defaults to the io_hole_size_limit setting
+    :param range_size_limit: defaults to the io_range_size_limit setting
+    :param columns: scan projection, see utility.elements.get_projection
+    :return:
+    """
+    dataset = get_resource_dataset(input_dir, resource, partition_column_data, io_mode)
+    if dataset is None:
+        return
+    if io_mode == "mmap":
+        settings = get_settings() if None in (pre_buffer, hole_size_limit, range_size_limit) else None
+        pre_buffer = settings.io_pre_buffer if pre_buffer is None else pre_buffer
+        hole_size_limit = settings.io_hole_size_limit if hole_size_limit is None else hole_size_limit
+        range_size_limit = settings.io_range_size_limit if range_size_limit is None else range_size_limit
+        scanner = dataset.scanner(columns=columns, memory_pool=get_memory_pool(),
+                                  fragment_scan_options=get_fragment_scan_options(
+                                      pre_buffer, hole_size_limit, range_size_limit))
+    else:
+        scanner = dataset.scanner(columns=columns, memory_pool=get_memory_pool())
+    if get_cancel_token() is None and get_memory_budget() is None:
+        return scanner.to_table()
+    # batch by batch, so a cancelled request or a request over its memory budget stops the scan
+    return pa.Table.from_batches(
+        list(check_budget(check_batches(scanner.to_batches()))), schema=scanner.projected_schema)
+
+
+def get_io_options(config):
+    """
+    Returns the parquet io keyword arguments of get_resource_data from the settings
+
+    :param config:
+    :return:
+    """
+    return {
+        "io_mode": config.io_mode,
+        "pre_buffer": config.io_pre_buffer,
+        "hole_size_limit": config.io_hole_size_limit,
+        "range_size_limit": config.io_range_size_limit,
+    }
 
 
-def execute_query(query, params):
+def execute_query(query, params, tables: Dict[str, pa.Table] = None):
     """
 
     @param query:
     @param sql_str:
     @param params:
+    @param tables: arrow tables registered as views of the query, by name
     @return:
     """
     con = duckdb.connect()
-    data = con.execute(query, params).fetch_arrow_table().to_pylist()
-    con.close()
+    token = get_cancel_token()
+    if token is not None:
+        token.add_callback(con.interrupt)
+    budget = get_memory_budget()
+    try:
+        if budget is not None:
+            budget.check()
+            con.execute(f"SET memory_limit='{budget.limit - budget.used}B'")
+        for name, table in (tables or {}).items():
+            con.register(name, table)
+        data = con.execute(query, params).fetch_arrow_table().to_pylist()
+    except duckdb.OutOfMemoryException:
+        if budget is not None:
+            MEMORY_BUDGET_EXCEEDED.labels("aborted").inc()
+            raise MemoryBudgetExceeded(None, budget.limit)
+        raise
+    except (duckdb.InterruptException, RuntimeError):
+        if token is not None and token.cancelled:
+            token.check()
+        raise
+    finally:
+        if token is not None:
+            token.remove_callback(con.interrupt)
+        con.close()
     return data
 
 
@@ -124,40 +298,623 @@ def get_composite_parameters(comp_str: str):
     return res[1], res[2]
 
 
-def get_data(resource_type, system_name, patient, config):
+def get_data(resource_type, system_name, patient, config, filter_expression: pc.Expression = None,
+             elements: str = None, summary: str = None, sort: str = None, limit: int = None,
+             raw_json: bool = False):
     """
 
     :param resource_type:
     :param system_name:
     :param patient:
     :param config:
-    :return:
+    :param filter_expression: arrow filter applied on the patient partition
+    :param elements: _elements search parameter
+    :param summary: _summary search parameter
+    :param sort: _sort search parameter
+    :param limit: with sort, only the first limit rows are returned
+    :param raw_json: only read the id, partition and resource_json columns, see get_raw_json_response
+    :return: {'data': pyarrow.Table}, rows are only converted to python objects per page.
+    Sorted results also hold the 'total' number of matching rows
     """
 
     resource_type=resource_type.lower()
     patient_type, patient_id, patient_url=get_reference_parameters(patient)
     if system_name not in config.system_config['systems'][system_name]:
-        data=get_resource_data(
-            input_dir=os.path.join(
-                config.system_config['paths']['base_path'],
-                config.system_config['systems'][system_name]['db_name']),
-            resource=resource_type,
-            partition_column_data=[("yy__patient_id", "=", patient_id)])
+        input_dir = os.path.join(
+            config.system_config['paths']['base_path'],
+            config.system_config['systems'][system_name]['db_name'])
+        columns = get_search_projection(input_dir, resource_type, elements, summary)
+        if raw_json:
+            columns = {"id": pc.field("id"), PARTITION_COLUMN: pc.field(PARTITION_COLUMN),
+                       RESOURCE_JSON: pc.field(RESOURCE_JSON)}
+        table_path = os.path.join(input_dir, resource_type)
+        if sort and not get_write_overlay().has_pending(table_path):
+            data, total = get_sorted_patient_data(
+                input_dir, resource_type, patient_id, config, sort, limit, filter_expression)
+            if not data:
+                return {'data': [], 'message': 'No files found'}
+            return {'data': drop_resource_json(project_table(data, columns)), 'total': total}
+
+        data = get_patient_data(input_dir, resource_type, patient_id, config, columns)
+        data = merge_pending_writes(data, table_path, patient_id, config, columns)
+        if sort and data:
+            if filter_expression is not None:
+                data = data.filter(filter_expression)
+            return {'data': drop_resource_json(top_k(data, parse_sort(resource_type, sort), limit)),
+                    'total': data.num_rows}
 
         if not data:
             return {'data': [], 'message': 'No files found'}
 
-        return {'data': data.to_pylist()}
+        if filter_expression is not None:
+            data = data.filter(filter_expression)
+        return {'data': data if raw_json else drop_resource_json(data)}
+
+
+def get_changes(resource_type, system_name, patient, config, since: str = None):
+    """
+    Reads the changes of the patient partition committed after _since, from the delta log and the
+    change data feed files, without scanning the partition
+
+    :param resource_type:
+    :param system_name:
+    :param patient:
+    :param config:
+    :param since: version or instant, None for the whole history, raises utility.changes.ChangesExpired when
+    the commits after it are no longer kept
+    :return: {'data': changed rows, see utility.changes.read_changes, 'version': latest version of the table}
+    """
+    resource_type = resource_type.lower()
+    patient_type, patient_id, patient_url = get_reference_parameters(patient)
+    table_path = os.path.join(
+        config.system_config['paths']['base_path'],
+        config.system_config['systems'][system_name]['db_name'],
+        resource_type)
+    try:
+        version = get_table_version(table_path, config.table_version_ttl)
+        delta_table = get_delta_table(table_path)
+    except PyDeltaTableError as e:
+        logger.warning(f'Table not found: {e}')
+        return {'data': [], 'message': 'No files found'}
+    start_version = get_since_version(delta_table.table_uri, since, version)
+    try:
+        data = read_changes(
+            delta_table.table_uri, delta_table.schema().to_pyarrow(), start_version, version,
+            {"yy__patient_id": patient_id})
+    except ChangesExpired:
+        if since is not None:
+            raise
+        # the whole history after a log cleanup or a vacuum starts from the current rows of the partition
+        data = delta_table.to_pyarrow_table(partitions=[("yy__patient_id", "=", patient_id)])
+        data = get_snapshot_changes(delta_table.table_uri, data.drop(
+            [name for name in ("yy__patient_id",) if name in data.schema.names]), version)
+    return {'data': drop_resource_json(data), 'version': version}
+
+
+def get_resource_version(resource_type, system_name, config):
+    """
+    :param resource_type:
+    :param system_name:
+    :param config:
+    :return: latest version of the delta table of the resource, -1 when the table does not exist
+    """
+    table_path = os.path.join(
+        config.system_config['paths']['base_path'],
+        config.system_config['systems'][system_name]['db_name'],
+        resource_type.lower())
+    try:
+        return get_table_version(table_path, config.table_version_ttl)
+    except PyDeltaTableError as e:
+        logger.warning(f'Table not found: {e}')
+        return -1
+
+
+def get_write_table(resource_type, system_name, patient_id, config, resources: List[Dict]) -> Tuple[str, pa.Table]:
+    """
+    Converts resources to rows of the patient partition of their delta table, before they are committed
+
+    :param resource_type:
+    :param system_name:
+    :param patient_id:
+    :param config:
+    :param resources:
+    :return: path of the delta table and the rows, raises pyarrow.ArrowInvalid / ArrowTypeError when the
+    resources do not fit the schema of the table
+    """
+    table_path = os.path.join(
+        config.system_config['paths']['base_path'],
+        config.system_config['systems'][system_name]['db_name'],
+        resource_type.lower())
+    return table_path, to_table(resources, patient_id, get_table_schema(table_path))
+
+
+async def commit_write_table(table_path, patient_id, table: pa.Table, config, upsert: bool = False) -> int:
+    """
+    Group commits rows of get_write_table, see utility.writer.GroupCommitter
+
+    :param table_path:
+    :param patient_id:
+    :param table:
+    :param config:
+    :param upsert: replace the rows with the same ids
+    :return: version of the table the rows were committed in
+    """
+    committer = get_group_committer(config.write_max_rows, config.write_max_delay, config.write_commit_retries)
+    version = await committer.write(table_path, patient_id, table, upsert)
+    # the reads of this worker see the commit from now on, its rows leave the overlay
+    get_write_overlay().prune(table_path, await run_in_threadpool(get_table_version, table_path))
+    return version
+
+
+async def commit_transaction(table_path, partitions: Dict[str, Tuple[pa.Table, bool]], config) -> int:
+    """
+    Commits the rows of a transaction in a single delta commit, so either all of them or none are committed
+
+    :param table_path:
+    :param partitions: rows of get_write_table per patient partition, and whether they replace the rows with
+    the same ids
+    :param config:
+    :return: version of the table the rows were committed in
+    """
+    version = await run_in_threadpool(commit_partitions, table_path, partitions, config.write_commit_retries)
+    await run_in_threadpool(get_table_version, table_path)
+    return version
+
+
+def get_changed_data(resource_type, system_name, patient, config, since: str, elements: str = None,
+                     summary: str = None, sort: str = None):
+    """
+    _since search, the current version of the resources changed after _since
+
+    :param resource_type:
+    :param system_name:
+    :param patient:
+    :param config:
+    :param since:
+    :param elements:
+    :param summary:
+    :param sort:
+    :return: {'data': pyarrow.Table, 'version': latest version of the table}, the version is the _since
+    of the next incremental sync
+    """
+    changes = get_changes(resource_type, system_name, patient, config, since)
+    if not isinstance(changes['data'], pa.Table):
+        return changes
+    data = get_current_rows(changes['data'])
+    if sort:
+        data = top_k(data, parse_sort(resource_type, sort), None)
+    input_dir = os.path.join(
+        config.system_config['paths']['base_path'],
+        config.system_config['systems'][system_name]['db_name'])
+    data = project_table(data, get_search_projection(input_dir, resource_type.lower(), elements, summary))
+    return {'data': data, 'version': changes['version']}
+
+
+def get_filtered_data(resource_type, system_name, patient, config, content: str = None, text: str = None,
+                      code_in: str = None, code_below: str = None, elements: str = None, summary: str = None,
+                      sort: str = None):
+    """
+    Searches with the filters that are not pushed into the scan. _content and _text search the text index of
+    the table, the matching resources are then read from the patient partition. code:in and code:below match
+    the codings of the code element against the compiled ValueSet expansions and subsumption closures.
+
+    :param resource_type:
+    :param system_name:
+    :param patient:
+    :param config:
+    :param content: _content search parameter
+    :param text: _text search parameter
+    :param code_in: comma separated ValueSet urls
+    :param code_below: comma separated "system|code" tokens
+    :param elements:
+    :param summary:
+    :param sort: _sort search parameter, text matches are ordered by relevance without it
+    :return: get_data result
+    """
+    patient_type, patient_id, patient_url = get_reference_parameters(patient)
+    input_dir = os.path.join(
+        config.system_config['paths']['base_path'],
+        config.system_config['systems'][system_name]['db_name'])
+    table_path = os.path.join(input_dir, resource_type.lower())
+    value_set = None
+    if code_in or code_below:
+        terminology = get_terminology(config.terminology_dir, config.terminology_cache_size)
+        value_sets = [terminology.expand(url) for url in (code_in or "").split(",") if url] + \
+            [terminology.below(token) for token in (code_below or "").split(",") if token]
+        if not value_sets:
+            raise TerminologyError("code:in and code:below take ValueSet urls and codes, none were given")
+        value_set = pa.concat_arrays(value_sets)
+
+    filter_expression, scores = None, None
+    if content or text:
+        try:
+            get_table_version(table_path, config.table_version_ttl)
+        except PyDeltaTableError as e:
+            logger.warning(f'Table not found: {e}')
+            return {'data': [], 'message': 'No files found'}
+        index = get_text_index(config.text_index_dir, table_path, config.text_index_max_segments)
+        for field, query in ((CONTENT, content), (TEXT, text)):
+            if query:
+                matches = index.search(get_delta_table(table_path), field, query, patient_id,
+                                       config.text_index_wait)
+                scores = matches if scores is None else {
+                    resource_id: score + matches[resource_id] for resource_id, score in scores.items()
+                    if resource_id in matches}
+        if not scores:
+            return {'data': [], 'total': 0}
+        filter_expression = pc.field("id").isin(list(scores))
+
+    if value_set is None:
+        data = get_data(resource_type, system_name, patient, config, filter_expression,
+                        elements=elements, summary=summary, sort=sort)
+    else:
+        # the code element is read whatever the projection, which is applied after the match
+        data = get_data(resource_type, system_name, patient, config, filter_expression, sort=sort)
+        if isinstance(data['data'], pa.Table):
+            table = data['data'].filter(get_value_set_mask(data['data'], "code", value_set))
+            table = project_table(table, get_search_projection(input_dir, resource_type.lower(), elements, summary))
+            data = {**data, 'data': table, **({'total': table.num_rows} if 'total' in data else {})}
+    table = data['data']
+    if sort or scores is None or not isinstance(table, pa.Table) or "id" not in table.schema.names:
+        return data
+    ranks = [-scores.get(resource_id, 0.0) for resource_id in table.column("id").to_pylist()]
+    return {**data, 'data': table.take(pa.array(np.argsort(ranks, kind="stable")))}
+
+
+def get_search_projection(input_dir, resource_type, elements: str = None, summary: str = None):
+    """
+    :param input_dir:
+    :param resource_type:
+    :param elements: _elements search parameter
+    :param summary: _summary search parameter
+    :return: scan projection of the search, None for every column
+    """
+    if not elements and not summary:
+        return
+    schema = get_table_schema(os.path.join(input_dir, resource_type))
+    paths = get_element_paths(resource_type, schema, elements, summary) if schema else None
+    return get_projection(schema, paths) if paths else None
+
+
+def get_streaming_scanner(resource_type, system_name, patient, config, elements: str = None, summary: str = None,
+                          stream: bool = True):
+    """
+    Returns a scanner of the patient partition when reading the whole partition would exceed the memory
+    budget of the request. The in-memory size is estimated from the parquet file sizes of the delta add
+    actions, times memory_expansion_ratio.
+
+    :param resource_type:
+    :param system_name:
+    :param patient:
+    :param config:
+    :param elements:
+    :param summary:
+    :param stream: when False a partition over the budget is rejected with MemoryBudgetExceeded
+    :return: None when the partition fits in the budget
+    """
+    budget = get_memory_budget()
+    if budget is None:
+        return
+    resource_type = resource_type.lower()
+    patient_type, patient_id, patient_url = get_reference_parameters(patient)
+    input_dir = os.path.join(
+        config.system_config['paths']['base_path'],
+        config.system_config['systems'][system_name]['db_name'])
+    size = get_partition_size(os.path.join(input_dir, resource_type), patient_id, config.table_version_ttl)
+    if not size or size * config.memory_expansion_ratio <= budget.limit:
+        return
+    if not stream:
+        budget.check(int(size * config.memory_expansion_ratio))
+    dataset = get_resource_dataset(input_dir, resource_type, [("yy__patient_id", "=", patient_id)], config.io_mode)
+    if dataset is None:
+        return
+    MEMORY_BUDGET_EXCEEDED.labels("streamed").inc()
+    columns = get_search_projection(input_dir, resource_type, elements, summary)
+    if columns is None and has_resource_json(dataset.schema):
+        columns = [name for name in dataset.schema.names if name != RESOURCE_JSON]
+    return dataset.scanner(columns=columns, memory_pool=budget.pool)
+
+
+def get_page_data(scanner, offset: int, size: int) -> pa.Table:
+    """
+    Reads the rows of a page, the batches before the page are dropped as they are read and the scan stops
+    at the end of the page
+
+    :param scanner:
+    :param offset:
+    :param size:
+    :return:
+    """
+    batches, skipped, rows = [], 0, 0
+    for batch in check_budget(check_batches(scanner.to_batches())):
+        if skipped + batch.num_rows <= offset:
+            skipped += batch.num_rows
+            continue
+        batch = batch.slice(offset - skipped)
+        skipped = offset
+        batches.append(batch)
+        rows += batch.num_rows
+        if rows >= size:
+            break
+    return pa.Table.from_batches(batches, schema=scanner.projected_schema).slice(0, size)
+
+
+async def get_shared_data(resource_type, system_name, patient, config, **kwargs):
+    """
+    get_data run in the thread pool, concurrent calls with the same search on the same delta table
+    version share a single call
+
+    :param resource_type:
+    :param system_name:
+    :param patient:
+    :param config:
+    :param kwargs: get_data keyword arguments
+    :return:
+    """
+    if not config.single_flight_enabled:
+        return await run_in_threadpool(get_data, resource_type, system_name, patient, config, **kwargs)
+    patient_type, patient_id, patient_url = get_reference_parameters(patient)
+    table_path = os.path.join(
+        config.system_config['paths']['base_path'],
+        config.system_config['systems'][system_name]['db_name'],
+        resource_type.lower())
+    try:
+        version = await run_in_threadpool(get_table_version, table_path, config.table_version_ttl)
+    except PyDeltaTableError:
+        version = None
+    key = (table_path, patient_id, version, tuple((name, str(value)) for name, value in sorted(kwargs.items())))
+    return await get_single_flight().do(key, get_data, resource_type, system_name, patient, config, **kwargs)
+
+
+def get_table_schema(input_dir):
+    """
+
+    :param input_dir:
+    :return: arrow schema of the delta table, None when the table does not exist
+    """
+    try:
+        return get_delta_table(input_dir).schema().to_pyarrow()
+    except PyDeltaTableError as e:
+        logger.warning(f'Table not found: {e}')
+        return
+
+
+def get_patient_data(input_dir, resource_type, patient_id, config, columns: Dict[str, pc.Expression] = None):
+    """
+    Reads the patient partition of a resource, through the in-process hot store and the cache shared
+    by the workers of the host when they are enabled. The caches hold whole partitions, projected reads
+    of uncached partitions go straight to the table.
+
+    :param input_dir:
+    :param resource_type:
+    :param patient_id:
+    :param config:
+    :param columns: scan projection, see utility.elements.get_projection
+    :return:
+    """
+    partition_column_data = [("yy__patient_id", "=", patient_id)]
+    if not config.hot_store_enabled and not config.shared_cache_enabled:
+        return get_resource_data(
+            input_dir=input_dir, resource=resource_type, partition_column_data=partition_column_data,
+            columns=columns, **get_io_options(config))
+
+    table_path = os.path.join(input_dir, resource_type)
+    try:
+        version = get_table_version(table_path, config.table_version_ttl)
+    except PyDeltaTableError as e:
+        logger.warning(f'Table not found: {e}')
+        return
+    key = (table_path, patient_id)
+    hot_store = get_hot_store(config.hot_store_max_bytes, config.tenant) if config.hot_store_enabled else None
+    data = hot_store.get(key, version) if hot_store else None
+    if data is not None:
+        return project_table(data, columns)
+    if columns:
+        return get_resource_data(
+            input_dir=input_dir, resource=resource_type, partition_column_data=partition_column_data,
+            columns=columns, **get_io_options(config))
+
+    shared_cache = get_shared_cache(
+        config.shared_cache_socket, config.shared_cache_dir) if config.shared_cache_enabled else None
+    # the version is part of the shared key, entries of older versions are never read again and age out
+    shared_key = f"{table_path}|{patient_id}|{version}"
+    data = shared_cache.get_table(shared_key) if shared_cache else None
+    if data is None:
+        data = get_resource_data(
+            input_dir=input_dir, resource=resource_type, partition_column_data=partition_column_data,
+            **get_io_options(config))
+        if data is not None and shared_cache:
+            shared_cache.put_table(shared_key, data)
+    if data is not None and hot_store:
+        data = hot_store.put(key, version, data)
+    return data
+
+
+def merge_pending_writes(data: Optional[pa.Table], table_path, patient_id, config,
+                         columns: Dict[str, pc.Expression] = None) -> Optional[pa.Table]:
+    """
+    Adds the rows this worker wrote to the partition that are not in the table version read yet, they
+    replace the read rows with the same ids
+
+    :param data: rows read from the partition
+    :param table_path:
+    :param patient_id:
+    :param config:
+    :param columns: scan projection the rows were read with
+    :return:
+    """
+    overlay = get_write_overlay()
+    if not overlay.has_pending(table_path):
+        return data
+    try:
+        version = get_table_version(table_path, config.table_version_ttl)
+    except PyDeltaTableError:
+        version = None
+    pending = overlay.get(table_path, patient_id, version)
+    if pending is None:
+        return data
+    pending = project_table(pending, columns)
+    if not data:
+        return pending
+    if "id" in data.schema.names and "id" in pending.schema.names:
+        data = data.filter(pc.invert(pc.is_in(data.column("id"), value_set=pending.column("id"))))
+    return pa.concat_tables([data, pending.select(data.schema.names).cast(data.schema)])
+
+
+def get_sorted_patient_data(input_dir, resource_type, patient_id, config, sort: str, limit: int = None,
+                            filter_expression: pc.Expression = None):
+    """
+    Returns the first rows of the patient partition in _sort order. Partitions in the hot store are
+    sorted in memory, others are sorted by a bounded top-k over the scan that skips the row groups whose
+    statistics rule them out.
+
+    :param input_dir:
+    :param resource_type:
+    :param patient_id:
+    :param config:
+    :param sort: _sort search parameter
+    :param limit: number of rows to return, None sorts the whole partition
+    :param filter_expression:
+    :return: the sorted rows and the number of matching rows
+    """
+    keys = parse_sort(resource_type, sort)
+    partition_column_data = [("yy__patient_id", "=", patient_id)]
+    if config.hot_store_enabled:
+        table_path = os.path.join(input_dir, resource_type)
+        try:
+            version = get_table_version(table_path, config.table_version_ttl)
+        except PyDeltaTableError as e:
+            logger.warning(f'Table not found: {e}')
+            return None, 0
+        data = get_hot_store(config.hot_store_max_bytes, config.tenant).get((table_path, patient_id), version)
+        if data is not None:
+            if filter_expression is not None:
+                data = data.filter(filter_expression)
+            return top_k(data, keys, limit), data.num_rows
+
+    dataset = get_resource_dataset(input_dir, resource_type, partition_column_data, config.io_mode)
+    if dataset is None:
+        return None, 0
+    return scan_top_k(dataset, keys, limit, filter_expression)
+
+
+def get_count(resource_type, system_name, patient, config, filter_expression: pc.Expression = None,
+              accurate: bool = True):
+    """
+    Counts the rows of a patient partition without reading them. Without a filter, or when an estimate
+    is enough, the count comes from the numRecords stats of the delta add actions, then from the parquet
+    footers. With a filter only the filtered columns are scanned.
+
+    :param resource_type:
+    :param system_name:
+    :param patient:
+    :param config:
+    :param filter_expression:
+    :param accurate: when False the filter is ignored and the partition row count is returned
+    :return:
+    """
+    resource_type = resource_type.lower()
+    patient_type, patient_id, patient_url = get_reference_parameters(patient)
+    if system_name not in config.system_config['systems'][system_name]:
+        input_dir = os.path.join(
+            config.system_config['paths']['base_path'],
+            config.system_config['systems'][system_name]['db_name'])
+        try:
+            # the counts read the cached table handle, moved to the latest version first
+            get_table_version(os.path.join(input_dir, resource_type), config.table_version_ttl)
+        except PyDeltaTableError as e:
+            logger.warning(f'Table not found: {e}')
+            return 0
+        if filter_expression is None or not accurate:
+            count = get_delta_record_count(os.path.join(input_dir, resource_type), patient_id)
+            if count is not None:
+                return count
+        dataset = get_resource_dataset(
+            input_dir, resource_type, [("yy__patient_id", "=", patient_id)], config.io_mode)
+        if dataset is None:
+            return 0
+        if filter_expression is None or not accurate:
+            return dataset.count_rows()
+        return dataset.count_rows(filter=filter_expression)
+
+
+def get_delta_record_count(input_dir, patient_id):
+    """
+    Sums the numRecords stats of the add actions of the patient partition
+
+    :param input_dir:
+    :param patient_id:
+    :return: None when the stats are not available for every file of the partition
+    """
+    try:
+        delta_table = get_delta_table(input_dir)
+    except PyDeltaTableError as e:
+        logger.warning(f'Table not found: {e}')
+        return 0
+    if not hasattr(delta_table, "get_add_actions"):
+        return None
+    actions = delta_table.get_add_actions(flatten=True)
+    if "num_records" not in actions.schema.names or "partition.yy__patient_id" not in actions.schema.names:
+        return None
+    num_records = pc.filter(
+        actions.column("num_records"), pc.equal(actions.column("partition.yy__patient_id"), patient_id))
+    if num_records.null_count:
+        return None
+    return pc.sum(num_records).as_py() or 0
+
+
+_partition_sizes: Dict[str, Tuple[int, Optional[Dict[str, int]]]] = {}
+
+
+def get_partition_size(input_dir, patient_id, ttl: float = 0.0):
+    """
+    Sums the parquet file sizes of the add actions of the patient partition. The sizes of every partition
+    are listed once per table version, see get_table_version.
+
+    :param input_dir:
+    :param patient_id:
+    :param ttl: see get_table_version
+    :return: bytes, None when the add actions are not available
+    """
+    try:
+        version = get_table_version(input_dir, ttl)
+    except PyDeltaTableError as e:
+        logger.warning(f'Table not found: {e}')
+        return 0
+    cached_version, sizes = _partition_sizes.get(input_dir, (None, None))
+    if cached_version != version:
+        sizes = get_partition_sizes(get_delta_table(input_dir))
+        _partition_sizes[input_dir] = (version, sizes)
+    return sizes.get(patient_id, 0) if sizes is not None else None
+
+
+def get_partition_sizes(delta_table) -> Optional[Dict[str, int]]:
+    """
+    :param delta_table:
+    :return: parquet bytes of every patient partition, None when the add actions are not available
+    """
+    if not hasattr(delta_table, "get_add_actions"):
+        return None
+    actions = delta_table.get_add_actions(flatten=True)
+    if "size_bytes" not in actions.schema.names or "partition.yy__patient_id" not in actions.schema.names:
+        return None
+    sizes = pa.Table.from_batches([actions]).group_by("partition.yy__patient_id").aggregate([("size_bytes", "sum")])
+    return dict(zip(sizes.column("partition.yy__patient_id").to_pylist(), sizes.column("size_bytes_sum").to_pylist()))
 
 
 def get_paginated_data(data, page_num, page_size):
-    data_length = len(data["data"])
+    data_length = data.get("total", len(data["data"]))
     start = (page_num - 1) * page_size
     end = start + page_size
+    # streamed results only hold the rows from 'offset'
+    offset = data.get("offset", 0)
+    page = data["data"][start - offset:end - offset]
+    if isinstance(page, pa.Table):
+        page = page.to_pylist()
     response = {
-        "data": data["data"][start:end],
+        "data": page,
         "total": data_length,
-        "count": len(data["data"][start:end]),
+        "count": len(page),
         "pagination": {}
     }
 
@@ -179,3 +936,235 @@ def get_paginated_data(data, page_num, page_size):
         response["pagination"]["next"] = f"page_num={page_num + 1} & page_size={page_size}"
 
     return response
+
+
+class SearchParameters:
+    """
+    FHIR search result parameters shared by the resource routes
+    """
+
+    def __init__(
+            self,
+            format_: str = Query(
+                None, alias="_format",
+                description="application/vnd.apache.arrow.stream or parquet for binary output, json by default"),
+            elements: str = Query(
+                None, alias="_elements", description="comma separated elements, ex: id,code,subject.reference"),
+            summary: str = Query(None, alias="_summary", regex="^(true|text|data|count|false)$"),
+            total: str = Query(None, alias="_total", regex="^(none|estimate|accurate)$"),
+            include: Optional[List[str]] = Query(
+                None, alias="_include", description="ex: MedicationRequest:medication"),
+            revinclude: Optional[List[str]] = Query(
+                None, alias="_revinclude", description="ex: Provenance:target"),
+            sort: str = Query(
+                None, alias="_sort", regex=r"^-?(date|code|status)(,-?(date|code|status))*$",
+                description="date, code or status, prefixed with - for descending order"),
+            since: str = Query(
+                None, alias="_since", regex=SINCE_PATTERN,
+                description="delta table version or instant, only the resources changed after it"),
+            content: str = Query(
+                None, alias="_content", description="words of the resource content, ranked by relevance"),
+            text: str = Query(
+                None, alias="_text", description="words of the resource narrative, ranked by relevance"),
+            code_in: str = Query(
+                None, alias="code:in", description="comma separated ValueSet urls, codes of their expansions"),
+            code_below: str = Query(
+                None, alias="code:below", description="comma separated tokens, ex: http://loinc.org|4548-4, "
+                                                      "the codes and their descendants")):
+        self.format = format_
+        self.elements = elements
+        self.summary = summary
+        self.total = total
+        self.include = include
+        self.revinclude = revinclude
+        self.sort = sort
+        self.since = since
+        self.content = content
+        self.text = text
+        self.code_in = code_in
+        self.code_below = code_below
+
+    def is_filtered(self) -> bool:
+        """
+        :return: True when the search has filters applied after the scan, see get_filtered_data
+        """
+        return bool(self.content or self.text or self.code_in or self.code_below)
+
+
+def is_raw_json_search(resource_type, system_name, config, params: SearchParameters, output_format) -> bool:
+    """
+    :return: True when the search returns whole resources as json and the table has a resource_json column
+    """
+    if not config.resource_json_enabled or output_format or params.elements or params.summary or params.sort \
+            or params.include or params.revinclude or params.is_filtered():
+        return False
+    return has_resource_json(get_table_schema(os.path.join(
+        config.system_config['paths']['base_path'],
+        config.system_config['systems'][system_name]['db_name'],
+        resource_type.lower())))
+
+
+def get_raw_json_response(data, page_num, page_size, params: SearchParameters) -> Optional[Response]:
+    """
+    Builds the json response of a page from the resource_json values of its rows, the values are spliced
+    into the body as they are stored
+
+    :param data: get_data result read with raw_json
+    :param page_num:
+    :param page_size:
+    :param params:
+    :return: None when a resource of the page has no resource_json, the page is then decoded from the columns
+    """
+    table = data["data"]
+    response = get_paginated_data({**data, "data": range(table.num_rows)}, page_num, page_size)
+    rows = response.pop("data")
+    page = table.column(RESOURCE_JSON).slice(rows.start, len(rows))
+    if page.null_count:
+        return None
+    if PARTITION_COLUMN in table.schema.names:
+        # the stored json never holds the partition column, the decoded rows do
+        partitions = table.column(PARTITION_COLUMN).slice(rows.start, len(rows))
+        page = append_json_element(page, PARTITION_COLUMN, partitions)
+    if params.total == "none":
+        response.pop("total")
+    if "version" in data:
+        response["version"] = data["version"]
+    # "data" stays the first key of the body, like the decoded responses
+    body = b'{"data":[' + join_resource_json(page) + b'],' + orjson.dumps(response)[1:]
+    return Response(content=body, media_type="application/json")
+
+
+async def get_search_count(resource_type, system_name, patient, config, params: SearchParameters) -> int:
+    """
+    _summary=count. The filters applied after the scan, _since and the writes of this worker that the table
+    version read does not hold yet are counted on the ids of the rows they select, the other searches on
+    the partition row count.
+
+    :param resource_type:
+    :param system_name:
+    :param patient:
+    :param config:
+    :param params:
+    :return: number of matching resources
+    """
+    table_path = os.path.join(
+        config.system_config['paths']['base_path'],
+        config.system_config['systems'][system_name]['db_name'],
+        resource_type.lower())
+    if params.is_filtered():
+        data = await run_in_threadpool(
+            get_filtered_data, resource_type, system_name, patient, config, params.content, params.text,
+            params.code_in, params.code_below, elements="id")
+    elif params.since:
+        data = await run_in_threadpool(
+            get_changed_data, resource_type, system_name, patient, config, params.since, elements="id")
+    elif get_write_overlay().has_pending(table_path):
+        data = await get_shared_data(resource_type, system_name, patient, config, elements="id")
+    else:
+        return await run_in_threadpool(
+            get_count, resource_type, system_name, patient, config, accurate=params.total != "estimate")
+    return data.get("total", len(data["data"]))
+
+
+async def get_search_response(resource_type, system_name, patient, config, page_num, page_size,
+                              params: SearchParameters):
+    """
+    Runs the search of a resource route and builds its response. Binary formats return every matching
+    row in one arrow stream or parquet file, json responses are paginated. _summary=count only returns
+    the total, which is counted without reading the rows.
+
+    :param resource_type:
+    :param system_name:
+    :param patient:
+    :param config:
+    :param page_num:
+    :param page_size:
+    :param params:
+    :return:
+    """
+    if params.summary == "count":
+        total = await get_search_count(resource_type, system_name, patient, config, params)
+        return {"data": [], "total": total, "count": 0, "pagination": {"next": None, "previous": None}}
+
+    output_format = get_output_format(params.format)
+    # partitions over the memory budget are streamed, arrow streams batch by batch and json pages are
+    # read up to the end of the page. Sorted reads are already bounded by the top-k, _since reads by the
+    # commits after it
+    scanner = None if params.sort or params.since or params.is_filtered() else await run_in_threadpool(
+        get_streaming_scanner, resource_type, system_name, patient, config, params.elements, params.summary,
+        stream=output_format in (None, ARROW_STREAM_MEDIA_TYPE))
+    if scanner is not None and output_format:
+        return get_batches_response(scanner.projected_schema, check_budget(scanner.to_batches()))
+    if scanner is not None:
+        offset = (page_num - 1) * page_size
+        data = {
+            "data": await run_in_threadpool(get_page_data, scanner, offset, page_size),
+            "total": await run_in_threadpool(get_count, resource_type, system_name, patient, config, accurate=False),
+            "offset": offset,
+        }
+    elif params.is_filtered():
+        data = await run_in_threadpool(
+            get_filtered_data, resource_type, system_name, patient, config, params.content, params.text,
+            params.code_in, params.code_below, elements=params.elements, summary=params.summary, sort=params.sort)
+    elif params.since:
+        data = await run_in_threadpool(
+            get_changed_data, resource_type, system_name, patient, config, params.since,
+            elements=params.elements, summary=params.summary, sort=params.sort)
+    else:
+        if is_raw_json_search(resource_type, system_name, config, params, output_format):
+            data = await get_shared_data(resource_type, system_name, patient, config, raw_json=True)
+            response = get_raw_json_response(data, page_num, page_size, params) \
+                if isinstance(data["data"], pa.Table) else None
+            if response is not None:
+                return response
+        # sorted json pages only need the rows up to the end of the requested page
+        limit = page_num * page_size if params.sort and not output_format else None
+        data = await get_shared_data(
+            resource_type, system_name, patient, config, elements=params.elements, summary=params.summary,
+            sort=params.sort, limit=limit)
+    if output_format and isinstance(data["data"], pa.Table):
+        return await run_in_threadpool(get_format_response, data["data"], output_format)
+    response = get_paginated_data(data, page_num, page_size)
+    if params.total == "none":
+        response.pop("total")
+    if "version" in data:
+        response["version"] = data["version"]
+    if (params.include or params.revinclude) and isinstance(data["data"], pa.Table):
+        page = data["data"].slice((page_num - 1) * page_size - data.get("offset", 0), page_size)
+        response["included"] = await run_in_threadpool(
+            get_included_resources, resource_type, system_name, patient, config, page, params.include,
+            params.revinclude)
+    return response
+
+
+def get_included_resources(resource_type, system_name, patient, config, page: pa.Table, include: List[str],
+                           revinclude: List[str]):
+    """
+    Resolves _include and _revinclude within the partition of the patient, the shared resources like
+    Medication or Practitioner are read by id from the whole table
+
+    :param resource_type:
+    :param system_name:
+    :param patient:
+    :param config:
+    :param page:
+    :param include:
+    :param revinclude:
+    :return:
+    """
+    patient_type, patient_id, patient_url = get_reference_parameters(patient)
+    input_dir = os.path.join(
+        config.system_config['paths']['base_path'],
+        config.system_config['systems'][system_name]['db_name'])
+    def read_ids(target, ids):
+        dataset = get_resource_dataset(input_dir, target.lower(), io_mode=config.io_mode)
+        if dataset is None or "id" not in dataset.schema.names:
+            return None
+        id_filter = pc.field("id").isin(pa.array(ids, dataset.schema.field("id").type))
+        return drop_resource_json(dataset.to_table(filter=id_filter, memory_pool=get_memory_pool()))
+
+    return get_included(
+        resource_type, page, include, revinclude,
+        read_table=lambda target: drop_resource_json(
+            get_patient_data(input_dir, target.lower(), patient_id, config)),
+        read_ids=read_ids)
@@ -0,0 +1,119 @@
+"""
+Reload of the customer system_config TOML without a restart
+"""
+import os
+import asyncio
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+import toml
+from loguru import logger
+
+
+def get_system_config_path() -> str:
+    """
+    :return: path of the TOML of the CUSTOMER environment variable
+    """
+    return os.path.join(os.path.dirname(__file__), f"../config/{os.getenv('CUSTOMER').lower()}.toml")
+
+
+def load_system_config(config_path: str) -> Dict:
+    """
+    Loads and validates a system_config TOML
+
+    :param config_path:
+    :return:
+    """
+    system_config = toml.load(config_path)
+    base_path = system_config.get("paths", {}).get("base_path")
+    if not isinstance(base_path, str) or not base_path:
+        raise ValueError(f"{config_path}: paths.base_path must be a non empty string")
+    systems = system_config.get("systems")
+    if not isinstance(systems, dict):
+        raise ValueError(f"{config_path}: [systems.*] tables are missing")
+    for name, system in systems.items():
+        if not isinstance(system, dict) or not isinstance(system.get("db_name"), str) or not system["db_name"]:
+            raise ValueError(f"{config_path}: systems.{name}.db_name must be a non empty string")
+    return system_config
+
+
+def get_database_dirs(system_config: Dict) -> Dict[str, str]:
+    """
+    :param system_config:
+    :return: delta database directory of every system, by system name
+    """
+    base_path = system_config.get("paths", {}).get("base_path", "")
+    return {
+        name: os.path.join(base_path, system["db_name"])
+        for name, system in system_config.get("systems", {}).items()
+    }
+
+
+class SystemConfigWatcher:
+    """
+    Polls the system_config TOML and swaps the settings snapshot when it changes. The snapshot dict is never
+    modified, a reload replaces it with a new one in a single assignment, so readers see the old or the new
+    config. Only the delta databases of the systems that were removed or moved are closed, and only those
+    of the new systems are opened, the tables of unchanged systems keep their handles and cached data.
+    """
+
+    def __init__(self, settings, config_path: str, interval: float,
+                 open_databases: Callable[[Iterable[str]], None] = None,
+                 close_databases: Callable[[Iterable[str]], None] = None):
+        """
+        :param settings: AppSettings holding the system_config snapshot
+        :param config_path:
+        :param interval: seconds between two checks of the file
+        :param open_databases: called with the database directories of the new systems
+        :param close_databases: called with the database directories of the removed systems
+        """
+        self.settings = settings
+        self.config_path = config_path
+        self.interval = interval
+        self.open_databases = open_databases
+        self.close_databases = close_databases
+        self._signature = self._get_signature()
+        self._task: Optional[asyncio.Task] = None
+
+    def _get_signature(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.config_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def reload(self) -> bool:
+        """
+        :return: True when the new config was loaded and swapped in
+        """
+        try:
+            system_config = load_system_config(self.config_path)
+        except (OSError, ValueError, toml.TomlDecodeError) as e:
+            logger.warning(f'Invalid system config, keeping the current one: {e}')
+            return False
+        old_dirs = set(get_database_dirs(self.settings.system_config).values())
+        new_dirs = set(get_database_dirs(system_config).values())
+        self.settings.system_config = system_config
+        if self.close_databases and old_dirs - new_dirs:
+            self.close_databases(old_dirs - new_dirs)
+        if self.open_databases and new_dirs - old_dirs:
+            self.open_databases(new_dirs - old_dirs)
+        logger.info(f'System config reloaded, {len(new_dirs - old_dirs)} databases opened, '
+                    f'{len(old_dirs - new_dirs)} closed')
+        return True
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            signature = self._get_signature()
+            if signature is None or signature == self._signature:
+                continue
+            self._signature = signature
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.reload)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._watch())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
@@ -2,14 +2,15 @@
 This module contains all project related settings.
 """
 import os
-import toml
 from functools import lru_cache
 from os import path
-from typing import List, Dict
+from typing import List, Dict, Literal, Optional
 
 import requests
 from pydantic import BaseSettings, Extra, HttpUrl, SecretStr, PostgresDsn
 
+from .configwatch import get_system_config_path, load_system_config
+
 
 class KeycloakModel(BaseSettings):
     """Keycloak Settings"""
@@ -88,6 +89,126 @@ class AppSettings(BaseSettings):
     )
     system_config: Dict = {}
 
+    # parquet io settings, "mmap" memory maps the local parquet files of the delta tables
+    io_mode: Literal["default", "mmap"] = "default"
+    io_pre_buffer: bool = True
+    io_hole_size_limit: int = 8192
+    io_range_size_limit: int = 32 * 1024 * 1024
+
+    # hot store settings, recently read patient partitions are kept in memory as arrow tables
+    hot_store_enabled: bool = False
+    hot_store_max_bytes: int = 512 * 1024 * 1024
+    # shared cache settings, a cache daemon shared by all the workers of a host, see utility/sharedcache.py
+    shared_cache_enabled: bool = False
+    shared_cache_socket: str = "/tmp/fhir-api-cache.sock"
+    shared_cache_dir: str = "/dev/shm/fhir-api-cache"
+
+    # response compression settings, see middleware/compression.py
+    compression_minimum_size: int = 1024
+    compression_threadpool_size: int = 256 * 1024
+    compression_encodings: List[str] = ["zstd", "br", "gzip"]
+
+    # identical concurrent reads of a table version share a single scan
+    single_flight_enabled: bool = True
+
+    # plain json searches of tables with a resource_json column splice its values into the response
+    resource_json_enabled: bool = True
+
+    # _text and _content searches, the index segments of every table are written under text_index_dir and
+    # merged in one past text_index_max_segments, see utility/textindex.py. New commits are indexed in the
+    # background, a search waits for them at most text_index_wait seconds
+    text_index_dir: str = "/tmp/fhir-api-text-index"
+    text_index_max_segments: int = 8
+    text_index_wait: float = 1.0
+
+    # code:in and code:below searches, CodeSystem and ValueSet files of terminology_dir are loaded at startup,
+    # terminology_cache_size expansions and closures are kept, see utility/terminology.py
+    terminology_dir: str = "/data/terminology"
+    terminology_cache_size: int = 1024
+
+    # seconds between two checks of the delta log for new table versions
+    table_version_ttl: float = 1.0
+
+    # request deadlines in seconds, default and per resource type, see middleware/cancellation.py
+    request_deadline: float = 30.0
+    request_deadlines: Dict[str, float] = {}
+    request_deadline_max: float = 300.0
+
+    # per request arrow memory budget in bytes, 0 disables it, see middleware/memory.py
+    memory_budget: int = 1024 * 1024 * 1024
+    # in-memory size of a partition over its parquet file size, estimates a partition before it is read
+    memory_expansion_ratio: float = 5.0
+
+    # seconds between two writes of the request metrics of a worker, when PROMETHEUS_MULTIPROC_DIR is set
+    metrics_flush_interval: float = 5.0
+
+    # seconds between two checks of the system_config TOML for changes, 0 disables the reload
+    system_config_reload_interval: float = 5.0
+
+    # seconds between two checks for new commits, and between two keepalives, of the change feed streams
+    change_feed_poll_interval: float = 2.0
+    change_feed_keepalive: float = 15.0
+
+    # group commit of the write path, a table is committed once it buffers write_max_rows rows or
+    # write_max_delay seconds after its first buffered write, see utility/writer.py
+    write_max_rows: int = 1000
+    write_max_delay: float = 0.05
+    # upsert retries when another commit changed the patient partition
+    write_commit_retries: int = 5
+
+    # $import of NDJSON files, only files under import_dir are read, see utility/bulkimport.py
+    import_dir: str = "/data/import"
+    # parsing processes, 0 for one per cpu
+    import_processes: int = 0
+    # bytes of NDJSON parsed per task, and arrow bytes buffered before a commit
+    import_chunk_bytes: int = 16 * 1024 * 1024
+    import_batch_bytes: int = 256 * 1024 * 1024
+    # lines the schema of a new table is inferred from
+    import_sample_lines: int = 10000
+    # new tables get a resource_json column holding the imported lines, see utility/rawjson.py
+    import_resource_json: bool = False
+    # seconds the status of a finished import stays available
+    import_job_retention: float = 24 * 3600
+
+    # compaction of the partitions with many small files, see utility/compaction.py. The scheduled runs
+    # only compact in the local time window and are checked every compaction_check_interval seconds
+    compaction_enabled: bool = False
+    compaction_window: str = "01:00-05:00"
+    compaction_check_interval: float = 300.0
+    # partitions with fewer files are left alone, and partitions compacted per table and run
+    compaction_min_files: int = 8
+    compaction_max_partitions: int = 10000
+    # cluster the compacted rows on a z-order of date and code, in row groups of compaction_row_group_rows
+    compaction_zorder: bool = True
+    compaction_row_group_rows: int = 16384
+    # bytes read and written per second by compaction, 0 disables the throttle
+    compaction_max_bytes_per_second: int = 64 * 1024 * 1024
+    # hours the files removed by compaction are kept for readers of older versions, before the vacuum
+    vacuum_retention_hours: int = 168
+
+    # patient sharding, requests with a patient are proxied to the node owning it on a consistent hash ring
+    # of shard_nodes, empty disables it. shard_self is the base url of this node, see middleware/sharding.py
+    shard_nodes: List[str] = []
+    shard_self: str = ""
+    shard_virtual_nodes: int = 128
+    # keep-alive connections to the other nodes, and seconds to connect or wait for a proxied response
+    shard_pool_size: int = 100
+    shard_timeout: float = 30.0
+    # seconds between two health checks of the other nodes
+    shard_health_interval: float = 5.0
+
+    # multi-tenant mode, every app/config TOML is a tenant, routed by header or /tenants/<tenant> path prefix.
+    # The tenants are listed at startup, adding or removing a TOML takes a restart
+    multi_tenant: bool = False
+    tenant_header: str = "x-tenant"
+    # concurrent requests of all the tenants, and of one tenant, further requests are queued fairly
+    tenant_concurrency: int = 32
+    tenant_max_concurrency: int = 8
+    # settings by tenant, ex: {"test1": {"hot_store_max_bytes": 268435456, "tenant_max_concurrency": 4}}
+    tenant_overrides: Dict[str, Dict] = {}
+    # name of the tenant of a tenant settings copy, see core/tenants.py
+    tenant: Optional[str] = None
+
     class Config(BaseSettings.Config):
         """Config Function"""
         extra: Extra = Extra.ignore
@@ -166,8 +287,8 @@ def get_settings():
     settings_file: str = os.getenv("APP_CONFIG_FILE")
     if settings_file is not None and path.exists(settings_file) and path.isfile(settings_file):
         settings = settings.parse_file(settings_file)
-    settings.system_config = toml.load(os.path.join(os.path.dirname(__file__),
-                                                    f"../config/{os.getenv('CUSTOMER').lower()}.toml"))
+    if os.getenv('CUSTOMER') or not settings.multi_tenant:
+        settings.system_config = load_system_config(get_system_config_path())
     return settings
 
 
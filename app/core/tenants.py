@@ -0,0 +1,70 @@
+"""
+Multi-tenant mode, every customer TOML of app/config is a tenant served by the same process.
+
+The tenants are listed once, at startup: the tenant middleware, the fair scheduler quotas, the memory
+budgets and the config watchers are built from that list. A TOML added or removed later takes a restart,
+the config reload only swaps the system_config of the tenants listed at startup.
+"""
+import os
+import glob
+from functools import lru_cache
+from typing import Dict
+
+import toml
+from fastapi import HTTPException, Request
+from loguru import logger
+
+from .configwatch import load_system_config
+from .settings import AppSettings, get_settings
+
+CONFIG_DIR = os.path.join(os.path.dirname(__file__), "../config")
+
+
+def get_tenant_config_path(tenant: str) -> str:
+    return os.path.join(CONFIG_DIR, f"{tenant}.toml")
+
+
+def load_tenant_settings(settings: AppSettings) -> Dict[str, AppSettings]:
+    """
+    Loads the customer TOMLs as tenants. The settings of a tenant are a copy of the process settings with
+    the system_config of its TOML and its tenant_overrides.
+
+    :param settings:
+    :return: settings by tenant name, the lower cased TOML file name
+    """
+    tenants = {}
+    for config_path in sorted(glob.glob(os.path.join(CONFIG_DIR, "*.toml"))):
+        tenant = os.path.splitext(os.path.basename(config_path))[0].lower()
+        try:
+            system_config = load_system_config(config_path)
+        except (OSError, ValueError, toml.TomlDecodeError) as e:
+            logger.warning(f'Tenant {tenant} not loaded: {e}')
+            continue
+        tenants[tenant] = settings.copy(update={
+            **settings.tenant_overrides.get(tenant, {}), "tenant": tenant, "system_config": system_config})
+    return tenants
+
+
+@lru_cache()
+def get_tenants() -> Dict[str, AppSettings]:
+    """
+    :return: the tenants found at startup, a tenant TOML added or removed later needs a restart
+    """
+    return load_tenant_settings(get_settings())
+
+
+def get_tenant_settings(request: Request) -> AppSettings:
+    """
+    Replaces get_settings in multi-tenant mode, returns the settings of the tenant of the request
+
+    :param request:
+    :return:
+    """
+    tenant = request.scope.get("tenant")
+    if tenant is None:
+        raise HTTPException(
+            status_code=400, detail="Tenant required, use the tenant header or the /tenants/<tenant> path prefix")
+    settings = get_tenants().get(tenant)
+    if settings is None:
+        raise HTTPException(status_code=404, detail=f"Tenant {tenant} not found")
+    return settings
@@ -2,6 +2,8 @@
 Main module which initializes FastAPI and required middleware
 """
 import os
+import asyncio
+from functools import partial
 from typing import List, Dict
 from loguru import logger
 from fastapi import FastAPI
@@ -11,24 +13,34 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.routing import solve_dependencies, run_endpoint_function
 from fastapi.encoders import jsonable_encoder
 from starlette.middleware.cors import CORSMiddleware
-from starlette_prometheus import PrometheusMiddleware, metrics
+from starlette.concurrency import run_in_threadpool
 from starlette.responses import FileResponse
 
 
 from .core.settings import get_settings, AppSettings
 from .core.log import setup_logging
+from .core.configwatch import SystemConfigWatcher, get_system_config_path, get_database_dirs
+from .core.tenants import get_tenants, get_tenant_settings, get_tenant_config_path
+from .common import open_delta_databases, close_delta_databases
 from .middleware.servertiming import ServerTimingMiddleware
+from .middleware.compression import CompressionMiddleware
+from .middleware.cancellation import CancellationMiddleware
+from .middleware.memory import MemoryBudgetMiddleware
+from .middleware.metrics import MetricsMiddleware, metrics
+from .middleware.tenant import TenantMiddleware
+from .middleware.sharding import ShardingMiddleware, ShardMembership
+from .utility.cancellation import ScanCancelled
+from .utility.changes import ChangesExpired
+from .utility.memory import MemoryBudgetExceeded
+from .utility.metrics import get_request_metrics, get_multiprocess_dir, write_snapshots
+from .utility.scheduler import FairScheduler
+from .utility.writer import WriteConflict
+from .utility.terminology import TerminologyError, get_terminology
+from .utility.textindex import TextIndexNotReady
+from .utility.compaction import schedule_compaction
 
 
-from .routes import (
-    fhirresource, observation, account, allergyintolerance, careplan, careteam, chargeitem, claim, claimresponse,
-    condition, coverage, diagnosticreport, documentreference, encounter, familymemberhistory, immunization,
-    medicationadministration, medicationrequest, medicationstatement, procedure, clinicalimpression, detectedissue,
-    media, specimen, bodystructure, imagingstudy, QuestionnaireResponse, molecularsequence, medicationdispense,
-    immunizationevaluation, immunizationrecommendation, goal, servicerequest, nutritionorder, visionprescription,
-    riskassessment, requestgroup, communication, communicationrequest, devicerequest, deviceusestatement,
-    guidanceresponse, supplydelivery, bundle
-)
+from .routes import RESOURCE_ROUTES, fhirresource, bundle, history, write, bulkimport, admin
 
 config: AppSettings = get_settings()
 api_prefix: str = config.api_prefix
@@ -64,7 +76,31 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-app.add_middleware(PrometheusMiddleware)
+app.add_middleware(
+    MemoryBudgetMiddleware,
+    limit=config.memory_budget,
+    limits={tenant: settings.memory_budget for tenant, settings in get_tenants().items()} if config.multi_tenant
+    else None,
+)
+app.add_middleware(
+    CancellationMiddleware,
+    deadline=config.request_deadline,
+    deadlines=config.request_deadlines,
+    max_deadline=config.request_deadline_max,
+)
+if config.multi_tenant:
+    app.dependency_overrides[get_settings] = get_tenant_settings
+    app.add_middleware(
+        TenantMiddleware,
+        tenants=get_tenants(),
+        scheduler=FairScheduler(
+            concurrency=config.tenant_concurrency,
+            quota=config.tenant_max_concurrency,
+            quotas={tenant: settings.tenant_max_concurrency for tenant, settings in get_tenants().items()},
+        ),
+        header=config.tenant_header,
+    )
+app.add_middleware(MetricsMiddleware, metrics=get_request_metrics())
 app.add_middleware(
     ServerTimingMiddleware,
     calls_to_track={
@@ -77,9 +113,64 @@ app.add_middleware(
         ),
     },
 )
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=config.compression_minimum_size,
+    threadpool_size=config.compression_threadpool_size,
+    encodings=config.compression_encodings,
+)
+if config.shard_nodes:
+    app.state.shard_membership = ShardMembership(
+        nodes=config.shard_nodes,
+        self_node=config.shard_self,
+        virtual_nodes=config.shard_virtual_nodes,
+        pool_size=config.shard_pool_size,
+        timeout=config.shard_timeout,
+        interval=config.shard_health_interval,
+    )
+    # outermost, the requests of other nodes do not use the resources of this one
+    app.add_middleware(ShardingMiddleware, membership=app.state.shard_membership)
 app.add_route("/metrics/", metrics)
 
 
+@app.exception_handler(ScanCancelled)
+async def scan_cancelled_handler(request, exc: ScanCancelled):
+    """Returns 504 when the request deadline stopped a scan"""
+    return ORJSONResponse(status_code=504, content={"message": str(exc)})
+
+
+@app.exception_handler(MemoryBudgetExceeded)
+async def memory_budget_exceeded_handler(request, exc: MemoryBudgetExceeded):
+    """Returns 413 when the request needs more memory than its budget"""
+    return ORJSONResponse(status_code=413, content={
+        "message": f"{exc}, use _elements, smaller pages or _format=arrow"})
+
+
+@app.exception_handler(WriteConflict)
+async def write_conflict_handler(request, exc: WriteConflict):
+    """Returns 409 when concurrent commits kept changing the partition of an upsert"""
+    return ORJSONResponse(status_code=409, content={"message": str(exc)})
+
+
+@app.exception_handler(ChangesExpired)
+async def changes_expired_handler(request, exc: ChangesExpired):
+    """Returns 410 when the changes after a _since were cleaned up from the delta log or vacuumed"""
+    return ORJSONResponse(status_code=410, content={"message": str(exc)})
+
+
+@app.exception_handler(TextIndexNotReady)
+async def text_index_not_ready_handler(request, exc: TextIndexNotReady):
+    """Returns 503 while the text index of a _text or _content search is built for the first time"""
+    return ORJSONResponse(status_code=503, content={"message": f"{exc}, retry later"},
+                          headers={"Retry-After": "5"})
+
+
+@app.exception_handler(TerminologyError)
+async def terminology_error_handler(request, exc: TerminologyError):
+    """Returns 400 when a code:in or code:below search names an unknown ValueSet or code system"""
+    return ORJSONResponse(status_code=400, content={"message": str(exc)})
+
+
 @app.get("/", include_in_schema=False)
 async def read_index():
     return FileResponse(os.path.join(os.path.dirname(__file__), "../static/index.html"))
@@ -120,6 +211,30 @@ async def redoc_html():
 async def startup():
     """Server startup function, run whatever is required to start with server startup"""
     logger.info("Setting up application resources")
+    app.state.config_watchers = []
+    if config.system_config_reload_interval:
+        watched = get_tenants().items() if config.multi_tenant else [(None, config)]
+        for tenant, settings in watched:
+            watcher = SystemConfigWatcher(
+                settings, get_tenant_config_path(tenant) if tenant else get_system_config_path(),
+                config.system_config_reload_interval, open_databases=open_delta_databases,
+                close_databases=partial(close_delta_databases, config=settings))
+            watcher.start()
+            app.state.config_watchers.append(watcher)
+    if get_multiprocess_dir():
+        app.state.metrics_writer = asyncio.create_task(
+            write_snapshots(get_request_metrics(), get_multiprocess_dir(), config.metrics_flush_interval))
+    if config.shard_nodes:
+        app.state.shard_membership.start()
+    if os.path.isdir(config.terminology_dir):
+        # the code systems are loaded and the ValueSets expanded before the first code:in search
+        await run_in_threadpool(get_terminology, config.terminology_dir, config.terminology_cache_size)
+    if config.compaction_enabled:
+        # the watchers swap the system configs, the databases are listed again for every run
+        app.state.compaction = asyncio.create_task(schedule_compaction(
+            lambda: sorted({database_dir for settings in (get_tenants().values() if config.multi_tenant else [config])
+                            for database_dir in get_database_dirs(settings.system_config).values()}),
+            config))
     logger.info("Application startup complete")
 
 
@@ -127,49 +242,22 @@ async def startup():
 async def shutdown():
     """Server shutdown function, terminates all connections to resources"""
     logger.info("Cleaning up application resources")
+    for watcher in app.state.config_watchers:
+        watcher.stop()
+    if get_multiprocess_dir():
+        app.state.metrics_writer.cancel()
+        get_request_metrics().write(get_multiprocess_dir())
+    if config.compaction_enabled:
+        app.state.compaction.cancel()
+    if config.shard_nodes:
+        await app.state.shard_membership.stop()
 
 
 app.include_router(fhirresource.router, prefix=f"{api_prefix}/fhirresource", tags=["FHIR Resource"])
-app.include_router(observation.router, tags=["FHIR Resource"])
-app.include_router(account.router, tags=["FHIR Resource"])
-app.include_router(allergyintolerance.router, tags=["FHIR Resource"])
-app.include_router(careplan.router, tags=["FHIR Resource"])
-app.include_router(careteam.router, tags=["FHIR Resource"])
-app.include_router(chargeitem.router, tags=["FHIR Resource"])
-app.include_router(claim.router, tags=["FHIR Resource"])
-app.include_router(claimresponse.router, tags=["FHIR Resource"])
-app.include_router(condition.router, tags=["FHIR Resource"])
-app.include_router(coverage.router, tags=["FHIR Resource"])
-app.include_router(diagnosticreport.router, tags=["FHIR Resource"])
-app.include_router(documentreference.router, tags=["FHIR Resource"])
-app.include_router(encounter.router, tags=["FHIR Resource"])
-app.include_router(familymemberhistory.router, tags=["FHIR Resource"])
-app.include_router(immunization.router, tags=["FHIR Resource"])
-app.include_router(medicationadministration.router, tags=["FHIR Resource"])
-app.include_router(medicationrequest.router, tags=["FHIR Resource"])
-app.include_router(medicationstatement.router, tags=["FHIR Resource"])
-app.include_router(procedure.router, tags=["FHIR Resource"])
-app.include_router(clinicalimpression.router, tags=["FHIR Resource"])
-app.include_router(detectedissue.router, tags=["FHIR Resource"])
-app.include_router(media.router, tags=["FHIR Resource"])
-app.include_router(specimen.router, tags=["FHIR Resource"])
-app.include_router(bodystructure.router, tags=["FHIR Resource"])
-app.include_router(imagingstudy.router, tags=["FHIR Resource"])
-app.include_router(QuestionnaireResponse.router, tags=["FHIR Resource"])
-app.include_router(molecularsequence.router, tags=["FHIR Resource"])
-app.include_router(medicationdispense.router, tags=["FHIR Resource"])
-app.include_router(immunizationevaluation.router, tags=["FHIR Resource"])
-app.include_router(immunizationrecommendation.router, tags=["FHIR Resource"])
-app.include_router(goal.router, tags=["FHIR Resource"])
-app.include_router(servicerequest.router, tags=["FHIR Resource"])
-app.include_router(nutritionorder.router, tags=["FHIR Resource"])
-app.include_router(visionprescription.router, tags=["FHIR Resource"])
-app.include_router(riskassessment.router, tags=["FHIR Resource"])
-app.include_router(requestgroup.router, tags=["FHIR Resource"])
-app.include_router(communication.router, tags=["FHIR Resource"])
-app.include_router(communicationrequest.router, tags=["FHIR Resource"])
-app.include_router(devicerequest.router, tags=["FHIR Resource"])
-app.include_router(deviceusestatement.router, tags=["FHIR Resource"])
-app.include_router(guidanceresponse.router, tags=["FHIR Resource"])
-app.include_router(supplydelivery.router, tags=["FHIR Resource"])
+for module in RESOURCE_ROUTES:
+    app.include_router(module.router, tags=["FHIR Resource"])
 app.include_router(bundle.router, tags=["FHIR Resource"])
+app.include_router(history.router, tags=["FHIR History"])
+app.include_router(bulkimport.router, tags=["FHIR Import"])
+app.include_router(admin.router, tags=["Admin"])
+app.include_router(write.router, tags=["FHIR Write"])
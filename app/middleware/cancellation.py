@@ -0,0 +1,145 @@
+import re
+import time
+import asyncio
+from typing import Dict, List
+
+import orjson
+from prometheus_client import Counter
+from starlette.datastructures import Headers
+
+from ..utility.cancellation import CancelToken, set_cancel_token
+
+CANCELLED_REQUESTS = Counter("fhir_cancelled_requests_total", "Requests cancelled before completion", ["reason"])
+
+_PREFER_WAIT = re.compile(r"(?:^|[;,\s])wait\s*=\s*(\d+(?:\.\d+)?)")
+_PREFER_HANDLING = re.compile(r"(?:^|[;,\s])handling\s*=\s*(strict|lenient)")
+
+# methods of the requests that commit, a write cancelled after its commit would be reported as failed
+WRITE_METHODS = frozenset({"POST", "PUT", "PATCH", "DELETE"})
+
+
+class CancellationMiddleware:
+    """Request deadline and client disconnect handling for ASGI HTTP applications
+
+    Every request gets a cancel token, with the deadline of its resource type. The request is cancelled
+    when the client disconnects or when the deadline passes before the response starts: its cancel token
+    stops the arrow scans and interrupts the duckdb queries of the request, and a 504 is returned on
+    deadline.
+
+    The `Prefer` request header adjusts the deadline: `wait=<seconds>` sets it and `handling=lenient`
+    relaxes it to max_deadline, both capped at max_deadline. With `handling=strict` a wait over max_deadline
+    is rejected with 400 instead of capped. Writes and the requests under exempt_paths
+    have no deadline and run to completion.
+
+    Args:
+        app (ASGI v3 callable): An ASGI application
+
+        deadline (float): Default request deadline in seconds
+
+        deadlines (Dict[str, float]): Request deadline per resource type, ex: {"Observation": 60}
+
+        max_deadline (float): Upper bound of the deadlines requested with the Prefer header
+
+        exempt_paths (List[str]): First path segments of the requests without deadline, ex: "admin"
+    """
+
+    def __init__(self, app, deadline: float = 30.0, deadlines: Dict[str, float] = None, max_deadline: float = 300.0,
+                 exempt_paths: List[str] = ("admin", "$import")):
+        self.app = app
+        self.deadline = deadline
+        self.deadlines = {name.lower(): value for name, value in (deadlines or {}).items()}
+        self.max_deadline = max_deadline
+        self.exempt_paths = {path.lower() for path in exempt_paths}
+
+    def is_exempt(self, scope) -> bool:
+        return scope["method"] in WRITE_METHODS or \
+            scope["path"].strip("/").split("/")[0].lower() in self.exempt_paths
+
+    def get_deadline(self, scope) -> float:
+        """
+        :param scope:
+        :return: deadline of the request in seconds, raises ValueError for a strict wait over max_deadline
+        """
+        resource_type = scope["path"].strip("/").split("/")[0].lower()
+        deadline = self.deadlines.get(resource_type, self.deadline)
+        prefer = Headers(scope=scope).get("prefer", "").lower()
+        handling = _PREFER_HANDLING.search(prefer)
+        if handling and handling.group(1) == "lenient":
+            deadline = self.max_deadline
+        wait = _PREFER_WAIT.search(prefer)
+        if wait:
+            deadline = float(wait.group(1))
+            if handling and handling.group(1) == "strict" and deadline > self.max_deadline:
+                raise ValueError(f"Prefer wait={deadline:g} is over the maximum deadline of {self.max_deadline:g} "
+                                 f"seconds")
+        return min(deadline, self.max_deadline)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.is_exempt(scope):
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            deadline = self.get_deadline(scope)
+        except ValueError as e:
+            await self.send_message(send, 400, str(e))
+            return
+        token = CancelToken(deadline=time.monotonic() + deadline)
+        set_cancel_token(token)
+        response_started = asyncio.Event()
+        messages: asyncio.Queue = asyncio.Queue()
+
+        async def wrapped_send(message):
+            if message["type"] == "http.response.start":
+                response_started.set()
+            await send(message)
+
+        app_task = asyncio.ensure_future(self.app(scope, messages.get, wrapped_send))
+
+        async def listen():
+            # relays the request messages to the application and watches for the client disconnect
+            while True:
+                message = await receive()
+                await messages.put(message)
+                if message["type"] == "http.disconnect":
+                    if not app_task.done():
+                        token.cancel("disconnect")
+                        CANCELLED_REQUESTS.labels("disconnect").inc()
+                        app_task.cancel()
+                    return
+
+        listener = asyncio.ensure_future(listen())
+        started = asyncio.ensure_future(response_started.wait())
+        try:
+            await asyncio.wait({app_task, started}, timeout=deadline, return_when=asyncio.FIRST_COMPLETED)
+            if not app_task.done() and not response_started.is_set():
+                token.cancel("deadline")
+                CANCELLED_REQUESTS.labels("deadline").inc()
+                app_task.cancel()
+                await self.send_timeout(send, deadline)
+                return
+            await app_task
+        except asyncio.CancelledError:
+            if not app_task.done():
+                token.cancel("disconnect")
+                app_task.cancel()
+            if token.reason != "disconnect":
+                raise
+        finally:
+            started.cancel()
+            listener.cancel()
+
+    @staticmethod
+    async def send_timeout(send, deadline: float):
+        await CancellationMiddleware.send_message(
+            send, 504, f"Request cancelled after its deadline of {deadline:g} seconds")
+
+    @staticmethod
+    async def send_message(send, status: int, message: str):
+        body = orjson.dumps({"message": message})
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,247 @@
+import time
+import zlib
+from typing import Dict, List, Optional
+
+from prometheus_client import Counter
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional dependency
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+COMPRESSION_BYTES_IN = Counter(
+    "fhir_compression_bytes_in_total", "Response bytes before compression", ["encoding"])
+COMPRESSION_BYTES_OUT = Counter(
+    "fhir_compression_bytes_out_total", "Response bytes after compression", ["encoding"])
+COMPRESSION_BYTES_SAVED = Counter(
+    "fhir_compression_bytes_saved_total", "Response bytes saved by compression", ["encoding"])
+COMPRESSION_CPU_SECONDS = Counter(
+    "fhir_compression_cpu_seconds_total", "CPU time spent compressing responses", ["encoding"])
+
+# compression levels per content type, streamed content types get cheaper levels to keep latency low
+DEFAULT_LEVELS: Dict[str, Dict[str, int]] = {
+    "application/json": {"gzip": 6, "br": 5, "zstd": 6},
+    "application/fhir+json": {"gzip": 6, "br": 5, "zstd": 6},
+    "application/x-ndjson": {"gzip": 4, "br": 3, "zstd": 3},
+    "application/fhir+ndjson": {"gzip": 4, "br": 3, "zstd": 3},
+    "text/event-stream": {"gzip": 1, "br": 1, "zstd": 1},
+    "text/": {"gzip": 6, "br": 5, "zstd": 6},
+    "application/javascript": {"gzip": 6, "br": 5, "zstd": 3},
+}
+
+# levels from which every chunk is compressed in the thread pool, whatever its size
+THREADPOOL_LEVELS: Dict[str, int] = {"gzip": 9, "br": 9, "zstd": 15}
+
+
+class _Compressor:
+    """Incremental compressor of one of the supported encodings"""
+
+    def __init__(self, encoding: str, level: int):
+        self.encoding = encoding
+        if encoding == "gzip":
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        elif encoding == "br":
+            self._compressor = brotli.Compressor(quality=level)
+        else:
+            self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes, flush: bool = False, finish: bool = False) -> bytes:
+        """
+        :param data:
+        :param flush: emit everything compressed so far, so that the client can decode a streamed chunk
+        :param finish: end of the compressed stream
+        :return:
+        """
+        start = time.thread_time()
+        if self.encoding == "gzip":
+            output = self._compressor.compress(data)
+            if finish:
+                output += self._compressor.flush()
+            elif flush:
+                output += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        elif self.encoding == "br":
+            output = self._compressor.process(data)
+            if finish:
+                output += self._compressor.finish()
+            elif flush:
+                output += self._compressor.flush()
+        else:
+            output = self._compressor.compress(data)
+            if finish:
+                output += self._compressor.flush()
+            elif flush:
+                output += self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        COMPRESSION_CPU_SECONDS.labels(self.encoding).inc(time.thread_time() - start)
+        COMPRESSION_BYTES_IN.labels(self.encoding).inc(len(data))
+        COMPRESSION_BYTES_OUT.labels(self.encoding).inc(len(output))
+        return output
+
+
+def get_available_encodings(encodings: List[str]) -> List[str]:
+    """
+    Drops the encodings whose optional library is not installed
+
+    :param encodings: in order of server preference
+    :return:
+    """
+    available = {"gzip": True, "br": brotli is not None, "zstd": zstandard is not None}
+    return [encoding for encoding in encodings if available.get(encoding)]
+
+
+def negotiate_encoding(accept_encoding: str, encodings: List[str]) -> Optional[str]:
+    """
+    Picks the encoding with the highest q-value in the Accept-Encoding header, ties are broken by the
+    server preference order of encodings
+
+    :param accept_encoding: ex: "gzip, deflate, br;q=0.9, zstd"
+    :param encodings:
+    :return:
+    """
+    weights: Dict[str, float] = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.strip().partition(";")
+        name = name.strip().lower()
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name] = weight
+    candidates = [
+        (weights.get(encoding, weights.get("*", 0.0)), -index, encoding) for index, encoding in enumerate(encodings)]
+    candidates = [candidate for candidate in candidates if candidate[0] > 0]
+    return max(candidates)[2] if candidates else None
+
+
+class CompressionMiddleware:
+    """Response compression for ASGI HTTP applications
+
+    The response encoding is negotiated from the `Accept-Encoding` header among gzip, brotli and zstd.
+    Responses smaller than minimum_size or of content types without a configured level are sent as is.
+    Streamed responses are compressed and flushed chunk by chunk. Once a response reached threadpool_size
+    bytes, or at the levels of THREADPOOL_LEVELS, its chunks are compressed in the thread pool so they do
+    not block the event loop.
+
+    Args:
+        app (ASGI v3 callable): An ASGI application
+
+        minimum_size (int): Smallest response body (in bytes) that gets compressed
+
+        threadpool_size (int): Response size (in bytes) from which the body is compressed off the event loop
+
+        encodings (List[str]): Enabled encodings, in order of server preference
+
+        levels (Dict[str, Dict[str, int]]): Compression level per encoding keyed by content type,
+            keys ending with "/" match every subtype
+    """
+
+    def __init__(
+        self,
+        app,
+        minimum_size: int = 1024,
+        threadpool_size: int = 256 * 1024,
+        encodings: List[str] = ("zstd", "br", "gzip"),
+        levels: Dict[str, Dict[str, int]] = None,
+    ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.threadpool_size = threadpool_size
+        self.encodings = get_available_encodings(list(encodings))
+        self.levels = levels or DEFAULT_LEVELS
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate_encoding(Headers(scope=scope).get("accept-encoding", ""), self.encodings)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await _CompressionResponder(self, encoding, send).run(scope, receive)
+
+    def get_level(self, content_type: str, encoding: str) -> Optional[int]:
+        media_type = content_type.split(";")[0].strip().lower()
+        levels = self.levels.get(media_type)
+        if levels is None:
+            levels = next(
+                (value for key, value in self.levels.items() if key.endswith("/") and media_type.startswith(key)),
+                None)
+        return levels.get(encoding) if levels else None
+
+
+class _CompressionResponder:
+    def __init__(self, middleware: CompressionMiddleware, encoding: str, send):
+        self.middleware = middleware
+        self.encoding = encoding
+        self.send = send
+        self.start_message = None
+        self.compressor: Optional[_Compressor] = None
+        self.passthrough = False
+        self.offload = False
+        self.bytes_in = 0
+
+    async def run(self, scope, receive):
+        await self.middleware.app(scope, receive, self.wrapped_send)
+
+    async def _compress(self, data: bytes, flush: bool = False, finish: bool = False) -> bytes:
+        # file responses are streamed in small chunks, the size of the whole body decides
+        self.bytes_in += len(data)
+        self.offload = self.offload or self.bytes_in >= self.middleware.threadpool_size
+        if self.offload:
+            return await run_in_threadpool(self.compressor.compress, data, flush, finish)
+        return self.compressor.compress(data, flush, finish)
+
+    def _get_level(self, headers: MutableHeaders) -> Optional[int]:
+        if "content-encoding" in headers:
+            return None
+        return self.middleware.get_level(headers.get("content-type", ""), self.encoding)
+
+    async def wrapped_send(self, message):
+        if message["type"] == "http.response.start":
+            self.start_message = message
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.start_message is not None:
+            start_message, self.start_message = self.start_message, None
+            headers = MutableHeaders(raw=start_message["headers"])
+            level = self._get_level(headers)
+            if level is None or (not more_body and len(body) < self.middleware.minimum_size):
+                self.passthrough = True
+                await self.send(start_message)
+                await self.send(message)
+                return
+            self.compressor = _Compressor(self.encoding, level)
+            self.offload = level >= THREADPOOL_LEVELS.get(self.encoding, level + 1)
+            headers["Content-Encoding"] = self.encoding
+            headers.add_vary_header("Accept-Encoding")
+            if more_body:
+                del headers["Content-Length"]
+                compressed = await self._compress(body, flush=True)
+                COMPRESSION_BYTES_SAVED.labels(self.encoding).inc(max(len(body) - len(compressed), 0))
+                await self.send(start_message)
+                await self.send({"type": "http.response.body", "body": compressed, "more_body": True})
+                return
+            compressed = await self._compress(body, finish=True)
+            COMPRESSION_BYTES_SAVED.labels(self.encoding).inc(max(len(body) - len(compressed), 0))
+            headers["Content-Length"] = str(len(compressed))
+            await self.send(start_message)
+            await self.send({"type": "http.response.body", "body": compressed})
+            return
+
+        compressed = await self._compress(body, flush=more_body, finish=not more_body)
+        COMPRESSION_BYTES_SAVED.labels(self.encoding).inc(max(len(body) - len(compressed), 0))
+        await self.send({"type": "http.response.body", "body": compressed, "more_body": more_body})
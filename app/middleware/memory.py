@@ -0,0 +1,45 @@
+from typing import Dict
+
+from ..utility.memory import MemoryBudget, set_memory_budget
+
+
+class MemoryBudgetMiddleware:
+    """Per-request memory budget for ASGI HTTP applications
+
+    Every request gets a memory budget, the arrow scans of the request allocate from its memory pool and
+    stop once it is exceeded. The peak arrow memory of the request is added to the `Server-Timing` header,
+    as allocated before the response starts, and exported to prometheus once the response is sent.
+
+    Args:
+        app (ASGI v3 callable): An ASGI application
+
+        limit (int): Memory budget of a request in bytes, 0 disables the budget
+
+        limits (Dict[str, int]): Memory budget of the requests of each tenant, see middleware/tenant.py
+    """
+
+    def __init__(self, app, limit: int, limits: Dict[str, int] = None):
+        self.app = app
+        self.limit = limit
+        self.limits = limits or {}
+
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope.get("tenant"), self.limit)
+        if scope["type"] != "http" or not limit:
+            await self.app(scope, receive, send)
+            return
+
+        budget = MemoryBudget(limit)
+        set_memory_budget(budget)
+
+        async def wrapped_send(message):
+            if message["type"] == "http.response.start":
+                budget.peak = max(budget.peak, budget.used)
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"server-timing", f'memory;desc="peak {budget.peak} bytes"'.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, wrapped_send)
+        finally:
+            budget.release()
@@ -0,0 +1,82 @@
+import time
+from typing import Dict, Callable
+
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from starlette.requests import Request
+from starlette.responses import Response
+
+from ..routes import RESOURCE_TYPES
+from ..utility.metrics import RequestMetrics, get_metrics_registry
+
+UNMATCHED_ROUTE = "<unmatched>"
+
+
+class MetricsMiddleware:
+    """Request metrics middleware for ASGI HTTP applications
+
+    Counts the requests and observes their duration by method, route template and resource type, raw
+    paths are never used as labels. The metrics are kept in memory by the worker, see utility/metrics.py.
+
+    Args:
+        app (ASGI v3 callable): An ASGI application
+
+        metrics (RequestMetrics): Request metrics of the worker
+    """
+
+    def __init__(self, app, metrics: RequestMetrics):
+        self.app = app
+        self.metrics = metrics
+        self._templates: Dict[Callable, str] = {}
+
+    def get_route(self, scope) -> str:
+        route = scope.get("route")
+        if route is not None and hasattr(route, "path"):
+            return route.path
+        endpoint = scope.get("endpoint")
+        if endpoint is None or "app" not in scope:
+            return UNMATCHED_ROUTE
+        if endpoint not in self._templates:
+            for route in scope["app"].routes:
+                if getattr(route, "endpoint", None) is endpoint:
+                    self._templates[endpoint] = route.path
+                    break
+            else:
+                return UNMATCHED_ROUTE
+        return self._templates[endpoint]
+
+    @staticmethod
+    def get_resource_type(route: str, path_params: Dict[str, str] = None) -> str:
+        # the generic routes take the resource type as a path parameter, the resource routes have it as the
+        # capitalized first segment of their template
+        name = (path_params or {}).get("resource_type") or route.strip("/").split("/")[0]
+        # path parameters are client input, only known resource types become label values
+        return name if name in RESOURCE_TYPES else "none"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def wrapped_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        self.metrics.in_progress += 1
+        try:
+            await self.app(scope, receive, wrapped_send)
+        finally:
+            self.metrics.in_progress -= 1
+            route = self.get_route(scope)
+            resource_type = self.get_resource_type(route, scope.get("path_params"))
+            self.metrics.observe(
+                (scope["method"], route, resource_type), str(status), time.perf_counter() - start)
+
+
+async def metrics(request: Request) -> Response:
+    """Returns the prometheus metrics of every worker"""
+    return Response(generate_latest(get_metrics_registry()), headers={"Content-Type": CONTENT_TYPE_LATEST})
@@ -0,0 +1,283 @@
+import asyncio
+from typing import Dict, Iterable, Optional, Set
+from urllib.parse import parse_qs, urlsplit
+
+import aiohttp
+import orjson
+from loguru import logger
+from prometheus_client import Counter
+from starlette.datastructures import Headers
+
+from ..utility.hashring import HashRing
+from ..utility.writer import get_resource_patient
+
+SHARD_REQUESTS = Counter("fhir_shard_requests_total", "Requests by patient sharding decision", ["route"])
+
+# set on proxied requests, the owner serves them whatever its ring says, so they are never forwarded twice
+FORWARDED_HEADER = "x-shard-forwarded"
+HEALTH_PATH = "/shard/health"
+# query parameters of the patient, the search routes take patient and the /fhirresource route yy__patient_id
+PATIENT_PARAMETERS = ("patient", "yy__patient_id")
+# writes are routed by the patient of their body, like the write routes partition them
+WRITE_METHODS = ("POST", "PUT")
+HOP_BY_HOP_HEADERS = {
+    "connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailers",
+    "transfer-encoding", "upgrade", "host"}
+
+
+class ShardMembership:
+    """Nodes of the sharding ring. The other nodes are polled on their health endpoint, the ring only holds the
+    nodes that answer and is rebuilt when one leaves or joins.
+
+    Args:
+        nodes (Iterable[str]): Base urls of all the nodes, ex: http://10.0.0.1:8000
+
+        self_node (str): Base url of this node
+
+        virtual_nodes (int): Ring points per node
+
+        pool_size (int): Keep-alive connections of the proxy to the other nodes
+
+        timeout (float): Seconds to connect to a node, and between two reads of a proxied response
+
+        interval (float): Seconds between two health checks
+    """
+
+    def __init__(self, nodes: Iterable[str], self_node: str, virtual_nodes: int = 128, pool_size: int = 100,
+                 timeout: float = 30.0, interval: float = 5.0):
+        self.self_node = self_node.rstrip("/")
+        self.nodes = sorted({node.rstrip("/") for node in nodes} | {self.self_node})
+        self.ring = HashRing(self.nodes, virtual_nodes)
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.interval = interval
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout),
+                # responses are relayed as they are, compressed or not
+                auto_decompress=False)
+        return self._session
+
+    def get_owner(self, patient_id: str) -> str:
+        return self.ring.get_node(patient_id) or self.self_node
+
+    def mark_down(self, node: str):
+        logger.warning(f'Shard node {node} left the ring')
+        self.ring = self.ring.with_nodes(name for name in self.ring.nodes if name != node)
+
+    async def is_alive(self, node: str) -> bool:
+        try:
+            async with self.get_session().get(f"{node}{HEALTH_PATH}", timeout=aiohttp.ClientTimeout(
+                    total=min(self.timeout, self.interval))) as response:
+                return response.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return False
+
+    async def check(self):
+        others = [node for node in self.nodes if node != self.self_node]
+        alive = await asyncio.gather(*(self.is_alive(node) for node in others))
+        nodes = [self.self_node] + [node for node, ok in zip(others, alive) if ok]
+        if set(nodes) != set(self.ring.nodes):
+            logger.info(f'Shard ring nodes: {sorted(nodes)}')
+        self.ring = self.ring.with_nodes(nodes)
+
+    async def run(self):
+        # the ring starts with all the nodes, they may still be starting, unreachable ones leave it on proxying
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.check()
+
+    def start(self):
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self._session is not None:
+            await self._session.close()
+
+
+def get_query_patient(query_string: str) -> Optional[str]:
+    """
+    :param query_string:
+    :return: id of the patient of the query parameters, see PATIENT_PARAMETERS
+    """
+    query = parse_qs(query_string)
+    for name in PATIENT_PARAMETERS:
+        patient = query.get(name, [""])[0]
+        if patient:
+            return patient.rstrip("/").split("/")[-1]
+    return None
+
+
+def get_body_patients(body: bytes) -> Set[str]:
+    """
+    :param body: body of a write
+    :return: ids of the patients of the resource, or of the entries of a transaction Bundle, empty when the body
+    is not a resource or its resources have no patient reference
+    """
+    try:
+        resource = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        return set()
+    if not isinstance(resource, dict):
+        return set()
+    if resource.get("resourceType") != "Bundle":
+        patient_id = get_resource_patient(resource)
+        return {patient_id} if patient_id else set()
+    if resource.get("type") != "transaction":
+        return set()
+    patients = set()
+    for entry in resource.get("entry") or []:
+        if not isinstance(entry, dict) or not isinstance(entry.get("resource"), dict):
+            continue
+        url = (entry.get("request") or {}).get("url", "")
+        patient_id = get_resource_patient(entry["resource"]) or get_query_patient(urlsplit(url).query)
+        if patient_id:
+            patients.add(patient_id)
+    return patients
+
+
+class ShardingMiddleware:
+    """Patient sharding for ASGI HTTP applications
+
+    Requests with a `patient` or `yy__patient_id` query parameter, and POST and PUT requests whose resource has
+    a patient reference, are served by the node owning the patient on the consistent hash ring. Every patient
+    partition is cached and written on a single node, so a read sent to the owner sees the writes. Requests
+    owned by another node are proxied to it over pooled keep-alive connections, and served locally when it
+    cannot be reached. A transaction whose entries belong to patients of several nodes is rejected with 400.
+    $import writes the patients of every node, it runs on the node it is sent to and the other nodes read
+    its commits once their table version cache expires.
+
+    Args:
+        app (ASGI v3 callable): An ASGI application
+
+        membership (ShardMembership): Ring of the alive nodes
+    """
+
+    def __init__(self, app, membership: ShardMembership):
+        self.app = app
+        self.membership = membership
+
+    def get_owners(self, scope, body: bytes) -> Set[str]:
+        """
+        :param scope:
+        :param body: body of the request, read for the writes only
+        :return: the nodes owning the patients of the request, empty when it is served locally
+        """
+        if Headers(scope=scope).get(FORWARDED_HEADER):
+            return set()
+        patients = get_body_patients(body) if body else set()
+        if not patients:
+            patient_id = get_query_patient(scope.get("query_string", b"").decode("latin-1"))
+            patients = {patient_id} if patient_id else set()
+        return {self.membership.get_owner(patient_id) for patient_id in patients}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if scope["path"] == HEALTH_PATH:
+            await self.send_json(send, 200, {"node": self.membership.self_node, "nodes": self.membership.ring.nodes})
+            return
+
+        body = b""
+        if scope["method"] in WRITE_METHODS:
+            body = await self.read_body(receive)
+            if body is None:
+                return
+        owners = self.get_owners(scope, body)
+        if len(owners) > 1:
+            SHARD_REQUESTS.labels("rejected").inc()
+            await self.send_json(send, 400, {"detail": "The entries of a transaction must belong to patients of "
+                                                       "a single shard node"})
+            return
+        owner = owners.pop() if owners else self.membership.self_node
+        if owner != self.membership.self_node:
+            if scope["method"] not in WRITE_METHODS:
+                body = await self.read_body(receive)
+                if body is None:
+                    return
+            started = False
+
+            async def relay(message):
+                nonlocal started
+                started = True
+                await send(message)
+
+            try:
+                await self.proxy(owner, scope, body, relay)
+                SHARD_REQUESTS.labels("proxied").inc()
+                return
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if started:
+                    raise
+                logger.warning(f'Shard node {owner} unreachable, serving locally: {e}')
+                self.membership.mark_down(owner)
+            SHARD_REQUESTS.labels("fallback").inc()
+        else:
+            SHARD_REQUESTS.labels("local").inc()
+            if scope["method"] not in WRITE_METHODS:
+                await self.app(scope, receive, send)
+                return
+
+        replayed = False
+
+        async def replay():
+            nonlocal replayed
+            if not replayed:
+                replayed = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        await self.app(scope, replay, send)
+
+    @staticmethod
+    async def read_body(receive) -> Optional[bytes]:
+        """
+        :param receive:
+        :return: the whole body of the request, None when the client disconnected
+        """
+        body = b""
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return None
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                return body
+
+    @staticmethod
+    async def send_json(send, status: int, content: Dict):
+        body = orjson.dumps(content)
+        await send({"type": "http.response.start", "status": status, "headers": [
+            (b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
+
+    async def proxy(self, owner: str, scope, body: bytes, send):
+        """
+        Relays the request to its owner and streams the response back, raises aiohttp.ClientConnectionError
+        when the owner is not reached
+        """
+        url = f"{owner}{scope.get('root_path', '')}{scope['path']}"
+        if scope.get("query_string"):
+            url = f"{url}?{scope['query_string'].decode('latin-1')}"
+        headers = [(name.decode("latin-1"), value.decode("latin-1")) for name, value in scope["headers"]
+                   if name.decode("latin-1").lower() not in HOP_BY_HOP_HEADERS]
+        headers.append((FORWARDED_HEADER, self.membership.self_node))
+        if scope.get("client"):
+            headers.append(("x-forwarded-for", scope["client"][0]))
+        async with self.membership.get_session().request(
+                scope["method"], url, headers=headers, data=body or None, allow_redirects=False) as response:
+            await send({
+                "type": "http.response.start", "status": response.status,
+                "headers": [(name, value) for name, value in response.raw_headers
+                            if name.decode("latin-1").lower() not in HOP_BY_HOP_HEADERS]})
+            async for chunk in response.content.iter_any():
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
@@ -0,0 +1,75 @@
+from typing import Iterable, Optional
+
+import orjson
+from starlette.datastructures import Headers
+
+from ..utility.scheduler import FairScheduler
+
+
+class TenantMiddleware:
+    """Tenant routing for ASGI HTTP applications
+
+    The tenant of a request is read from the tenant header, or from a `/tenants/<tenant>` path prefix which
+    is removed from the path. It is stored in the `tenant` key of the scope and the request waits for a
+    slot of the fair scheduler of the tenants. Requests without a tenant, docs and metrics, and event
+    streams are not scheduled.
+
+    Args:
+        app (ASGI v3 callable): An ASGI application
+
+        tenants (Iterable[str]): Names of the tenants
+
+        scheduler (FairScheduler): Concurrency slots shared by the tenants
+
+        header (str): Name of the tenant header
+
+        path_prefix (str): Path prefix followed by the tenant name
+    """
+
+    def __init__(self, app, tenants: Iterable[str], scheduler: FairScheduler, header: str = "x-tenant",
+                 path_prefix: str = "/tenants"):
+        self.app = app
+        self.tenants = set(tenants)
+        self.scheduler = scheduler
+        self.header = header.lower()
+        self.path_prefix = path_prefix.rstrip("/") + "/"
+
+    def get_tenant(self, scope) -> Optional[str]:
+        tenant = Headers(scope=scope).get(self.header)
+        if tenant:
+            return tenant.lower()
+        if scope["path"].startswith(self.path_prefix):
+            tenant, _, path = scope["path"][len(self.path_prefix):].partition("/")
+            prefix = f"{self.path_prefix}{tenant}"
+            scope["path"] = f"/{path}"
+            scope["raw_path"] = scope["path"].encode()
+            scope["root_path"] = scope.get("root_path", "") + prefix
+            return tenant.lower()
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        tenant = self.get_tenant(scope)
+        if tenant is None:
+            await self.app(scope, receive, send)
+            return
+        if tenant not in self.tenants:
+            body = orjson.dumps({"message": f"Tenant {tenant} not found"})
+            await send({
+                "type": "http.response.start",
+                "status": 404,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+
+        scope["tenant"] = tenant
+        if "text/event-stream" in Headers(scope=scope).get("accept", ""):
+            # event streams stay open, they would hold a slot for their whole life
+            await self.app(scope, receive, send)
+            return
+        async with self.scheduler.slot(tenant):
+            await self.app(scope, receive, send)
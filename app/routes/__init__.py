@@ -0,0 +1,25 @@
+"""
+Routes of the server. The resource routes serve the search of one resource type each, the other routes
+only accept the resource types of RESOURCE_TYPES.
+"""
+from . import (
+    observation, account, allergyintolerance, careplan, careteam, chargeitem, claim, claimresponse, condition,
+    coverage, diagnosticreport, documentreference, encounter, familymemberhistory, immunization,
+    medicationadministration, medicationrequest, medicationstatement, procedure, clinicalimpression, detectedissue,
+    media, specimen, bodystructure, imagingstudy, QuestionnaireResponse, molecularsequence, medicationdispense,
+    immunizationevaluation, immunizationrecommendation, goal, servicerequest, nutritionorder, visionprescription,
+    riskassessment, requestgroup, communication, communicationrequest, devicerequest, deviceusestatement,
+    guidanceresponse, supplydelivery
+)
+
+# modules of the resource routes, in registration order
+RESOURCE_ROUTES = [
+    observation, account, allergyintolerance, careplan, careteam, chargeitem, claim, claimresponse, condition,
+    coverage, diagnosticreport, documentreference, encounter, familymemberhistory, immunization,
+    medicationadministration, medicationrequest, medicationstatement, procedure, clinicalimpression, detectedissue,
+    media, specimen, bodystructure, imagingstudy, QuestionnaireResponse, molecularsequence, medicationdispense,
+    immunizationevaluation, immunizationrecommendation, goal, servicerequest, nutritionorder, visionprescription,
+    riskassessment, requestgroup, communication, communicationrequest, devicerequest, deviceusestatement,
+    guidanceresponse, supplydelivery,
+]
+RESOURCE_TYPES = frozenset(module.RESOURCE_TYPE for module in RESOURCE_ROUTES)
@@ -0,0 +1,80 @@
+import asyncio
+import os
+from typing import Dict
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import ORJSONResponse
+from deltalake import DeltaTable
+from starlette.concurrency import run_in_threadpool
+
+from ..core.settings import get_settings
+from ..utility.compaction import (
+    create_compaction_run, get_compaction_runs, get_database_tables, get_table_report, run_compaction)
+
+router = APIRouter()
+
+
+def get_database_dir(system_name: str, config) -> str:
+    if system_name not in config.system_config['systems']:
+        raise HTTPException(status_code=404, detail=f"System {system_name} not found")
+    return os.path.join(
+        config.system_config['paths']['base_path'], config.system_config['systems'][system_name]['db_name'])
+
+
+@router.get(
+    path="/admin/compaction/report", response_model=Dict, operation_id="get_compaction_report",
+    summary="Reports the files per partition and file sizes of the delta tables of a system")
+def get_compaction_report(system_name: str, resource_type: str = None, top: int = Query(20, ge=0),
+                          config=Depends(get_settings)):
+    tables = get_database_tables(get_database_dir(system_name, config), resource_type)
+    return {'data': [get_table_report(table_path, top) for table_path, _ in tables]}
+
+
+@router.get(
+    path="/admin/compaction", response_model=Dict, operation_id="get_compaction",
+    summary="Gets the last compaction run of every database")
+async def get_compaction():
+    return {'data': [run.to_dict() for run in get_compaction_runs().values()]}
+
+
+@router.post(
+    path="/admin/compaction", status_code=202, operation_id="start_compaction",
+    summary="Compacts the partitions with the most small files of a system now, outside the off-peak window")
+async def start_compaction(system_name: str, resource_type: str = None, min_files: int = Query(None, ge=2),
+                           max_partitions: int = Query(None, ge=1), zorder: bool = None, vacuum: bool = False,
+                           config=Depends(get_settings)):
+    run = create_compaction_run(get_database_dir(system_name, config), resource_type)
+    if run is None:
+        raise HTTPException(status_code=409, detail=f"A compaction of {system_name} is running")
+    asyncio.ensure_future(run_in_threadpool(
+        run_compaction, run, min_files or config.compaction_min_files,
+        max_partitions or config.compaction_max_partitions,
+        config.compaction_zorder if zorder is None else zorder, config.compaction_row_group_rows,
+        config.compaction_max_bytes_per_second, "", config.vacuum_retention_hours if vacuum else None))
+    return ORJSONResponse(status_code=202, content=run.to_dict())
+
+
+@router.delete(
+    path="/admin/compaction", status_code=202, operation_id="stop_compaction",
+    summary="Stops the compaction of a system after the partition being compacted")
+async def stop_compaction(system_name: str, config=Depends(get_settings)):
+    run = get_compaction_runs().get(get_database_dir(system_name, config))
+    if run is None:
+        raise HTTPException(status_code=404, detail=f"No compaction of {system_name}")
+    run.stop.set()
+    return ORJSONResponse(status_code=202, content=run.to_dict())
+
+
+@router.post(
+    path="/admin/vacuum", response_model=Dict, operation_id="vacuum",
+    summary="Deletes the files no version within the retention reads, lists them only with dry_run")
+def vacuum(system_name: str, resource_type: str = None, retention_hours: int = Query(None, ge=0),
+           dry_run: bool = True, config=Depends(get_settings)):
+    retention_hours = config.vacuum_retention_hours if retention_hours is None else retention_hours
+    data = {}
+    for table_path, name in get_database_tables(get_database_dir(system_name, config), resource_type):
+        try:
+            data[name] = DeltaTable(table_path).vacuum(retention_hours, dry_run=dry_run)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Vacuum of {name} failed: {e}")
+    return {'data': data, 'dry_run': dry_run}
@@ -0,0 +1,75 @@
+import asyncio
+import os
+from typing import Dict, List
+
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
+
+from ..core.settings import get_settings
+from . import RESOURCE_TYPES
+from ..utility.bulkimport import create_import_job, get_import_job, get_input_paths, run_import
+
+router = APIRouter()
+
+
+class ImportInput(BaseModel):
+    type: str
+    # file name or glob pattern, relative to import_dir
+    url: str
+
+
+class ImportRequest(BaseModel):
+    inputFormat: str = "application/fhir+ndjson"
+    input: List[ImportInput]
+
+
+@router.post(
+    path="/$import", status_code=202, operation_id="import_ndjson",
+    summary="Imports NDJSON files into the delta tables of a system, returns the job to poll")
+async def import_ndjson(request: ImportRequest, system_name: str, config=Depends(get_settings)):
+    if request.inputFormat not in ("application/fhir+ndjson", "application/ndjson", "ndjson"):
+        raise HTTPException(status_code=400, detail=f"Input format {request.inputFormat} not supported")
+    if system_name not in config.system_config['systems']:
+        raise HTTPException(status_code=404, detail=f"System {system_name} not found")
+    inputs = []
+    for item in request.input:
+        if item.type not in RESOURCE_TYPES:
+            raise HTTPException(status_code=400, detail=f"Resource type {item.type} not supported")
+        try:
+            paths = get_input_paths(config.import_dir, item.url)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if not paths:
+            raise HTTPException(status_code=400, detail=f"No files match {item.url}")
+        inputs.append((item.type, paths))
+
+    job = create_import_job(system_name, inputs, config.import_job_retention)
+    database_dir = os.path.join(
+        config.system_config['paths']['base_path'], config.system_config['systems'][system_name]['db_name'])
+    job.task = asyncio.create_task(run_import(
+        job, database_dir, config.import_processes or os.cpu_count(), config.import_chunk_bytes,
+        config.import_batch_bytes, config.import_sample_lines, config.write_commit_retries,
+        config.import_resource_json))
+    return ORJSONResponse(status_code=202, content=job.to_dict(), headers={"content-location": f"$import/{job.id}"})
+
+
+@router.get(
+    path="/$import/{job_id}", response_model=Dict, operation_id="get_import",
+    summary="Gets the progress of an import, 202 while it runs")
+async def get_import(job_id: str):
+    job = get_import_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Import {job_id} not found")
+    return ORJSONResponse(status_code=202 if job.status in ("queued", "running") else 200, content=job.to_dict())
+
+
+@router.delete(
+    path="/$import/{job_id}", status_code=202, operation_id="cancel_import", summary="Cancels an import")
+async def cancel_import(job_id: str):
+    job = get_import_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Import {job_id} not found")
+    if job.task is not None and not job.task.done():
+        job.task.cancel()
+    return ORJSONResponse(status_code=202, content=job.to_dict())
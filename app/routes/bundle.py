@@ -1,11 +1,15 @@
 import aiohttp
-import asyncio
-from typing import Dict, List
-from fastapi import APIRouter, Depends, Request
+import uuid
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlsplit
+import pyarrow as pa
+from fastapi import APIRouter, Depends, HTTPException, Request
 from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
 
 from ..core.settings import get_settings
-from ..common import get_data, get_paginated_data
+from ..common import get_data, get_paginated_data, get_write_table, commit_transaction
+from .write import WRITE_ERRORS, check_resource
 
 
 router = APIRouter()
@@ -18,6 +22,7 @@ class RequestModel(BaseModel):
 
 class Entry(BaseModel):
     request: RequestModel
+    resource: Optional[Dict] = None
 
 
 class Bundle(BaseModel):
@@ -27,8 +32,66 @@ class Bundle(BaseModel):
     entry: List[Entry]
 
 
+async def process_transaction(bundle: Bundle, system_name: Optional[str], config):
+    """
+    Checks and converts every entry before any is committed, then commits them in a single delta commit so
+    the transaction is all or nothing. The entries of a transaction must share a table.
+
+    :param bundle: transaction Bundle of POST and PUT entries
+    :param system_name: system of the entries whose url has no system_name
+    :param config:
+    :return: transaction-response Bundle
+    """
+    writes = []
+    for index, entry in enumerate(bundle.entry):
+        method = entry.request.method.upper()
+        url = urlsplit(entry.request.url)
+        path = url.path.strip("/").split("/")
+        query = parse_qs(url.query)
+        if method not in ("POST", "PUT") or entry.resource is None:
+            raise HTTPException(status_code=400, detail=f"Entry {index}: transactions take POST and PUT resources")
+        resource_type = path[0]
+        resource = dict(entry.resource)
+        patient_id = check_resource(resource_type, resource, query.get("patient", [None])[0])
+        entry_system_name = query.get("system_name", [system_name])[0]
+        if not entry_system_name:
+            raise HTTPException(status_code=400, detail=f"Entry {index}: system_name required")
+        if method == "PUT":
+            if len(path) < 2 or resource.setdefault("id", path[1]) != path[1]:
+                raise HTTPException(status_code=400, detail=f"Entry {index}: PUT url and resource id do not match")
+        else:
+            resource["id"] = resource.get("id") or str(uuid.uuid4())
+        try:
+            table_path, table = await run_in_threadpool(
+                get_write_table, resource_type, entry_system_name, patient_id, config, [resource])
+        except WRITE_ERRORS as e:
+            raise HTTPException(status_code=422, detail=f"Entry {index}: {resource_type} does not fit its table: {e}")
+        writes.append((method, resource_type, resource["id"], table_path, patient_id, table))
+
+    table_paths = {table_path for _, _, _, table_path, _, _ in writes}
+    if len(table_paths) > 1:
+        raise HTTPException(status_code=400, detail="The entries of a transaction must share a resource type and "
+                                                    "system")
+    partitions = {}
+    for method, _, _, _, patient_id, table in writes:
+        tables, upsert = partitions.get(patient_id, ([], False))
+        partitions[patient_id] = (tables + [table], upsert or method == "PUT")
+    if partitions:
+        version = await commit_transaction(table_paths.pop(), {
+            patient_id: (pa.concat_tables(tables), upsert) for patient_id, (tables, upsert) in partitions.items()},
+            config)
+    return {
+        "resourceType": "Bundle", "id": str(uuid.uuid4()), "type": "transaction-response",
+        "entry": [{"response": {
+            "status": "201 Created" if method == "POST" else "200 OK",
+            "location": f"{resource_type}/{resource_id}", "etag": f'W/"{version}"'}}
+            for method, resource_type, resource_id, _, _, _ in writes]}
+
+
 @router.post("/bundle")
-async def get_data(request: Request, bundle: Bundle):
+async def get_data(request: Request, bundle: Bundle, system_name: str = None, config=Depends(get_settings)):
+    if bundle.type == "transaction":
+        return await process_transaction(bundle, system_name, config)
     data_list = []
     async with aiohttp.ClientSession() as session:
         for entry in bundle.entry:
@@ -3,7 +3,7 @@ from fastapi import APIRouter, Depends
 
 
 from ..core.settings import get_settings
-from ..common import get_data, get_paginated_data
+from ..common import SearchParameters, get_search_response
 router = APIRouter()
 
 RESOURCE_TYPE = 'Claim'
@@ -12,8 +12,6 @@ RESOURCE_TYPE = 'Claim'
 @router.get(
     path=f"/{RESOURCE_TYPE}", response_model=Dict, operation_id="get_claim", summary="Gets claim data")
 async def get_claim(system_name: str, patient: str = None, config=Depends(get_settings), page_num: int = 1,
-                    page_size: int = 10):
-    data = get_data(RESOURCE_TYPE, system_name, patient, config)
-
-    return get_paginated_data(data, page_num, page_size)
+                    page_size: int = 10, params: SearchParameters = Depends()):
+    return await get_search_response(RESOURCE_TYPE, system_name, patient, config, page_num, page_size, params)
 
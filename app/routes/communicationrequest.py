@@ -4,7 +4,7 @@ from fastapi import APIRouter, Depends
 
 
 from ..core.settings import get_settings
-from ..common import get_data, get_paginated_data
+from ..common import SearchParameters, get_search_response
 router = APIRouter()
 
 RESOURCE_TYPE = 'CommunicationRequest'
@@ -14,8 +14,6 @@ RESOURCE_TYPE = 'CommunicationRequest'
     path=f"/{RESOURCE_TYPE}", response_model=Dict, operation_id="get_communicationrequest",
     summary="Gets communicationrequest data")
 async def get_communicationrequest(system_name: str, patient: str = None, config=Depends(get_settings), page_num: int = 1,
-                                   page_size: int = 10):
-    data = get_data(RESOURCE_TYPE, system_name, patient, config)
-
-    return get_paginated_data(data, page_num, page_size)
+                                   page_size: int = 10, params: SearchParameters = Depends()):
+    return await get_search_response(RESOURCE_TYPE, system_name, patient, config, page_num, page_size, params)
 
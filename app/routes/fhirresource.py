@@ -3,10 +3,11 @@ import duckdb
 from deltalake import DeltaTable, PyDeltaTableError
 from loguru import logger
 from typing import Dict
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Query
 
 from ..core.settings import get_settings
-from ..common import get_delta_table, Resource, get_resource_data
+from ..common import get_delta_table, Resource, get_resource_data, get_io_options
+from ..utility.formats import get_output_format, get_format_response
 
 router = APIRouter()
 
@@ -14,13 +15,17 @@ router = APIRouter()
 @router.get(
     path="", response_model=Dict, operation_id="get_resource", summary="Gets data for the given fhir resource")
 async def get_resource(
-        resource: Resource, yy__patient_id: str, system_name: str, config=Depends(get_settings)):
+        resource: Resource, yy__patient_id: str, system_name: str, config=Depends(get_settings),
+        format_: str = Query(
+            None, alias="_format",
+            description="application/vnd.apache.arrow.stream or parquet for binary output, json by default")):
     """
 
     @param resource:
     @param yy__patient_id:
     @param system_name:
     @param config:
+    @param format_: _format search parameter
     @return:
     """
 
@@ -31,11 +36,16 @@ async def get_resource(
                 config.system_config['paths']['base_path'],
                 config.system_config['systems'][system_name]['db_name']),
             resource='observation',
-            partition_column_data=[("yy__patient_id", "=", yy__patient_id)])
+            partition_column_data=[("yy__patient_id", "=", yy__patient_id)],
+            **get_io_options(config))
 
         if not files:
             return {'message': "No files found"}
 
+        output_format = get_output_format(format_)
+        if output_format:
+            return get_format_response(files, output_format)
+
         duckdb_con = duckdb.connect()
         data = duckdb_con.execute(
             f'select * from read_parquet({files})').fetch_arrow_table().to_pylist()
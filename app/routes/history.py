@@ -0,0 +1,85 @@
+import asyncio
+import time
+from typing import Dict
+
+import orjson
+from fastapi import APIRouter, Depends, Query, Request
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+from ..core.settings import get_settings
+from ..common import get_changes, get_paginated_data, get_resource_version
+from ..utility.changes import SINCE_PATTERN, CHANGE_TYPE, COMMIT_VERSION, ChangesExpired
+
+router = APIRouter()
+
+
+@router.get(
+    path="/{resource_type}/_history", response_model=Dict, operation_id="get_history",
+    summary="Gets the changes of a resource type committed after _since")
+async def get_history(resource_type: str, patient: str, system_name: str, config=Depends(get_settings),
+                      page_num: int = 1, page_size: int = 10,
+                      since: str = Query(None, alias="_since", regex=SINCE_PATTERN,
+                                         description="delta table version or instant, the whole history by default")):
+    data = await run_in_threadpool(get_changes, resource_type, system_name, patient, config, since)
+    response = get_paginated_data(data, page_num, page_size)
+    response["version"] = data.get("version")
+    return response
+
+
+async def iter_change_events(request: Request, resource_type: str, system_name: str, patient: str, config,
+                             since: str = None):
+    """
+    Yields the changes committed after since as server-sent events, then polls the table for new commits
+    until the client disconnects. The id of the last event of a commit is its version, a reconnecting client
+    sends it back in the Last-Event-ID header.
+
+    :param request:
+    :param resource_type:
+    :param system_name:
+    :param patient:
+    :param config:
+    :param since:
+    :return:
+    """
+    keepalive_at = time.monotonic() + config.change_feed_keepalive
+    while not await request.is_disconnected():
+        try:
+            data = await run_in_threadpool(get_changes, resource_type, system_name, patient, config, since)
+        except ChangesExpired as e:
+            data = {"message": str(e)}
+        if "version" not in data:
+            yield f"event: error\ndata: {orjson.dumps({'message': data.get('message')}).decode()}\n\n"
+            return
+        rows = data["data"].to_pylist()
+        for index, row in enumerate(rows):
+            event = f"event: {row[CHANGE_TYPE]}\ndata: {orjson.dumps(row, default=str).decode()}\n"
+            if index == len(rows) - 1 or rows[index + 1][COMMIT_VERSION] != row[COMMIT_VERSION]:
+                event = f"id: {row[COMMIT_VERSION]}\n{event}"
+            yield f"{event}\n"
+        since = str(data["version"])
+        if rows:
+            keepalive_at = time.monotonic() + config.change_feed_keepalive
+        elif time.monotonic() >= keepalive_at:
+            yield ": keepalive\n\n"
+            keepalive_at = time.monotonic() + config.change_feed_keepalive
+        await asyncio.sleep(config.change_feed_poll_interval)
+
+
+@router.get(
+    path="/{resource_type}/_history/stream", operation_id="stream_history",
+    summary="Streams the changes of a resource type as server-sent events, as the commits land")
+async def stream_history(request: Request, resource_type: str, patient: str, system_name: str,
+                         config=Depends(get_settings),
+                         since: str = Query(None, alias="_since", regex=SINCE_PATTERN,
+                                            description="delta table version or instant, new commits by default")):
+    last_event_id = request.headers.get("last-event-id", "")
+    if last_event_id.isdigit():
+        since = last_event_id
+    if since is None:
+        # only the commits after the current version
+        version = await run_in_threadpool(get_resource_version, resource_type, system_name, config)
+        since = str(version) if version >= 0 else None
+    return StreamingResponse(
+        iter_change_events(request, resource_type, system_name, patient, config, since),
+        media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
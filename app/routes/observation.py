@@ -1,9 +1,12 @@
 from typing import Dict
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException, Query
 
 
 from ..core.settings import get_settings
-from ..common import get_data, get_paginated_data
+from ..common import SearchParameters, get_search_response, get_data, execute_query
+from ..utility.lastn import get_lastn_query
+from ..utility.series import get_series
+from ..utility.tokens import get_coding_mask
 router = APIRouter()
 
 RESOURCE_TYPE = 'Observation'
@@ -13,6 +16,39 @@ RESOURCE_TYPE = 'Observation'
 @router.get(
     path=f"/{RESOURCE_TYPE}", response_model=Dict, operation_id="get_observation", summary="Gets observation data")
 async def get_observation(patient: str, system_name: str, config=Depends(get_settings), page_num: int = 1,
-                          page_size: int = 10):
+                          page_size: int = 10, params: SearchParameters = Depends()):
+    return await get_search_response(RESOURCE_TYPE, system_name, patient, config, page_num, page_size, params)
+
+
+@router.get(
+    path=f"/{RESOURCE_TYPE}/$lastn", response_model=Dict, operation_id="lastn_observation",
+    summary="Gets the most recent observations of every code")
+def lastn_observation(patient: str, system_name: str, config=Depends(get_settings),
+                      max_per_code: int = Query(1, alias="max", ge=1),
+                      code: str = Query(None, description="comma separated tokens, ex: http://loinc.org|4548-4")):
     data = get_data(RESOURCE_TYPE, system_name, patient, config)
-    return get_paginated_data(data, page_num, page_size)
+    table = data['data']
+    if not len(table):
+        return {'data': [], 'count': 0}
+    if code:
+        table = table.filter(get_coding_mask(table, 'code', code.split(',')))
+    query, query_params = get_lastn_query(table.schema, max_per_code)
+    rows = execute_query(query, query_params, tables={'observation': table})
+    return {'data': rows, 'count': len(rows)}
+
+
+@router.get(
+    path=f"/{RESOURCE_TYPE}/$series", response_model=Dict, operation_id="series_observation",
+    summary="Gets the downsampled values of a numeric observation code")
+def series_observation(patient: str, system_name: str, code: str, config=Depends(get_settings),
+                       start: str = None, end: str = None, points: int = Query(500, ge=3, le=100000),
+                       method: str = Query("lttb", regex="^(lttb|minmax)$")):
+    data = get_data(RESOURCE_TYPE, system_name, patient, config, elements="code,effectiveDateTime,valueQuantity")
+    table = data['data']
+    if not len(table):
+        return {'t': [], 'v': [], 'unit': None, 'total': 0, 'count': 0}
+    table = table.filter(get_coding_mask(table, 'code', code.split(',')))
+    try:
+        return get_series(table, points, method, start, end)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
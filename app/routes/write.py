@@ -0,0 +1,71 @@
+import uuid
+from typing import Dict
+
+import pyarrow as pa
+from fastapi import APIRouter, Body, Depends, HTTPException
+from fastapi.responses import ORJSONResponse
+from starlette.concurrency import run_in_threadpool
+
+from ..core.settings import get_settings
+from ..common import get_resource_patient, get_write_table, commit_write_table
+from ..utility.writer import UnknownElements
+from . import RESOURCE_TYPES
+
+router = APIRouter()
+
+# resources that do not fit the schema of their table
+WRITE_ERRORS = (UnknownElements, pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError)
+
+
+def check_resource(resource_type: str, resource: Dict, patient: str = None) -> str:
+    """
+    :param resource_type: resource type of the url
+    :param resource:
+    :param patient: patient query parameter, when the resource has no patient reference
+    :return: id of the patient partition of the resource
+    """
+    if resource_type not in RESOURCE_TYPES:
+        raise HTTPException(status_code=404, detail=f"Resource type {resource_type} not supported")
+    if resource.get("resourceType", resource_type) != resource_type:
+        raise HTTPException(
+            status_code=400, detail=f"resourceType {resource.get('resourceType')} does not match {resource_type}")
+    resource["resourceType"] = resource_type
+    patient_id = get_resource_patient(resource) or (patient.split("/")[-1] if patient else None)
+    if not patient_id:
+        raise HTTPException(status_code=400, detail="Patient required, use a subject or patient reference")
+    return patient_id
+
+
+async def write_resource(resource_type: str, resource: Dict, patient_id: str, system_name: str, config,
+                         upsert: bool) -> int:
+    try:
+        table_path, table = await run_in_threadpool(
+            get_write_table, resource_type, system_name, patient_id, config, [resource])
+    except WRITE_ERRORS as e:
+        raise HTTPException(status_code=422, detail=f"{resource_type} does not fit its table: {e}")
+    return await commit_write_table(table_path, patient_id, table, config, upsert)
+
+
+@router.post(
+    path="/{resource_type}", status_code=201, operation_id="create_resource",
+    summary="Creates a resource, acknowledged once its group commit lands")
+async def create_resource(resource_type: str, system_name: str, resource: Dict = Body(...), patient: str = None,
+                          config=Depends(get_settings)):
+    patient_id = check_resource(resource_type, resource, patient)
+    resource["id"] = resource.get("id") or str(uuid.uuid4())
+    version = await write_resource(resource_type, resource, patient_id, system_name, config, upsert=False)
+    return ORJSONResponse(status_code=201, content=resource, headers={
+        "location": f"{resource_type}/{resource['id']}", "etag": f'W/"{version}"'})
+
+
+@router.put(
+    path="/{resource_type}/{id}", operation_id="update_resource",
+    summary="Creates or replaces a resource, acknowledged once its group commit lands")
+async def update_resource(resource_type: str, id: str, system_name: str, resource: Dict = Body(...),
+                          patient: str = None, config=Depends(get_settings)):
+    patient_id = check_resource(resource_type, resource, patient)
+    if resource.setdefault("id", id) != id:
+        raise HTTPException(status_code=400, detail=f"Resource id {resource['id']} does not match {id}")
+    version = await write_resource(resource_type, resource, patient_id, system_name, config, upsert=True)
+    return ORJSONResponse(content=resource, headers={
+        "location": f"{resource_type}/{id}", "etag": f'W/"{version}"'})
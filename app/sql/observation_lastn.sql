@@ -0,0 +1,7 @@
+select *
+from observation
+qualify row_number() over (
+    partition by {{ group_by | sqlsafe }}
+    order by {{ order_by | sqlsafe }} desc nulls last
+) <= {{ max }}
+order by {{ group_by | sqlsafe }}, {{ order_by | sqlsafe }} desc nulls last
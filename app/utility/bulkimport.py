@@ -0,0 +1,366 @@
+"""
+$import of NDJSON files into the patient partitioned delta tables. Files are split in byte ranges parsed
+by a process pool, the parsed rows are buffered up to a memory bound, grouped by patient and committed while
+the pool parses the next ranges. Partitions without any of the ids of a batch are appended, the others are
+upserted so resources replace the ones with the same id, and an import that failed or was cancelled can be
+run again. The small files of the appended partitions are merged by utility.compaction.
+"""
+import asyncio
+import glob
+import os
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from multiprocessing import get_context
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+import orjson
+import pyarrow as pa
+import pyarrow.compute as pc
+from deltalake import DeltaTable, PyDeltaTableError
+from loguru import logger
+from prometheus_client import Counter
+from starlette.concurrency import run_in_threadpool
+
+from .rawjson import RESOURCE_JSON, has_resource_json
+from .writer import PARTITION_COLUMN, commit_partitions, get_resource_patient, get_unknown_elements, keep_last
+
+IMPORT_RESOURCES = Counter("fhir_import_resources_total", "Resources written by $import", ["resource_type"])
+IMPORT_ERRORS = Counter("fhir_import_errors_total", "NDJSON lines rejected by $import", ["resource_type"])
+
+# error messages kept per job, the others are only counted
+MAX_ERROR_MESSAGES = 20
+
+
+class ImportJob:
+    """Progress of a $import, polled by the status endpoint"""
+
+    def __init__(self, system_name: str, inputs: List[Tuple[str, List[str]]]):
+        self.id = str(uuid.uuid4())
+        self.system_name = system_name
+        self.inputs = inputs
+        self.status = "queued"
+        self.bytes_total = sum(os.path.getsize(path) for _, paths in inputs for path in paths)
+        self.bytes_read = 0
+        self.resources: Dict[str, int] = {}
+        self.versions: Dict[str, int] = {}
+        self.errors = 0
+        self.error_messages: List[str] = []
+        self.message: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def add_errors(self, resource_type: str, messages: List[str], count: int):
+        self.errors += count
+        IMPORT_ERRORS.labels(resource_type).inc(count)
+        self.error_messages.extend(messages[:MAX_ERROR_MESSAGES - len(self.error_messages)])
+
+    def to_dict(self) -> Dict:
+        elapsed = ((self.finished_at or time.time()) - self.started_at) if self.started_at else 0.0
+        written = sum(self.resources.values())
+        return {
+            "id": self.id, "status": self.status, "system_name": self.system_name,
+            "input": [{"type": resource_type, "files": paths} for resource_type, paths in self.inputs],
+            "progress": self.bytes_read / self.bytes_total if self.bytes_total else 1.0,
+            "bytes_read": self.bytes_read, "bytes_total": self.bytes_total,
+            "resources": self.resources, "resources_per_second": written / elapsed if elapsed else 0.0,
+            "versions": self.versions, "errors": self.errors, "error_messages": self.error_messages,
+            "message": self.message, "elapsed_seconds": elapsed}
+
+
+_import_jobs: Dict[str, ImportJob] = {}
+
+
+def get_import_job(job_id: str) -> Optional[ImportJob]:
+    return _import_jobs.get(job_id)
+
+
+def create_import_job(system_name: str, inputs: List[Tuple[str, List[str]]], retention: float) -> ImportJob:
+    """
+    :param system_name:
+    :param inputs: resource type and files of every input
+    :param retention: seconds the jobs finished before are kept, the older ones are evicted
+    :return:
+    """
+    now = time.time()
+    for job_id, job in list(_import_jobs.items()):
+        if job.finished_at is not None and now - job.finished_at > retention:
+            del _import_jobs[job_id]
+    job = ImportJob(system_name, inputs)
+    _import_jobs[job.id] = job
+    return job
+
+
+def get_input_paths(import_dir: str, pattern: str) -> List[str]:
+    """
+    :param import_dir: directory the NDJSON files are imported from
+    :param pattern: file name or glob pattern relative to import_dir
+    :return: the files, raises ValueError for patterns outside import_dir
+    """
+    root = os.path.realpath(import_dir)
+    paths = sorted(os.path.realpath(path) for path in glob.glob(os.path.join(root, pattern)))
+    if any(os.path.commonpath([root, path]) != root for path in paths):
+        raise ValueError(f"{pattern} is outside the import directory")
+    return [path for path in paths if os.path.isfile(path)]
+
+
+def iter_chunks(paths: List[str], chunk_bytes: int) -> Iterator[Tuple[str, int, int]]:
+    """
+    :param paths:
+    :param chunk_bytes:
+    :return: byte ranges of the files, path, start and end
+    """
+    for path in paths:
+        size = os.path.getsize(path)
+        for start in range(0, size, chunk_bytes):
+            yield path, start, min(start + chunk_bytes, size)
+
+
+def read_lines(path: str, start: int, end: int) -> Iterator[bytes]:
+    """
+    Lines starting in the byte range, the line across start belongs to the previous range
+
+    :param path:
+    :param start:
+    :param end:
+    :return:
+    """
+    with open(path, "rb") as file:
+        if start:
+            file.seek(start - 1)
+            file.readline()
+        while file.tell() < end:
+            line = file.readline()
+            if not line:
+                break
+            if line.strip():
+                yield line
+
+
+def to_rows(resource_type: str, lines: Iterator[bytes], path: str,
+            resource_json: bool = False) -> Tuple[List[Dict], List[str], int]:
+    """
+    :param resource_type:
+    :param lines:
+    :param path:
+    :param resource_json: keep every line in the resource_json column of its resource
+    :return: resources of the lines with their partition column, error messages and number of rejected lines
+    """
+    rows, messages, errors = [], [], 0
+    for line in lines:
+        try:
+            resource = orjson.loads(line)
+        except orjson.JSONDecodeError as e:
+            errors += 1
+            messages.append(f"{os.path.basename(path)}: {e}")
+            continue
+        if not isinstance(resource, dict) or resource.get("resourceType") != resource_type:
+            errors += 1
+            messages.append(f"{os.path.basename(path)}: not a {resource_type}")
+            continue
+        patient_id = get_resource_patient(resource)
+        if not patient_id:
+            errors += 1
+            messages.append(f"{os.path.basename(path)}: {resource_type} {resource.get('id')} without a patient")
+            continue
+        resource[PARTITION_COLUMN] = patient_id
+        if resource_json:
+            resource[RESOURCE_JSON] = line.strip()
+        rows.append(resource)
+    return rows, messages[:MAX_ERROR_MESSAGES], errors
+
+
+def parse_chunk(resource_type: str, path: str, start: int, end: int,
+                schema: pa.Schema) -> Tuple[Optional[pa.Table], List[str], int]:
+    """
+    Runs in the process pool, parses a byte range of an NDJSON file
+
+    :param resource_type:
+    :param path:
+    :param start:
+    :param end:
+    :param schema: schema of the table, resources with elements outside it are rejected rather than truncated
+    :return: the rows, error messages and number of rejected lines
+    """
+    rows, messages, errors = to_rows(
+        resource_type, read_lines(path, start, end), path, resource_json=has_resource_json(schema))
+    fitting = []
+    for row in rows:
+        unknown = get_unknown_elements(row, schema)
+        if not unknown:
+            fitting.append(row)
+            continue
+        # new tables take the schema of the first lines, elements first seen after them have no column
+        errors += 1
+        if len(messages) < MAX_ERROR_MESSAGES:
+            messages.append(f"{os.path.basename(path)}: {resource_type} {row.get('id')}: elements not in the "
+                            f"table schema: {', '.join(unknown)}")
+    rows = fitting
+    if not rows:
+        return None, messages, errors
+    try:
+        return pa.Table.from_pylist(rows, schema=schema), messages, errors
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # only the rows that do not fit are rejected
+        tables = []
+        for row in rows:
+            try:
+                tables.append(pa.Table.from_pylist([row], schema=schema))
+            except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+                errors += 1
+                if len(messages) < MAX_ERROR_MESSAGES:
+                    messages.append(f"{os.path.basename(path)}: {resource_type} {row.get('id')}: {e}")
+        return (pa.concat_tables(tables) if tables else None), messages, errors
+
+
+def get_import_schema(table_path: str, resource_type: str, paths: List[str], sample_lines: int,
+                      resource_json: bool = False) -> pa.Schema:
+    """
+    :param table_path:
+    :param resource_type:
+    :param paths:
+    :param sample_lines:
+    :param resource_json: add a resource_json column to a new table
+    :return: schema of the existing table, else the schema inferred from the first lines of the files
+    """
+    try:
+        return DeltaTable(table_path).schema().to_pyarrow()
+    except PyDeltaTableError:
+        pass
+    rows = []
+    for path in paths:
+        rows.extend(to_rows(resource_type, islice(read_lines(path, 0, os.path.getsize(path)), sample_lines),
+                            path)[0])
+        if len(rows) >= sample_lines:
+            break
+    if not rows:
+        raise ValueError(f"No {resource_type} resources with a patient in the first lines")
+    schema = pa.Table.from_pylist(rows).schema
+    return schema.append(pa.field(RESOURCE_JSON, pa.string())) if resource_json else schema
+
+
+def get_existing_partitions(table_path: str, table: pa.Table) -> Set[str]:
+    """
+    :param table_path:
+    :param table: rows of a batch
+    :return: the patients of the batch whose partition has some of the ids of the batch
+    """
+    try:
+        dataset = DeltaTable(table_path).to_pyarrow_dataset(
+            partitions=[(PARTITION_COLUMN, "in", pc.unique(table.column(PARTITION_COLUMN)).to_pylist())])
+    except PyDeltaTableError:
+        return set()
+    existing = dataset.to_table(columns=["id", PARTITION_COLUMN], filter=pc.field("id").isin(table.column("id")))
+    return set(pc.unique(existing.column(PARTITION_COLUMN)).to_pylist())
+
+
+def write_batch(table_path: str, tables: List[pa.Table], retries: int) -> int:
+    """
+    Commits the rows grouped by patient, so every partition gets a single file. The partitions without any of
+    the ids of the batch are appended in one commit that never conflicts, only the partitions with some of
+    them are upserted and retried on conflict.
+
+    :param table_path:
+    :param tables:
+    :param retries: see writer.commit_partitions
+    :return: version of the last commit
+    """
+    table = pa.concat_tables(tables)
+    table = table.take(pc.sort_indices(table, sort_keys=[(PARTITION_COLUMN, "ascending")]))
+    patients = table.column(PARTITION_COLUMN).to_numpy(zero_copy_only=False)
+    starts = np.flatnonzero(np.r_[True, patients[1:] != patients[:-1]])
+    ends = np.r_[starts[1:], len(patients)]
+    existing = get_existing_partitions(table_path, table)
+    partitions = {str(patients[start]): keep_last(table.slice(start, end - start)) for start, end in zip(starts, ends)}
+    version = None
+    appended = {patient_id: (rows, False) for patient_id, rows in partitions.items() if patient_id not in existing}
+    if appended:
+        version = commit_partitions(table_path, appended, retries)
+    upserted = {patient_id: (rows, True) for patient_id, rows in partitions.items() if patient_id in existing}
+    if upserted:
+        version = commit_partitions(table_path, upserted, retries)
+    return version
+
+
+async def import_resources(job: ImportJob, pool: ProcessPoolExecutor, resource_type: str, paths: List[str],
+                           table_path: str, processes: int, chunk_bytes: int, batch_bytes: int,
+                           sample_lines: int, retries: int, resource_json: bool = False):
+    """
+    Imports the files of a resource type. At most two chunks per process are parsed ahead and one batch
+    is committed while the next one is buffered.
+    """
+    loop = asyncio.get_running_loop()
+    schema = await run_in_threadpool(
+        get_import_schema, table_path, resource_type, paths, sample_lines, resource_json)
+    chunks = iter_chunks(paths, chunk_bytes)
+    running: Dict[asyncio.Future, int] = {}
+    buffered: List[pa.Table] = []
+    buffered_bytes = 0
+    writing: Optional[asyncio.Future] = None
+    while True:
+        for path, start, end in islice(chunks, 2 * processes - len(running)):
+            running[loop.run_in_executor(pool, parse_chunk, resource_type, path, start, end, schema)] = end - start
+        if not running and not buffered:
+            break
+        if running:
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                job.bytes_read += running.pop(future)
+                table, messages, errors = future.result()
+                job.add_errors(resource_type, messages, errors)
+                if table is not None:
+                    buffered.append(table)
+                    buffered_bytes += table.nbytes
+                    job.resources[resource_type] = job.resources.get(resource_type, 0) + table.num_rows
+                    IMPORT_RESOURCES.labels(resource_type).inc(table.num_rows)
+        if buffered_bytes >= batch_bytes or (buffered and not running):
+            if writing is not None:
+                job.versions[resource_type] = await writing
+            writing = asyncio.ensure_future(run_in_threadpool(write_batch, table_path, buffered, retries))
+            buffered, buffered_bytes = [], 0
+    if writing is not None:
+        job.versions[resource_type] = await writing
+
+
+async def run_import(job: ImportJob, database_dir: str, processes: int, chunk_bytes: int, batch_bytes: int,
+                     sample_lines: int, retries: int, resource_json: bool = False):
+    """
+    Imports the inputs of the job, one resource type after the other
+
+    :param job:
+    :param database_dir: directory of the delta tables of the system
+    :param processes: size of the process pool
+    :param chunk_bytes: size of the byte ranges parsed by the processes
+    :param batch_bytes: arrow bytes buffered before a commit
+    :param sample_lines: lines the schema of a new table is inferred from
+    :param retries: commit retries when a write changed a partition of a batch
+    :param resource_json: see get_import_schema
+    :return:
+    """
+    job.status = "running"
+    job.started_at = time.time()
+    pool = ProcessPoolExecutor(processes, mp_context=get_context("spawn"))
+    try:
+        for resource_type, paths in job.inputs:
+            await import_resources(
+                job, pool, resource_type, paths, os.path.join(database_dir, resource_type.lower()), processes,
+                chunk_bytes, batch_bytes, sample_lines, retries, resource_json)
+    except asyncio.CancelledError:
+        job.status = "cancelled"
+        job.message = "Cancelled, the batches committed before stay in the tables, running the import again " \
+                      "replaces them"
+        raise
+    except Exception as e:
+        logger.exception(f'Import {job.id} failed')
+        job.status = "failed"
+        job.message = str(e)
+    else:
+        job.status = "completed"
+    finally:
+        # without waiting, the event loop must not block on the processes of a cancelled job
+        pool.shutdown(wait=False, cancel_futures=True)
+        job.finished_at = time.time()
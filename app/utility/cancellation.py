@@ -0,0 +1,106 @@
+"""
+Cancellation of in-flight scans, when the client disconnects or the request deadline passes
+"""
+import time
+import threading
+from contextvars import ContextVar
+from typing import Callable, Iterable, Iterator, List, Optional
+
+import pyarrow as pa
+from loguru import logger
+from prometheus_client import Counter
+
+CANCELLED_SCANS = Counter("fhir_cancelled_scans_total", "Scans stopped before completion", ["reason"])
+CANCELLED_SCAN_ROWS = Counter("fhir_cancelled_scan_rows_total", "Rows read by scans that were then cancelled")
+
+
+class ScanCancelled(Exception):
+    """Raised inside a scan once its cancel token is cancelled"""
+
+    def __init__(self, reason: str):
+        super().__init__(f"Scan cancelled: {reason}")
+        self.reason = reason
+
+
+class CancelToken:
+    """
+    Cancellation state of a request or of a shared scan. Scans poll it between record batches,
+    duckdb connections register their interrupt as a callback.
+    """
+
+    def __init__(self, deadline: float = None):
+        """
+        :param deadline: time.monotonic() value after which the token is cancelled
+        """
+        self.deadline = deadline
+        self.reason: Optional[str] = None
+        self._callbacks: List[Callable] = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        if self.reason is None and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cancel("deadline")
+        return self.reason is not None
+
+    def cancel(self, reason: str = "cancelled"):
+        """
+        :param reason: disconnect, deadline or abandoned
+        :return:
+        """
+        with self._lock:
+            if self.reason is not None:
+                return
+            self.reason = reason
+            callbacks = list(self._callbacks)
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning(f'Cancel callback failed: {e}')
+
+    def add_callback(self, callback: Callable):
+        with self._lock:
+            if self.reason is None:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback: Callable):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+    def check(self):
+        if self.cancelled:
+            CANCELLED_SCANS.labels(self.reason).inc()
+            raise ScanCancelled(self.reason)
+
+
+_cancel_token: ContextVar[Optional[CancelToken]] = ContextVar("cancel_token", default=None)
+
+
+def get_cancel_token() -> Optional[CancelToken]:
+    return _cancel_token.get()
+
+
+def set_cancel_token(token: Optional[CancelToken]):
+    _cancel_token.set(token)
+
+
+def check_batches(batches: Iterable[pa.RecordBatch]) -> Iterator[pa.RecordBatch]:
+    """
+    Yields the batches of a scan until the cancel token of the context is cancelled. Dropping the scan
+    iterator stops the reads of the scanner.
+
+    :param batches:
+    :return:
+    """
+    token = get_cancel_token()
+    rows = 0
+    for batch in batches:
+        if token is not None and token.cancelled:
+            CANCELLED_SCAN_ROWS.inc(rows)
+            token.check()
+        rows += batch.num_rows
+        yield batch
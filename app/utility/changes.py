@@ -0,0 +1,205 @@
+"""
+Change feed of a delta table, read from the commits of the transaction log after a version
+"""
+import os
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import orjson
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from .parquetio import get_local_path
+
+CHANGE_TYPE = "_change_type"
+COMMIT_VERSION = "_commit_version"
+COMMIT_TIMESTAMP = "_commit_timestamp"
+
+# _since values, a delta table version or a FHIR instant
+SINCE_PATTERN = r"^(\d+|\d{4}-\d{2}-\d{2}(T\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:\d{2})?)?)$"
+
+
+class ChangesExpired(Exception):
+    """Raised when the commits or data files after a _since were removed by a log cleanup or a vacuum"""
+
+
+def get_commit_path(table_path: str, version: int) -> str:
+    return os.path.join(table_path, "_delta_log", f"{version:020d}.json")
+
+
+def read_commit(table_path: str, version: int) -> List[Dict]:
+    """
+    :param table_path: local path of the delta table
+    :param version:
+    :return: actions of the commit
+    """
+    with open(get_commit_path(table_path, version), "rb") as file:
+        return [orjson.loads(line) for line in file if line.strip()]
+
+
+def get_commit_timestamp(actions: List[Dict], table_path: str, version: int) -> int:
+    """
+    :return: epoch milliseconds of the commit, from its commitInfo or the modification time of the log file
+    """
+    for action in actions:
+        if "commitInfo" in action and "timestamp" in action["commitInfo"]:
+            return action["commitInfo"]["timestamp"]
+    return int(os.path.getmtime(get_commit_path(table_path, version)) * 1000)
+
+
+def parse_since(since: str) -> Tuple[Optional[int], Optional[int]]:
+    """
+    :param since: delta table version, or FHIR instant, ex: 2023-01-01T00:00:00Z
+    :return: version or epoch milliseconds
+    """
+    if since.isdigit():
+        return int(since), None
+    instant = datetime.fromisoformat(since.replace("Z", "+00:00"))
+    if instant.tzinfo is None:
+        instant = instant.replace(tzinfo=timezone.utc)
+    return None, int(instant.timestamp() * 1000)
+
+
+def get_version_at(table_path: str, timestamp: int, latest_version: int) -> int:
+    """
+    Walks the log back from the latest commit, only the commits after the timestamp are read
+
+    :param table_path:
+    :param timestamp: epoch milliseconds
+    :param latest_version:
+    :return: the last version committed at or before the timestamp, -1 when every commit is after it, raises
+    ChangesExpired when the walk reaches a cleaned up commit, the commits after the timestamp may not be kept
+    """
+    version = latest_version
+    while version >= 0:
+        try:
+            actions = read_commit(table_path, version)
+        except FileNotFoundError:
+            # commits before the last checkpoint may be cleaned up, this one and the ones before it may be after
+            # the timestamp
+            raise ChangesExpired(f"Commit {version} is no longer kept, read the current resources instead")
+        if get_commit_timestamp(actions, table_path, version) <= timestamp:
+            return version
+        version -= 1
+    return -1
+
+
+def get_since_version(table_uri: str, since: Optional[str], latest_version: int) -> int:
+    """
+    :param table_uri:
+    :param since: _since value, None for the whole history
+    :param latest_version:
+    :return: the version the changes are read after
+    """
+    if since is None:
+        return -1
+    version, timestamp = parse_since(since)
+    if version is not None:
+        return min(version, latest_version)
+    return get_version_at(get_local_path(table_uri), timestamp, latest_version)
+
+
+def iter_commit_files(table_path: str, start_version: int, end_version: int,
+                      partition_values: Dict[str, str] = None) -> Iterator[Tuple[int, int, str, List[str]]]:
+    """
+    Lists the data files of the commits after start_version, up to end_version included. Commits with
+    change data feed files yield their cdc files, the other commits yield the files they added.
+
+    :param table_path:
+    :param start_version: exclusive
+    :param end_version: inclusive
+    :param partition_values: only files of this partition, ex: {"yy__patient_id": "p1"}
+    :return: version, timestamp, "cdc" or "add", and the file paths of every commit with data changes, raises
+    ChangesExpired when a commit or its files are no longer kept
+    """
+    for version in range(start_version + 1, end_version + 1):
+        try:
+            actions = read_commit(table_path, version)
+        except FileNotFoundError:
+            raise ChangesExpired(f"Commit {version} is no longer kept, read the current resources instead")
+        timestamp = get_commit_timestamp(actions, table_path, version)
+        files = {"cdc": [], "add": []}
+        for action in actions:
+            for kind in ("cdc", "add"):
+                file_action = action.get(kind)
+                if file_action is None or (kind == "add" and not file_action.get("dataChange", True)):
+                    continue
+                values = file_action.get("partitionValues") or {}
+                if partition_values and any(values.get(name) != value for name, value in partition_values.items()):
+                    continue
+                files[kind].append(os.path.join(table_path, file_action["path"]))
+        kind = "cdc" if files["cdc"] else "add"
+        if not all(os.path.exists(path) for path in files[kind]):
+            raise ChangesExpired(f"The files of commit {version} were vacuumed, read the current resources instead")
+        if files[kind]:
+            yield version, timestamp, kind, files[kind]
+
+
+def with_commit(table: pa.Table, version: int, timestamp: int) -> pa.Table:
+    table = table.append_column(COMMIT_VERSION, pa.array([version] * table.num_rows, pa.int64()))
+    return table.append_column(
+        COMMIT_TIMESTAMP, pa.array([timestamp] * table.num_rows, pa.timestamp("ms", tz="UTC")))
+
+
+def get_snapshot_changes(table_uri: str, table: pa.Table, version: int) -> pa.Table:
+    """
+    The history of a table whose earlier commits are no longer kept starts from its current rows
+
+    :param table_uri:
+    :param table: rows of the table at version, without the partition columns
+    :param version:
+    :return: the rows as inserts of version, in the columns of read_changes
+    """
+    table_path = get_local_path(table_uri)
+    table = table.append_column(CHANGE_TYPE, pa.array(["insert"] * table.num_rows, pa.string()))
+    return with_commit(table, version, get_commit_timestamp(read_commit(table_path, version), table_path, version))
+
+
+def read_changes(table_uri: str, schema: pa.Schema, start_version: int, end_version: int,
+                 partition_values: Dict[str, str] = None) -> pa.Table:
+    """
+    Reads the rows changed by the commits after start_version. Rows of cdc files keep their change type,
+    rows of added files are inserts: without the change data feed the rows removed by a commit are not known.
+
+    :param table_uri:
+    :param schema: arrow schema of the table
+    :param start_version: exclusive
+    :param end_version: inclusive
+    :param partition_values:
+    :return: the changed rows with their _change_type, _commit_version and _commit_timestamp, in commit order
+    """
+    table_path = get_local_path(table_uri)
+    file_schema = pa.schema([field for field in schema if field.name not in (partition_values or {})])
+    tables = []
+    for version, timestamp, kind, paths in iter_commit_files(table_path, start_version, end_version,
+                                                             partition_values):
+        read_schema = file_schema.append(pa.field(CHANGE_TYPE, pa.string())) if kind == "cdc" else file_schema
+        table = ds.dataset(paths, schema=read_schema, format="parquet").to_table()
+        if kind == "add":
+            table = table.append_column(CHANGE_TYPE, pa.array(["insert"] * table.num_rows, pa.string()))
+        tables.append(with_commit(table, version, timestamp))
+    if not tables:
+        return pa.table({
+            **{field.name: pa.array([], field.type) for field in file_schema},
+            CHANGE_TYPE: pa.array([], pa.string()), COMMIT_VERSION: pa.array([], pa.int64()),
+            COMMIT_TIMESTAMP: pa.array([], pa.timestamp("ms", tz="UTC"))})
+    return pa.concat_tables(tables)
+
+
+def get_current_rows(changes: pa.Table, key: str = "id") -> pa.Table:
+    """
+    Keeps the last change of every resource, resources whose last change is a delete are dropped
+
+    :param changes: rows of read_changes
+    :param key: resource id column
+    :return: the changed resources, without the change columns
+    """
+    changes = changes.filter(pc.not_equal(changes.column(CHANGE_TYPE), "update_preimage"))
+    if key in changes.schema.names and changes.num_rows:
+        ids = changes.column(key).to_numpy(zero_copy_only=False)[::-1]
+        _, first = np.unique(ids.astype(str), return_index=True)
+        changes = changes.take(pa.array(np.sort(changes.num_rows - 1 - first)))
+    changes = changes.filter(pc.not_equal(changes.column(CHANGE_TYPE), "delete"))
+    return changes.drop([CHANGE_TYPE, COMMIT_VERSION, COMMIT_TIMESTAMP])
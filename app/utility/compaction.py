@@ -0,0 +1,406 @@
+"""
+Compaction of the patient partitions. Incremental loads leave many small files per partition, every file
+costs an open and a footer read per scan. The partitions with the most files are rewritten as one file,
+clustered on a z-order of their date and code, in OPTIMIZE commits whose actions have dataChange false so
+the change feed does not see them. Missing resource_json values are filled on the way.
+"""
+import asyncio
+import fcntl
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from deltalake import DeltaTable
+from deltalake.writer import DeltaJSONEncoder, get_file_stats_from_metadata
+from loguru import logger
+from prometheus_client import Counter
+from starlette.concurrency import run_in_threadpool
+
+from .parquetio import get_local_path
+from .rawjson import has_resource_json, fill_resource_json
+from .topk import DATE_ELEMENTS, DEFAULT_DATE_ELEMENT, SORT_ELEMENTS, get_key_column
+from .writer import PARTITION_COLUMN, get_commit_partitions, get_partition_files, write_commit
+
+COMPACTION_FILES = Counter("fhir_compaction_files_total", "Files removed and added by compaction", ["action"])
+COMPACTION_BYTES = Counter("fhir_compaction_bytes_total", "Bytes read and written by compaction", ["direction"])
+COMPACTION_CONFLICTS = Counter("fhir_compaction_conflicts_total", "Compaction commits lost to another commit")
+
+# upper bounds of the file size histogram buckets
+FILE_SIZE_BUCKETS = (64 * 1024, 1024 * 1024, 8 * 1024 * 1024, 64 * 1024 * 1024, 256 * 1024 * 1024)
+# upper bounds of the files per partition histogram buckets
+PARTITION_FILES_BUCKETS = (1, 4, 16, 64, 256)
+
+
+def get_bucket(value: int, buckets: Tuple[int, ...]) -> str:
+    for bound in buckets:
+        if value <= bound:
+            return f"<={bound}"
+    return f">{buckets[-1]}"
+
+
+def get_table_report(table_path: str, top: int = 20) -> Dict:
+    """
+    :param table_path:
+    :param top: number of partitions with the most files to list
+    :return: file size and files per partition histograms of the table, and its partitions with the most files
+    """
+    delta_table = DeltaTable(table_path)
+    partitions = get_partition_files(delta_table)
+    file_sizes, partition_files = {}, {}
+    for files in partitions.values():
+        bucket = get_bucket(len(files), PARTITION_FILES_BUCKETS)
+        partition_files[bucket] = partition_files.get(bucket, 0) + 1
+        for _, size in files:
+            bucket = get_bucket(size, FILE_SIZE_BUCKETS)
+            file_sizes[bucket] = file_sizes.get(bucket, 0) + 1
+    worst = sorted(partitions.items(), key=lambda item: len(item[1]), reverse=True)[:top]
+    return {
+        "table": os.path.basename(table_path.rstrip("/")), "version": delta_table.version(),
+        "partitions": len(partitions), "files": sum(len(files) for files in partitions.values()),
+        "bytes": sum(size for files in partitions.values() for _, size in files),
+        "file_sizes": file_sizes, "files_per_partition": partition_files,
+        "worst_partitions": [{"patient_id": patient_id, "files": len(files), "bytes": sum(size for _, size in files)}
+                             for patient_id, files in worst]}
+
+
+def plan_compaction(partitions: Dict[str, List[Tuple[str, int]]], min_files: int, max_partitions: int) -> List[str]:
+    """
+    :param partitions: files of every partition, see writer.get_partition_files
+    :param min_files: partitions with fewer files are left alone
+    :param max_partitions:
+    :return: the partitions to compact, most files first
+    """
+    candidates = [patient_id for patient_id, files in partitions.items() if len(files) >= min_files]
+    return sorted(candidates, key=lambda patient_id: len(partitions[patient_id]), reverse=True)[:max_partitions]
+
+
+def _spread_bits(values: np.ndarray) -> np.ndarray:
+    """Moves the 32 low bits of every value to the even bits of a 64 bit value"""
+    values = values.astype(np.uint64) & np.uint64(0xFFFFFFFF)
+    for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333), (1, 0x5555555555555555)):
+        values = (values | (values << np.uint64(shift))) & np.uint64(mask)
+    return values
+
+
+def zorder_indices(table: pa.Table, resource_type: str) -> np.ndarray:
+    """
+    :param table:
+    :param resource_type:
+    :return: row order of the table along the z-order curve of its date and code ranks
+    """
+    ranks = []
+    for path in (DATE_ELEMENTS.get(resource_type.lower(), DEFAULT_DATE_ELEMENT), SORT_ELEMENTS["code"]):
+        column = get_key_column(table, path)
+        if pa.types.is_null(column.type):
+            ranks.append(np.zeros(table.num_rows, dtype=np.uint64))
+        else:
+            ranks.append(pc.rank(column, sort_keys="ascending", null_placement="at_end",
+                                 tiebreaker="dense").to_numpy())
+    return np.argsort(_spread_bits(ranks[0]) << np.uint64(1) | _spread_bits(ranks[1]), kind="stable")
+
+
+class Throttle:
+    """Sleeps to keep the bytes moved under bytes_per_second, 0 disables it"""
+
+    def __init__(self, bytes_per_second: int):
+        self.bytes_per_second = bytes_per_second
+        self.started_at = time.monotonic()
+        self.moved = 0
+
+    def wait(self, nbytes: int):
+        if not self.bytes_per_second:
+            return
+        self.moved += nbytes
+        delay = self.started_at + self.moved / self.bytes_per_second - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+class TableFiles:
+    """
+    Files of the partitions of a table, listed once per compaction run. The commits made since by other
+    writers are read one by one and only the partitions they changed are listed again.
+
+    Args:
+        table_path (str): delta table
+    """
+
+    def __init__(self, table_path: str):
+        self.table_path = table_path
+        self.local_path = get_local_path(table_path)
+        self.delta_table = DeltaTable(table_path)
+        self.version = self.delta_table.version()
+        self.partitions = get_partition_files(self.delta_table)
+        self.changed: Set[str] = set()
+
+    def get(self, patient_id: str) -> List[Tuple[str, int]]:
+        """
+        :param patient_id:
+        :return: path and size of the files of the partition at self.version
+        """
+        if patient_id in self.changed:
+            self.partitions[patient_id] = get_partition_files(self.delta_table, [patient_id]).get(patient_id, [])
+            self.changed.discard(patient_id)
+        return self.partitions.get(patient_id, [])
+
+    def update(self, own_version: Optional[int] = None):
+        """
+        Moves to the latest version of the table
+
+        :param own_version: version of the compaction just committed, its partition files are already known
+        """
+        previous = self.version
+        self.delta_table.update_incremental()
+        self.version = self.delta_table.version()
+        for version in range(previous + 1, self.version + 1):
+            if version != own_version:
+                self.changed |= get_commit_partitions(self.local_path, version)
+
+
+def compact_partition(table_files: TableFiles, resource_type: str, patient_id: str, zorder: bool = True,
+                      row_group_rows: int = 16384, retries: int = 3) -> Tuple[int, int, int]:
+    """
+    Rewrites the files of a patient partition as a single file. The partition is read at the version of
+    table_files and the commit is only made at the next version, when another commit took it the compaction
+    is retried on the new version.
+
+    :param table_files: files of the table, moved to the version of the compaction commit
+    :param resource_type:
+    :param patient_id:
+    :param zorder: cluster the rows on their date and code
+    :param row_group_rows: rows per row group, the statistics of small clustered row groups let scans skip them
+    :param retries:
+    :return: files removed, bytes read and bytes written
+    """
+    local_path = table_files.local_path
+    for attempt in range(retries + 1):
+        version = table_files.version
+        files = table_files.get(patient_id)
+        if len(files) < 2 and not zorder:
+            return 0, 0, 0
+        table = table_files.delta_table.to_pyarrow_dataset(
+            partitions=[(PARTITION_COLUMN, "=", patient_id)]).to_table().drop([PARTITION_COLUMN])
+        if has_resource_json(table.schema):
+            # rows written without their json, by writers that do not know the column
+            table = fill_resource_json(table)
+        if zorder:
+            table = table.take(pa.array(zorder_indices(table, resource_type)))
+        name = f"{PARTITION_COLUMN}={patient_id}/{version + 1}-{uuid.uuid4()}-compacted.parquet"
+        pq.write_table(table, os.path.join(local_path, name), row_group_size=row_group_rows)
+        size = os.path.getsize(os.path.join(local_path, name))
+        now = int(time.time() * 1000)
+        actions = [{"commitInfo": {
+            "timestamp": now, "operation": "OPTIMIZE",
+            "operationParameters": {"zOrderBy": json.dumps(["date", "code"] if zorder else [])},
+            "readVersion": version}}]
+        actions += [{"remove": {
+            "path": path, "deletionTimestamp": now, "dataChange": False, "extendedFileMetadata": True,
+            "partitionValues": {PARTITION_COLUMN: patient_id}, "size": file_size}} for path, file_size in files]
+        actions.append({"add": {
+            "path": name, "size": size, "partitionValues": {PARTITION_COLUMN: patient_id}, "modificationTime": now,
+            "dataChange": False,
+            "stats": json.dumps(get_file_stats_from_metadata(pq.read_metadata(os.path.join(local_path, name))),
+                                cls=DeltaJSONEncoder)}})
+        if write_commit(local_path, version + 1, actions):
+            table_files.partitions[patient_id] = [(name, size)]
+            table_files.update(own_version=version + 1)
+            read = sum(file_size for _, file_size in files)
+            COMPACTION_FILES.labels("removed").inc(len(files))
+            COMPACTION_FILES.labels("added").inc()
+            COMPACTION_BYTES.labels("read").inc(read)
+            COMPACTION_BYTES.labels("written").inc(size)
+            return len(files), read, size
+        os.remove(os.path.join(local_path, name))
+        COMPACTION_CONFLICTS.inc()
+        table_files.update()
+        logger.info(f'Commit {version + 1} of {table_files.table_path} was taken, retrying the compaction of '
+                    f'{patient_id} ({attempt + 1})')
+    logger.warning(f'Compaction of {patient_id} of {table_files.table_path} abandoned after {retries + 1} conflicts')
+    return 0, 0, 0
+
+
+def in_window(window: str, now: Optional[datetime] = None) -> bool:
+    """
+    :param window: local time range, ex: 01:00-05:00, may wrap around midnight, empty for always
+    :param now:
+    :return:
+    """
+    if not window:
+        return True
+    start, end = (datetime.strptime(bound.strip(), "%H:%M").time() for bound in window.split("-"))
+    now = (now or datetime.now()).time()
+    return start <= now < end if start <= end else now >= start or now < end
+
+
+class CompactionRun:
+    """Progress of a compaction run, read by the admin endpoints"""
+
+    def __init__(self, database_dir: str, tables: List[Tuple[str, str]]):
+        self.database_dir = database_dir
+        self.tables = tables
+        self.status = "running"
+        self.partitions = 0
+        self.files_removed = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.vacuumed = 0
+        self.message: Optional[str] = None
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.stop = threading.Event()
+
+    def to_dict(self) -> Dict:
+        return {
+            "status": self.status, "database": self.database_dir, "tables": [table_path for table_path, _ in self.tables],
+            "partitions": self.partitions, "files_removed": self.files_removed, "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written, "vacuumed": self.vacuumed, "message": self.message,
+            "started_at": self.started_at, "finished_at": self.finished_at}
+
+
+def run_compaction(run: CompactionRun, min_files: int, max_partitions: int, zorder: bool, row_group_rows: int,
+                   bytes_per_second: int, window: str = "", vacuum_retention_hours: Optional[int] = None):
+    """
+    Compacts the worst partitions of the tables of the run, then vacuums them. Stops between two partitions
+    when the run is stopped or the off-peak window closes.
+
+    :param run:
+    :param min_files: see plan_compaction
+    :param max_partitions: per table
+    :param zorder:
+    :param row_group_rows:
+    :param bytes_per_second: I/O throttle of the reads and writes
+    :param window: off-peak window, see in_window
+    :param vacuum_retention_hours: None skips the vacuum
+    :return:
+    """
+    throttle = Throttle(bytes_per_second)
+    try:
+        with compaction_lock(run.database_dir) as locked:
+            if not locked:
+                run.status = "skipped"
+                run.message = "Another process is compacting the database"
+                return
+            compact_tables(run, throttle, min_files, max_partitions, zorder, row_group_rows, window,
+                           vacuum_retention_hours)
+    except Exception as e:
+        logger.exception('Compaction failed')
+        run.status = "failed"
+        run.message = str(e)
+    finally:
+        run.finished_at = time.time()
+
+
+def compact_tables(run: CompactionRun, throttle: Throttle, min_files: int, max_partitions: int, zorder: bool,
+                   row_group_rows: int, window: str, vacuum_retention_hours: Optional[int]):
+    for table_path, resource_type in run.tables:
+        table_files = TableFiles(table_path)
+        for patient_id in plan_compaction(table_files.partitions, min_files, max_partitions):
+            if run.stop.is_set() or not in_window(window):
+                run.status = "stopped"
+                return
+            files, read, written = compact_partition(
+                table_files, resource_type, patient_id, zorder, row_group_rows)
+            run.partitions += 1 if files else 0
+            run.files_removed += files
+            run.bytes_read += read
+            run.bytes_written += written
+            throttle.wait(read + written)
+        if vacuum_retention_hours is not None:
+            run.vacuumed += len(DeltaTable(table_path).vacuum(vacuum_retention_hours, dry_run=False))
+    run.status = "completed"
+
+
+@contextmanager
+def compaction_lock(database_dir: str):
+    """
+    Lock of a database shared by the workers of a host, only one of them compacts it
+
+    :param database_dir:
+    :return: True when the lock is held
+    """
+    with open(os.path.join(database_dir, ".compaction.lock"), "a") as file:
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def get_database_tables(database_dir: str, resource_type: str = None) -> List[Tuple[str, str]]:
+    """
+    :param database_dir:
+    :param resource_type: None for every table
+    :return: path and resource type of the delta tables of the database
+    """
+    if not os.path.isdir(database_dir):
+        return []
+    return sorted(
+        (entry.path, entry.name) for entry in os.scandir(database_dir)
+        if entry.is_dir() and os.path.isdir(os.path.join(entry.path, "_delta_log"))
+        and (resource_type is None or entry.name == resource_type.lower()))
+
+
+_compaction_runs: Dict[str, CompactionRun] = {}
+
+
+def get_compaction_runs() -> Dict[str, CompactionRun]:
+    """
+    :return: the last compaction run of every database, by database directory
+    """
+    return _compaction_runs
+
+
+def create_compaction_run(database_dir: str, resource_type: str = None) -> Optional[CompactionRun]:
+    """
+    :param database_dir:
+    :param resource_type: None for every table
+    :return: a new run of the database, None when one is running
+    """
+    run = _compaction_runs.get(database_dir)
+    if run is not None and run.finished_at is None:
+        return None
+    run = CompactionRun(database_dir, get_database_tables(database_dir, resource_type))
+    _compaction_runs[database_dir] = run
+    return run
+
+
+async def schedule_compaction(get_database_dirs: Callable[[], Iterable[str]], config):
+    """
+    Compacts and vacuums every database once each time the off-peak window opens
+
+    :param get_database_dirs: current database directories, they change with the system config reloads
+    :param config: compaction settings
+    :return:
+    """
+    ran = False
+    while True:
+        await asyncio.sleep(config.compaction_check_interval)
+        if not in_window(config.compaction_window):
+            ran = False
+            continue
+        if ran:
+            continue
+        ran = True
+        for database_dir in get_database_dirs():
+            run = create_compaction_run(database_dir)
+            if run is None:
+                continue
+            await run_in_threadpool(
+                run_compaction, run, config.compaction_min_files, config.compaction_max_partitions,
+                config.compaction_zorder, config.compaction_row_group_rows, config.compaction_max_bytes_per_second,
+                config.compaction_window, config.vacuum_retention_hours)
+            logger.info(f'Compaction of {database_dir}: {run.to_dict()}')
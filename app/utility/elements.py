@@ -0,0 +1,135 @@
+"""
+_elements and _summary projections of the resource columns
+"""
+import functools
+from typing import Dict, List, Optional
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from .rawjson import RESOURCE_JSON
+
+# elements returned by every projection
+MANDATORY_ELEMENTS = ["resourceType", "id", "meta", "implicitRules"]
+
+# isSummary elements of the FHIR R4 resources, "[x]" matches every type of a choice element.
+# Resources not listed here fall back to every element except the narrative
+SUMMARY_ELEMENTS: Dict[str, List[str]] = {
+    "observation": [
+        "identifier", "basedOn", "partOf", "status", "category", "code", "subject", "focus", "encounter",
+        "effective[x]", "issued", "performer", "value[x]", "hasMember", "derivedFrom", "component"],
+    "condition": [
+        "identifier", "clinicalStatus", "verificationStatus", "category", "severity", "code", "bodySite",
+        "subject", "encounter", "onset[x]", "abatement[x]", "recordedDate"],
+    "encounter": [
+        "identifier", "status", "class", "type", "serviceType", "priority", "subject", "episodeOfCare",
+        "basedOn", "participant", "appointment", "period", "length", "reasonCode", "reasonReference",
+        "diagnosis", "account", "serviceProvider", "partOf"],
+    "allergyintolerance": [
+        "identifier", "clinicalStatus", "verificationStatus", "type", "category", "criticality", "code",
+        "patient", "encounter", "onset[x]", "recordedDate", "asserter"],
+    "medicationrequest": [
+        "identifier", "status", "intent", "priority", "doNotPerform", "reported[x]", "medication[x]",
+        "subject", "encounter", "authoredOn", "requester", "performer"],
+    "diagnosticreport": [
+        "identifier", "basedOn", "status", "category", "code", "subject", "encounter", "effective[x]",
+        "issued", "performer", "resultsInterpreter", "result"],
+    "documentreference": [
+        "masterIdentifier", "identifier", "status", "docStatus", "type", "category", "subject", "date",
+        "author", "authenticator", "custodian", "relatesTo", "description", "securityLabel", "content",
+        "context"],
+    "procedure": [
+        "identifier", "basedOn", "partOf", "status", "category", "code", "subject", "encounter",
+        "performed[x]", "recorder", "asserter", "performer", "location", "reasonCode", "reasonReference",
+        "bodySite"],
+    "immunization": [
+        "identifier", "status", "vaccineCode", "patient", "occurrence[x]", "primarySource"],
+}
+
+
+def get_element_paths(resource_type: str, schema: pa.Schema, elements: str = None,
+                      summary: str = None) -> Optional[List[str]]:
+    """
+    Returns the element paths requested with _elements or _summary
+
+    :param resource_type:
+    :param schema:
+    :param elements: comma separated element names, nested elements use dotted paths, ex: id,code,subject.reference
+    :param summary: true, text, data or false
+    :return: None when every element is returned
+    """
+    names = [name for name in schema.names if name != RESOURCE_JSON]
+    if elements:
+        paths = [element.strip() for element in elements.split(",") if element.strip()]
+    elif summary == "text":
+        paths = ["text"]
+    elif summary == "data":
+        return [name for name in names if name != "text"]
+    elif summary == "true":
+        summary_elements = SUMMARY_ELEMENTS.get(resource_type.lower())
+        if summary_elements is None:
+            return [name for name in names if name != "text"]
+        paths = []
+        for element in summary_elements:
+            if element.endswith("[x]"):
+                paths.extend(name for name in names if name.startswith(element[:-3]))
+            else:
+                paths.append(element)
+    else:
+        return None
+    return MANDATORY_ELEMENTS + paths
+
+
+def get_projection(schema: pa.Schema, paths: List[str]) -> Dict[str, pc.Expression]:
+    """
+    Builds the dataset scan projection of the element paths. Children of struct columns are projected
+    as field references, so the parquet reader only decodes the requested leaves, and are put back
+    together into a struct with only those children. Paths through list columns select the whole list.
+
+    :param schema:
+    :param paths: dotted element paths, unknown elements are ignored
+    :return: output column name to projection expression
+    """
+    # nested dicts of the requested children, None selects the whole field
+    tree: Dict = {}
+    for path in paths:
+        node = tree
+        *parents, leaf = path.split(".")
+        for name in parents:
+            if name in node and node[name] is None:
+                break
+            node = node.setdefault(name, {})
+        else:
+            node[leaf] = None
+    return {
+        name: _get_field_expression((name,), schema.field(name).type, subtree)
+        for name, subtree in tree.items() if name in schema.names
+    }
+
+
+def _get_field_expression(field_path: tuple, field_type: pa.DataType, subtree: Optional[Dict]) -> pc.Expression:
+    if subtree is None or not pa.types.is_struct(field_type):
+        return ds.field(*field_path)
+    children = {field_type[index].name: field_type[index].type for index in range(field_type.num_fields)}
+    names = [name for name in subtree if name in children]
+    if not names:
+        return ds.field(*field_path)
+    expressions = [_get_field_expression(field_path + (name,), children[name], subtree[name]) for name in names]
+    # the parquet reader only decodes the selected leaves, a parent without any of them is missing rather
+    # than a struct of nulls
+    valid = functools.reduce(pc.or_, [pc.is_valid(expression) for expression in expressions])
+    return pc.if_else(valid, pc.make_struct(*expressions, field_names=names), pa.scalar(None))
+
+
+def project_table(table: pa.Table, columns: Optional[Dict[str, pc.Expression]]) -> pa.Table:
+    """
+    Applies a projection of get_projection to an in-memory table
+
+    :param table:
+    :param columns:
+    :return:
+    """
+    if not columns:
+        return table
+    return ds.dataset(table).to_table(columns=columns)
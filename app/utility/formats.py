@@ -0,0 +1,83 @@
+"""
+Binary output formats of the search results for analytics clients
+"""
+import io
+from typing import Iterable, Iterator, Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from fastapi.responses import Response, StreamingResponse
+
+ARROW_STREAM_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+PARQUET_MEDIA_TYPE = "application/vnd.apache.parquet"
+
+# _format values accepted for each binary format
+OUTPUT_FORMATS = {
+    ARROW_STREAM_MEDIA_TYPE: ARROW_STREAM_MEDIA_TYPE,
+    "arrow": ARROW_STREAM_MEDIA_TYPE,
+    PARQUET_MEDIA_TYPE: PARQUET_MEDIA_TYPE,
+    "application/parquet": PARQUET_MEDIA_TYPE,
+    "parquet": PARQUET_MEDIA_TYPE,
+}
+
+
+def get_output_format(format_str: Optional[str]) -> Optional[str]:
+    """
+    :param format_str: value of the _format parameter
+    :return: media type of the binary format, None for json
+    """
+    if not format_str:
+        return None
+    return OUTPUT_FORMATS.get(format_str.strip().lower())
+
+
+def iter_arrow_stream(table: pa.Table, batch_size: int = 64 * 1024) -> Iterator[bytes]:
+    """
+    Yields the arrow IPC stream of the table one record batch at a time, the record batches are written
+    as they are, without converting them to rows
+
+    :param table:
+    :param batch_size: max rows per record batch
+    :return:
+    """
+    return iter_arrow_batches(table.schema, table.to_batches(max_chunksize=batch_size))
+
+
+def iter_arrow_batches(schema: pa.Schema, batches: Iterable[pa.RecordBatch]) -> Iterator[bytes]:
+    """
+    Yields the arrow IPC stream of record batches as they are produced, only one batch is held at a time
+
+    :param schema:
+    :param batches:
+    :return:
+    """
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+            yield sink.getvalue()
+            sink.seek(0)
+            sink.truncate()
+    yield sink.getvalue()
+
+
+def get_format_response(table: pa.Table, media_type: str) -> Response:
+    """
+    :param table:
+    :param media_type: one of the OUTPUT_FORMATS media types
+    :return:
+    """
+    if media_type == ARROW_STREAM_MEDIA_TYPE:
+        return StreamingResponse(iter_arrow_stream(table), media_type=media_type)
+    sink = pa.BufferOutputStream()
+    pq.write_table(table, sink, compression="zstd")
+    return Response(content=sink.getvalue().to_pybytes(), media_type=media_type)
+
+
+def get_batches_response(schema: pa.Schema, batches: Iterable[pa.RecordBatch]) -> Response:
+    """
+    :param schema:
+    :param batches: record batches of a scan, read while the response is sent
+    :return: arrow IPC stream response
+    """
+    return StreamingResponse(iter_arrow_batches(schema, batches), media_type=ARROW_STREAM_MEDIA_TYPE)
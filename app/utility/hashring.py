@@ -0,0 +1,44 @@
+"""
+Consistent hash ring of the server nodes. Every node owns many points of the ring, a key belongs to the
+node of the first point after its hash, so a node joining or leaving only moves the keys of its points.
+"""
+import bisect
+import hashlib
+from typing import Iterable, List, Optional, Tuple
+
+
+def get_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Immutable ring, membership changes build a new ring that replaces the old one in a single assignment
+
+    Args:
+        nodes (Iterable[str]): Node names, ex: base urls
+
+        virtual_nodes (int): Points of every node
+    """
+
+    def __init__(self, nodes: Iterable[str], virtual_nodes: int = 128):
+        self.nodes = tuple(sorted(set(nodes)))
+        self.virtual_nodes = virtual_nodes
+        points: List[Tuple[int, str]] = sorted(
+            (get_hash(f"{node}#{index}"), node) for node in self.nodes for index in range(virtual_nodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def get_node(self, key: str) -> Optional[str]:
+        """
+        :param key:
+        :return: the node owning the key, None for an empty ring
+        """
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, get_hash(key)) % len(self._hashes)
+        return self._owners[index]
+
+    def with_nodes(self, nodes: Iterable[str]) -> "HashRing":
+        nodes = tuple(sorted(set(nodes)))
+        return self if nodes == self.nodes else HashRing(nodes, self.virtual_nodes)
@@ -0,0 +1,116 @@
+"""
+In-process hot tier of recently read patient partitions, kept as arrow tables
+"""
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, Hashable, Optional, Tuple
+
+import pyarrow as pa
+
+
+class HotStore:
+    """
+    Size aware LRU of arrow tables with a memory budget.
+
+    Every entry remembers the delta table version it was read at, a lookup with a different version
+    drops the entry, so a new delta commit invalidates the cached partitions of that table.
+    """
+
+    def __init__(self, max_bytes: int, max_entry_bytes: int = None):
+        """
+        :param max_bytes: memory budget of all the cached tables
+        :param max_entry_bytes: tables bigger than this are never cached, defaults to a quarter of the budget
+        """
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes or max_bytes // 4
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[Hashable, Tuple[int, pa.Table, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, version: int) -> Optional[pa.Table]:
+        """
+        :param key:
+        :param version: current version of the delta table the key belongs to
+        :return: the cached table or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            cached_version, table, size = entry
+            if cached_version != version:
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return table
+
+    def put(self, key: Hashable, version: int, table: pa.Table) -> pa.Table:
+        """
+        Caches the table as a single compacted chunk per column and evicts the least recently used
+        entries until the store fits in its budget.
+
+        :param key:
+        :param version:
+        :param table:
+        :return: the compacted table
+        """
+        table = table.combine_chunks()
+        size = table.get_total_buffer_size()
+        if size > self.max_entry_bytes:
+            return table
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            while self._entries and self.current_bytes + size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+            self._entries[key] = (version, table, size)
+            self.current_bytes += size
+        return table
+
+    def invalidate(self, table_path: str = None):
+        """
+        Drops all the entries of a table, or every entry when no table is given.
+        Keys are expected to be tuples starting with the table path.
+
+        :param table_path:
+        :return:
+        """
+        with self._lock:
+            for key in [key for key in self._entries if table_path is None or key[0] == table_path]:
+                self._remove(key)
+
+    def stats(self) -> Dict:
+        """
+        :return:
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _remove(self, key: Hashable):
+        _, _, size = self._entries.pop(key)
+        self.current_bytes -= size
+
+
+@lru_cache
+def get_hot_store(max_bytes: int, tenant: str = None) -> HotStore:
+    """
+    :param max_bytes:
+    :param tenant: every tenant has its own store and byte budget
+    :return:
+    """
+    return HotStore(max_bytes=max_bytes)
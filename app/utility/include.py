@@ -0,0 +1,155 @@
+"""
+_include and _revinclude resolution with one batched semi-join per referenced table
+"""
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Type/id references, absolute urls and versioned references resolve to their last Type/id segments
+REFERENCE_PATTERN = r"(?:^|/)(?P<type>[A-Z][A-Za-z]+)/(?P<id>[A-Za-z0-9\-\.]{1,64})(?:/_history/[^/]+)?$"
+
+# resource types outside the patient compartment, shared by the patients of the table they are stored in
+SHARED_RESOURCE_TYPES = frozenset({
+    "Device", "Endpoint", "Group", "HealthcareService", "Location", "Medication", "Organization", "Practitioner",
+    "PractitionerRole", "Substance",
+})
+
+# search parameters whose element name is not the camel case form of the parameter name
+REFERENCE_ELEMENTS = {
+    "medication": "medicationReference",
+    "organization": "managingOrganization",
+}
+
+
+def parse_include(value: str) -> Optional[Tuple[str, str, Optional[str]]]:
+    """
+    :param value: ex: MedicationRequest:medication or MedicationRequest:requester:Practitioner
+    :return: source resource type, search parameter and optional target resource type
+    """
+    parts = value.split(":")
+    if len(parts) not in (2, 3) or not all(parts):
+        return None
+    return parts[0], parts[1], parts[2] if len(parts) == 3 else None
+
+
+def get_reference_element(search_parameter: str) -> str:
+    """
+    :param search_parameter: ex: based-on
+    :return: ex: basedOn
+    """
+    if search_parameter in REFERENCE_ELEMENTS:
+        return REFERENCE_ELEMENTS[search_parameter]
+    first, *rest = search_parameter.split("-")
+    return first + "".join(part.capitalize() for part in rest)
+
+
+def get_reference_column(table: pa.Table, element: str) -> Tuple[Optional[pa.Array], Optional[pa.Array]]:
+    """
+    Returns the reference strings of a Reference or list of Reference column
+
+    :param table:
+    :param element:
+    :return: the references and, for list columns, the row index of every reference
+    """
+    if element not in table.schema.names:
+        return None, None
+    column = table.column(element).combine_chunks()
+    parents = None
+    if pa.types.is_list(column.type) or pa.types.is_large_list(column.type):
+        parents = pc.list_parent_indices(column)
+        column = pc.list_flatten(column)
+    if not pa.types.is_struct(column.type) or column.type.get_field_index("reference") < 0:
+        return None, None
+    return pc.struct_field(column, [column.type.get_field_index("reference")]), parents
+
+
+def get_referenced_ids(page: pa.Table, element: str, target_type: str = None) -> Dict[str, Set[str]]:
+    """
+    :param page:
+    :param element:
+    :param target_type: only keep references to this resource type
+    :return: distinct referenced ids per resource type
+    """
+    references, _ = get_reference_column(page, element)
+    if references is None:
+        return {}
+    parsed = pc.extract_regex(references, REFERENCE_PATTERN)
+    types, ids = pc.struct_field(parsed, [0]), pc.struct_field(parsed, [1])
+    referenced: Dict[str, Set[str]] = {}
+    for resource_type in pc.unique(types).to_pylist():
+        if resource_type is None or (target_type and resource_type != target_type):
+            continue
+        referenced[resource_type] = set(pc.unique(pc.filter(ids, pc.equal(types, resource_type))).to_pylist())
+    return referenced
+
+
+def get_included(resource_type: str, page: pa.Table, includes: List[str], revincludes: List[str],
+                 read_table: Callable[[str], Optional[pa.Table]],
+                 read_ids: Callable[[str, List[str]], Optional[pa.Table]]) -> List[Dict]:
+    """
+    Resolves the _include and _revinclude resources of a page. The referenced ids of every _include are
+    collected first, so each referenced table is read and filtered once with an is_in semi-join.
+
+    :param resource_type: resource type of the page
+    :param page:
+    :param includes: _include values
+    :param revincludes: _revinclude values
+    :param read_table: returns the patient partition of a resource type
+    :param read_ids: returns the resources of a type in SHARED_RESOURCE_TYPES with the ids, from every partition
+    :return: included resources, without duplicates and without the resources of the page
+    """
+    page_ids = page.column("id").to_pylist() if "id" in page.schema.names else []
+    seen = {(resource_type, resource_id) for resource_id in page_ids}
+    included: List[Dict] = []
+
+    def add_rows(table: pa.Table, table_resource_type: str):
+        for row in table.to_pylist():
+            key = (table_resource_type, row.get("id"))
+            if key in seen:
+                continue
+            seen.add(key)
+            row.setdefault("resourceType", table_resource_type)
+            included.append(row)
+
+    referenced: Dict[str, Set[str]] = {}
+    for value in includes or []:
+        include = parse_include(value)
+        if include is None or include[0].lower() != resource_type.lower():
+            continue
+        source, search_parameter, target_type = include
+        for target, ids in get_referenced_ids(page, get_reference_element(search_parameter), target_type).items():
+            referenced.setdefault(target, set()).update(ids)
+
+    for target, ids in referenced.items():
+        if target in SHARED_RESOURCE_TYPES:
+            table = read_ids(target, sorted(ids))
+            if table is not None:
+                add_rows(table, target)
+            continue
+        table = read_table(target)
+        if table is None or "id" not in table.schema.names:
+            continue
+        id_type = table.schema.field("id").type
+        add_rows(table.filter(pc.is_in(table.column("id"), value_set=pa.array(list(ids), id_type))), target)
+
+    page_references = pa.array([f"{resource_type}/{resource_id}" for resource_id in page_ids], pa.string())
+    for value in revincludes or []:
+        revinclude = parse_include(value)
+        if revinclude is None or not page_ids:
+            continue
+        source, search_parameter, target_type = revinclude
+        if target_type and target_type.lower() != resource_type.lower():
+            continue
+        table = read_table(source)
+        if table is None:
+            continue
+        references, parents = get_reference_column(table, get_reference_element(search_parameter))
+        if references is None:
+            continue
+        mask = pc.is_in(references, value_set=page_references)
+        if parents is None:
+            add_rows(table.filter(mask), source)
+        else:
+            add_rows(table.take(pc.unique(pc.filter(parents, mask))), source)
+    return included
@@ -0,0 +1,71 @@
+"""
+Observation $lastn, the latest observations per code computed with a window inside duckdb
+"""
+from typing import Optional, Sequence
+
+import pyarrow as pa
+
+from .sqlparser import get_sql_parser
+
+# date elements of an Observation, in order of preference
+OBSERVATION_DATE_ELEMENTS = ["effectiveDateTime", "effectiveInstant", "effectivePeriod.start", "issued"]
+
+
+def get_column_sql(schema: pa.Schema, path: str) -> Optional[str]:
+    """
+    :param schema:
+    :param path: dotted path of a struct field, ex: effectivePeriod.start
+    :return: quoted duckdb column expression, None when the path is not in the schema
+    """
+    field_type = None
+    for depth, name in enumerate(path.split(".")):
+        if depth == 0:
+            if name not in schema.names:
+                return None
+            field_type = schema.field(name).type
+        elif pa.types.is_struct(field_type) and field_type.get_field_index(name) >= 0:
+            field_type = field_type[field_type.get_field_index(name)].type
+        else:
+            return None
+    return ".".join(f'"{name}"' for name in path.split("."))
+
+
+def get_coalesce_sql(schema: pa.Schema, paths: Sequence[str]) -> Optional[str]:
+    columns = [column for column in (get_column_sql(schema, path) for path in paths) if column]
+    if not columns:
+        return None
+    return columns[0] if len(columns) == 1 else f"coalesce({', '.join(columns)})"
+
+
+def get_code_group_sql(schema: pa.Schema) -> str:
+    """
+    Observations are grouped by the system and code of their first coding, or by code.text without codings
+
+    :param schema:
+    :return:
+    """
+    keys = []
+    if get_column_sql(schema, "code.coding"):
+        coding = schema.field("code").type[schema.field("code").type.get_field_index("coding")].type
+        if pa.types.is_list(coding) and pa.types.is_struct(coding.value_type):
+            names = [coding.value_type[index].name for index in range(coding.value_type.num_fields)]
+            if "code" in names:
+                system = '"code"."coding"[1]."system"' if "system" in names else "''"
+                keys.append(f"{system} || '|' || \"code\".\"coding\"[1].\"code\"")
+    text = get_column_sql(schema, "code.text")
+    if text:
+        keys.append(text)
+    if not keys:
+        return "1"
+    return keys[0] if len(keys) == 1 else f"coalesce({', '.join(keys)})"
+
+
+def get_lastn_query(schema: pa.Schema, max_per_code: int):
+    """
+    :param schema: schema of the observation table registered as "observation"
+    :param max_per_code:
+    :return: query and bind parameters
+    """
+    order_by = get_coalesce_sql(schema, OBSERVATION_DATE_ELEMENTS) or '"id"'
+    return get_sql_parser().get_query(
+        "observation_lastn", {"group_by": get_code_group_sql(schema), "order_by": order_by, "max": max_per_code})
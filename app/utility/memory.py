@@ -0,0 +1,112 @@
+"""
+Per-request memory budget, accounted on the arrow memory pool of the request
+"""
+import threading
+from contextvars import ContextVar
+from typing import Iterable, Iterator, List, Optional
+
+import pyarrow as pa
+from prometheus_client import Counter, Histogram
+
+MEMORY_PEAK_BYTES = Histogram(
+    "fhir_request_memory_peak_bytes", "Peak arrow memory allocated by a request",
+    buckets=[2 ** exponent for exponent in range(16, 35, 2)])
+MEMORY_BUDGET_EXCEEDED = Counter(
+    "fhir_memory_budget_exceeded_total",
+    "Requests over their memory budget, streamed, rejected before the read or aborted during the scan",
+    ["action"])
+
+
+class MemoryBudgetExceeded(Exception):
+    """Raised when a request needs more arrow memory than its budget"""
+
+    def __init__(self, size: Optional[int], limit: int):
+        super().__init__(
+            f"Request needs {size} bytes, over its memory budget of {limit} bytes" if size is not None
+            else f"Request is over its memory budget of {limit} bytes")
+        self.size = size
+        self.limit = limit
+
+
+# proxy pools must outlive the buffers they allocated, cached tables keep their buffers after the request,
+# so the pools are recycled and never freed
+_free_pools: List[pa.MemoryPool] = []
+_pools_lock = threading.Lock()
+
+
+def _acquire_pool() -> pa.MemoryPool:
+    with _pools_lock:
+        if _free_pools:
+            return _free_pools.pop()
+    return pa.proxy_memory_pool(pa.default_memory_pool())
+
+
+class MemoryBudget:
+    """
+    Memory budget of a request. The arrow scans of the request allocate from its pool and check the budget
+    between record batches. A recycled pool may still hold the buffers of earlier requests, usage is counted
+    from the bytes allocated when the budget was created.
+    """
+
+    def __init__(self, limit: int):
+        """
+        :param limit: bytes
+        """
+        self.limit = limit
+        self.pool = _acquire_pool()
+        self._baseline = self.pool.bytes_allocated()
+        self.peak = 0
+
+    @property
+    def used(self) -> int:
+        return max(self.pool.bytes_allocated() - self._baseline, 0)
+
+    def check(self, size: int = 0):
+        """
+        :param size: bytes about to be allocated
+        :return:
+        """
+        used = self.used
+        self.peak = max(self.peak, used)
+        if used + size > self.limit:
+            MEMORY_BUDGET_EXCEEDED.labels("rejected" if size else "aborted").inc()
+            raise MemoryBudgetExceeded(used + size, self.limit)
+
+    def release(self):
+        self.peak = max(self.peak, self.used)
+        MEMORY_PEAK_BYTES.observe(self.peak)
+        with _pools_lock:
+            _free_pools.append(self.pool)
+
+
+_memory_budget: ContextVar[Optional[MemoryBudget]] = ContextVar("memory_budget", default=None)
+
+
+def get_memory_budget() -> Optional[MemoryBudget]:
+    return _memory_budget.get()
+
+
+def set_memory_budget(budget: Optional[MemoryBudget]):
+    _memory_budget.set(budget)
+
+
+def get_memory_pool() -> Optional[pa.MemoryPool]:
+    """
+    :return: the pool of the request budget, None for the default pool
+    """
+    budget = get_memory_budget()
+    return budget.pool if budget is not None else None
+
+
+def check_budget(batches: Iterable[pa.RecordBatch]) -> Iterator[pa.RecordBatch]:
+    """
+    Yields the batches of a scan until the memory budget of the context is exceeded
+
+    :param batches:
+    :return:
+    """
+    budget = get_memory_budget()
+    for batch in batches:
+        if budget is not None:
+            budget.check()
+        yield batch
@@ -0,0 +1,204 @@
+"""
+Request metrics kept per worker without locks, aggregated across the uvicorn workers at scrape time
+"""
+import os
+import glob
+import asyncio
+from bisect import bisect_left
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import orjson
+from prometheus_client import CollectorRegistry, REGISTRY
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily
+
+# request duration buckets in seconds, from a cached page to a full partition scan
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+LABEL_NAMES = ("method", "route", "resource_type")
+
+
+class RequestMetrics:
+    """
+    Request counters and duration histograms of a worker, by method, route template and resource type.
+    They are only updated from the event loop thread of the worker, so plain dicts are enough.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DURATION_BUCKETS):
+        self.buckets = buckets
+        # label values and status code: number of requests
+        self.requests: Dict[Tuple[str, ...], int] = {}
+        # label values: count per bucket, the last bucket is +Inf, followed by the sum of the durations
+        self.durations: Dict[Tuple[str, ...], List[float]] = {}
+        self.in_progress = 0
+
+    def observe(self, labels: Tuple[str, str, str], status: str, duration: float):
+        """
+        :param labels: method, route template and resource type
+        :param status: response status code
+        :param duration: seconds
+        :return:
+        """
+        key = labels + (status,)
+        self.requests[key] = self.requests.get(key, 0) + 1
+        histogram = self.durations.get(labels)
+        if histogram is None:
+            histogram = self.durations[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        histogram[bisect_left(self.buckets, duration)] += 1
+        histogram[-1] += duration
+
+    def snapshot(self) -> Dict:
+        return {
+            "requests": [[list(key), value] for key, value in self.requests.items()],
+            "durations": [[list(key), value] for key, value in self.durations.items()],
+            "in_progress": self.in_progress,
+        }
+
+    def merge(self, snapshot: Dict):
+        """
+        Adds the counters of the snapshot of another worker
+
+        :param snapshot:
+        :return:
+        """
+        for key, value in snapshot["requests"]:
+            key = tuple(key)
+            self.requests[key] = self.requests.get(key, 0) + value
+        for key, value in snapshot["durations"]:
+            key = tuple(key)
+            histogram = self.durations.get(key)
+            if histogram is None:
+                self.durations[key] = list(value)
+            else:
+                self.durations[key] = [total + added for total, added in zip(histogram, value)]
+        self.in_progress += snapshot["in_progress"]
+
+    def write(self, directory: str):
+        """
+        Writes the snapshot of the worker to the multiprocess directory, replaced atomically
+
+        :param directory:
+        :return:
+        """
+        path = os.path.join(directory, f"requests_{os.getpid()}.json")
+        with open(f"{path}.tmp", "wb") as file:
+            file.write(orjson.dumps(self.snapshot()))
+        os.replace(f"{path}.tmp", path)
+
+
+def is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def read_snapshots(directory: str) -> Iterable[Dict]:
+    """
+    :param directory:
+    :return: the snapshots of the other live workers. The snapshots of dead workers are removed, a restarted
+    worker starts again from zero and the scraper sees a counter reset rather than counts taken twice
+    """
+    own = os.path.join(directory, f"requests_{os.getpid()}.json")
+    for path in glob.glob(os.path.join(directory, "requests_*.json")):
+        if path == own:
+            continue
+        pid = os.path.basename(path)[len("requests_"):-len(".json")]
+        if pid.isdigit() and not is_alive(int(pid)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(path, "rb") as file:
+                yield orjson.loads(file.read())
+        except (OSError, orjson.JSONDecodeError):
+            continue
+
+
+class RequestMetricsCollector:
+    """
+    Prometheus collector of the request metrics, merged with the snapshots of the other workers
+    in multiprocess mode
+    """
+
+    def __init__(self, metrics: RequestMetrics, directory: Optional[str] = None):
+        self.metrics = metrics
+        self.directory = directory
+
+    def collect(self):
+        metrics = self.metrics
+        if self.directory:
+            metrics = RequestMetrics(self.metrics.buckets)
+            metrics.merge(self.metrics.snapshot())
+            for snapshot in read_snapshots(self.directory):
+                metrics.merge(snapshot)
+
+        requests = CounterMetricFamily(
+            "fhir_requests", "Requests by route template, resource type and status", labels=LABEL_NAMES + ("status",))
+        for key, value in metrics.requests.items():
+            requests.add_metric(key, value)
+        yield requests
+
+        durations = HistogramMetricFamily(
+            "fhir_request_duration_seconds", "Request duration by route template and resource type",
+            labels=LABEL_NAMES)
+        for key, histogram in metrics.durations.items():
+            cumulative, buckets = 0, []
+            for bound, count in zip(metrics.buckets + (float("inf"),), histogram[:-1]):
+                cumulative += count
+                buckets.append((str(bound) if bound != float("inf") else "+Inf", cumulative))
+            durations.add_metric(key, buckets, histogram[-1])
+        yield durations
+
+        in_progress = GaugeMetricFamily("fhir_requests_in_progress", "Requests being served")
+        in_progress.add_metric([], metrics.in_progress)
+        yield in_progress
+
+
+async def write_snapshots(metrics: RequestMetrics, directory: str, interval: float):
+    """
+    Writes the snapshot of the worker every interval seconds, the worker serving a scrape reads its own
+    counters from memory
+
+    :param metrics:
+    :param directory:
+    :param interval:
+    :return:
+    """
+    while True:
+        await asyncio.sleep(interval)
+        metrics.write(directory)
+
+
+@lru_cache
+def get_request_metrics() -> RequestMetrics:
+    return RequestMetrics()
+
+
+def get_multiprocess_dir() -> Optional[str]:
+    """
+    :return: the prometheus_client multiprocess directory, set when uvicorn runs several workers
+    """
+    return os.environ.get("PROMETHEUS_MULTIPROC_DIR") or os.environ.get("prometheus_multiproc_dir")
+
+
+@lru_cache
+def get_metrics_registry() -> CollectorRegistry:
+    """
+    :return: the registry of the /metrics/ route. In multiprocess mode the prometheus_client metrics
+    are read from the files of every worker
+    """
+    directory = get_multiprocess_dir()
+    if not directory:
+        REGISTRY.register(RequestMetricsCollector(get_request_metrics()))
+        return REGISTRY
+    from prometheus_client import multiprocess
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=directory)
+    registry.register(RequestMetricsCollector(get_request_metrics(), directory))
+    return registry
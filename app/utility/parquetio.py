@@ -0,0 +1,49 @@
+"""
+Local parquet I/O helpers used to read delta tables stored on local disks
+"""
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs as pa_fs
+
+
+def get_local_path(table_uri: str):
+    """
+    Returns the local file system path of a delta table uri
+
+    :param table_uri: delta table uri, ex: /data/ehr1/observation or file:///data/ehr1/observation
+    :return:
+    """
+    if table_uri.startswith("file://"):
+        return table_uri[len("file://"):]
+    return table_uri
+
+
+def get_local_filesystem(table_uri: str, use_mmap: bool = True):
+    """
+    Returns an arrow native local file system rooted at the table directory, the relative file paths in
+    the delta log resolve against it. With use_mmap the parquet files are memory mapped, so column chunks
+    are served from the OS page cache without copying them into arrow buffers.
+
+    :param table_uri:
+    :param use_mmap:
+    :return:
+    """
+    return pa_fs.SubTreeFileSystem(get_local_path(table_uri), pa_fs.LocalFileSystem(use_mmap=use_mmap))
+
+
+def get_fragment_scan_options(
+        pre_buffer: bool = True, hole_size_limit: int = 8192, range_size_limit: int = 32 * 1024 * 1024):
+    """
+    Returns the parquet scan options. pre_buffer reads all the column chunks of a row group up front and
+    coalesces nearby byte ranges (closer than hole_size_limit, up to range_size_limit) into single reads.
+
+    :param pre_buffer:
+    :param hole_size_limit:
+    :param range_size_limit:
+    :return:
+    """
+    if pre_buffer and hasattr(pa, "CacheOptions"):
+        return ds.ParquetFragmentScanOptions(
+            pre_buffer=True,
+            cache_options=pa.CacheOptions(hole_size_limit=hole_size_limit, range_size_limit=range_size_limit))
+    return ds.ParquetFragmentScanOptions(pre_buffer=pre_buffer)
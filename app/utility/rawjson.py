@@ -0,0 +1,101 @@
+"""
+Pre-serialized resources. Tables may hold the JSON of every resource in a resource_json column, written
+at ETL, $import, write or compaction time. Plain searches then read that column alone and splice its bytes
+into the response, the nested columns are never decoded.
+"""
+from typing import Any, Dict, List, Optional
+
+import orjson
+import pyarrow as pa
+import pyarrow.compute as pc
+
+RESOURCE_JSON = "resource_json"
+
+
+def has_resource_json(schema: pa.Schema) -> bool:
+    return schema is not None and RESOURCE_JSON in schema.names
+
+
+def drop_resource_json(table: Optional[pa.Table]) -> Optional[pa.Table]:
+    """
+    :param table:
+    :return: the rows without their resource_json, decoded searches return the columns
+    """
+    if isinstance(table, pa.Table) and RESOURCE_JSON in table.schema.names:
+        return table.drop([RESOURCE_JSON])
+    return table
+
+
+def strip_nulls(value: Any) -> Any:
+    """
+    :param value: python value of an arrow row, missing elements are nulls
+    :return: the value without its null elements and empty lists, like the FHIR JSON it was read from
+    """
+    if isinstance(value, dict):
+        return {name: strip_nulls(item) for name, item in value.items() if item is not None and item != []}
+    if isinstance(value, list):
+        return [strip_nulls(item) for item in value if item is not None]
+    return value
+
+
+def get_json_value(resource: Dict, field_type: pa.DataType):
+    """
+    :param resource: FHIR resource
+    :param field_type: type of the resource_json column, string or binary
+    :return: the serialized resource
+    """
+    data = orjson.dumps(resource, default=str)
+    return data if pa.types.is_binary(field_type) or pa.types.is_large_binary(field_type) else data.decode()
+
+
+def build_resource_json(table: pa.Table, field_type: pa.DataType, exclude: List[str] = ()) -> pa.Array:
+    """
+    :param table: resource rows
+    :param field_type: type of the resource_json column
+    :param exclude: columns that are not resource elements, ex: the partition column
+    :return: the serialized resources of the rows
+    """
+    columns = [name for name in table.schema.names if name != RESOURCE_JSON and name not in exclude]
+    return pa.array(
+        [get_json_value(strip_nulls(row), field_type) for row in table.select(columns).to_pylist()], field_type)
+
+
+def fill_resource_json(table: pa.Table, exclude: List[str] = ()) -> pa.Table:
+    """
+    :param table: rows of a table with a resource_json column
+    :param exclude: see build_resource_json
+    :return: the rows, their missing resource_json values built from their columns
+    """
+    index = table.schema.get_field_index(RESOURCE_JSON)
+    column = table.column(index)
+    if not column.null_count:
+        return table
+    built = build_resource_json(table, column.type, exclude)
+    return table.set_column(index, table.schema.field(index), pc.if_else(pc.is_null(column), built, column))
+
+
+def join_resource_json(column: pa.ChunkedArray) -> bytes:
+    """
+    :param column: resource_json values without nulls
+    :return: the values separated by commas, the items of a JSON array
+    """
+    if not len(column):
+        return b""
+    values = column.combine_chunks()
+    items = pa.ListArray.from_arrays(pa.array([0, len(values)], pa.int32()), values)
+    return pc.binary_join(items, b"," if pa.types.is_binary(values.type) else ",")[0].as_buffer().to_pybytes()
+
+
+def append_json_element(values: pa.ChunkedArray, name: str, column: pa.ChunkedArray) -> pa.ChunkedArray:
+    """
+    :param values: resource_json values without nulls
+    :param name: name of a column that is not stored in the json, ex: the partition column
+    :param column: values of that column, one per resource
+    :return: the values with the element added last, the decoded rows hold it in that place
+    """
+    values = values.combine_chunks()
+    if pa.types.is_binary(values.type) or pa.types.is_large_binary(values.type):
+        values = values.cast(pa.string())
+    members = pa.array([f',{orjson.dumps(name).decode()}:{orjson.dumps(value).decode()}}}'
+                        for value in column.to_pylist()], pa.string())
+    return pa.chunked_array([pc.binary_join_element_wise(pc.utf8_slice_codeunits(values, 0, -1), members, "")])
@@ -0,0 +1,91 @@
+"""
+Fair queuing of the requests of the tenants
+"""
+import time
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict
+
+from prometheus_client import Histogram
+
+TENANT_QUEUE_SECONDS = Histogram(
+    "fhir_tenant_queue_seconds", "Time requests waited for a slot of the scheduler", ["tenant"],
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0))
+
+
+class FairScheduler:
+    """
+    Runs at most `concurrency` requests at a time, and at most the quota of a tenant for each tenant. Waiting
+    requests are queued per tenant and the free slots go round robin to the tenants with waiting requests
+    under their quota, so a tenant with many heavy requests only delays the others by its share.
+    Used from the event loop thread only.
+    """
+
+    def __init__(self, concurrency: int, quota: int, quotas: Dict[str, int] = None):
+        """
+        :param concurrency: slots shared by all the tenants
+        :param quota: default maximum number of slots of a tenant
+        :param quotas: quota by tenant
+        """
+        self.concurrency = concurrency
+        self.quota = quota
+        self.quotas = quotas or {}
+        self.active = 0
+        self.running: Dict[str, int] = {}
+        # waiting requests by tenant, in round robin order
+        self.queues: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+
+    def _has_slot(self, tenant: str) -> bool:
+        return self.active < self.concurrency and self.running.get(tenant, 0) < self.quotas.get(tenant, self.quota)
+
+    def _grant(self, tenant: str):
+        self.active += 1
+        self.running[tenant] = self.running.get(tenant, 0) + 1
+
+    def _dispatch(self):
+        while self.active < self.concurrency:
+            tenant = next((tenant for tenant in self.queues if self._has_slot(tenant)), None)
+            if tenant is None:
+                return
+            queue = self.queues[tenant]
+            future = queue.popleft()
+            if queue:
+                self.queues.move_to_end(tenant)
+            else:
+                del self.queues[tenant]
+            self._grant(tenant)
+            future.set_result(None)
+
+    async def acquire(self, tenant: str):
+        if tenant not in self.queues and self._has_slot(tenant):
+            self._grant(tenant)
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.queues.setdefault(tenant, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # the slot was granted as the waiter was cancelled
+                self.release(tenant)
+            elif tenant in self.queues and future in self.queues[tenant]:
+                self.queues[tenant].remove(future)
+                if not self.queues[tenant]:
+                    del self.queues[tenant]
+            raise
+
+    def release(self, tenant: str):
+        self.active -= 1
+        self.running[tenant] -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, tenant: str):
+        start = time.perf_counter()
+        await self.acquire(tenant)
+        TENANT_QUEUE_SECONDS.labels(tenant).observe(time.perf_counter() - start)
+        try:
+            yield
+        finally:
+            self.release(tenant)
@@ -0,0 +1,167 @@
+"""
+Observation $series, numeric observation values downsampled to a target number of points
+"""
+from typing import Dict, Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+SERIES_METHODS = ("lttb", "minmax")
+
+
+# FHIR dateTime, a year, year-month, date or date and time, with an optional fraction and time zone
+DATE_TIME_PATTERN = (r"^(?P<date>\d{4}(?:-\d{2}(?:-\d{2})?)?)(?:T(?P<time>\d{2}:\d{2}(?::\d{2})?)"
+                     r"(?P<fraction>\.\d+)?(?P<zone>Z|[+-]\d{2}:\d{2})?)?$")
+
+
+def parse_date_times(values: pa.Array) -> pa.Array:
+    """
+    Parses FHIR dateTime strings to UTC epoch milliseconds. Partial dates are read as their first instant,
+    times without a time zone as UTC.
+
+    :param values: strings
+    :return: epoch milliseconds, null where a value is not a FHIR dateTime
+    """
+    parts = pc.extract_regex(pc.cast(values, pa.string()), DATE_TIME_PATTERN)
+    date, time, fraction, zone = (pc.struct_field(parts, [index]) for index in range(4))
+    date = pc.if_else(pc.equal(pc.utf8_length(date), 4), pc.binary_join_element_wise(date, "-01-01", ""),
+                      pc.if_else(pc.equal(pc.utf8_length(date), 7), pc.binary_join_element_wise(date, "-01", ""),
+                                 date))
+    time = pc.if_else(pc.equal(pc.utf8_length(time), 0), "00:00:00",
+                      pc.if_else(pc.equal(pc.utf8_length(time), 5), pc.binary_join_element_wise(time, ":00", ""),
+                                 time))
+    local = pc.strptime(pc.binary_join_element_wise(date, time, "T"), format="%Y-%m-%dT%H:%M:%S", unit="s",
+                        error_is_null=True)
+    milliseconds = pc.multiply(pc.cast(local, pa.int64()), 1000)
+    # digits of the fraction after the milliseconds are dropped
+    fraction = pc.utf8_rpad(pc.utf8_slice_codeunits(fraction, 1, 4), 3, "0")
+    milliseconds = pc.add(milliseconds, pc.cast(fraction, pa.int64()))
+    offset = pc.if_else(pc.greater(pc.utf8_length(zone), 1), zone, "+00:00")
+    minutes = pc.add(pc.multiply(pc.cast(pc.utf8_slice_codeunits(offset, 1, 3), pa.int64()), 60),
+                     pc.cast(pc.utf8_slice_codeunits(offset, 4, 6), pa.int64()))
+    minutes = pc.if_else(pc.starts_with(offset, "-"), pc.negate(minutes), minutes)
+    return pc.subtract(milliseconds, pc.multiply(minutes, 60 * 1000))
+
+
+def to_epoch_ms(value: str) -> int:
+    """
+    :param value: FHIR dateTime, ex: 2020, 2020-01-15 or 2020-01-15T10:00:00+02:00
+    :return: UTC epoch milliseconds, raises ValueError when the value is not a FHIR dateTime
+    """
+    epoch_ms = parse_date_times(pa.array([value], pa.string()))[0].as_py()
+    if epoch_ms is None:
+        raise ValueError(f"{value} is not a FHIR dateTime")
+    return epoch_ms
+
+
+def get_series_arrays(table: pa.Table, start: str = None, end: str = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Extracts the time and value columns of numeric observations, sorted by time
+
+    :param table: observations with effectiveDateTime and valueQuantity columns
+    :param start: inclusive lower bound of effectiveDateTime, FHIR dateTime
+    :param end: exclusive upper bound of effectiveDateTime, FHIR dateTime
+    :return: epoch milliseconds and values, raises ValueError when start or end is not a FHIR dateTime
+    """
+    start_ms = to_epoch_ms(start) if start else None
+    end_ms = to_epoch_ms(end) if end else None
+    names = table.schema.names
+    if "effectiveDateTime" not in names or "valueQuantity" not in names:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    quantity = table.column("valueQuantity").combine_chunks()
+    if not pa.types.is_struct(quantity.type) or quantity.type.get_field_index("value") < 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    values = pc.struct_field(quantity, [quantity.type.get_field_index("value")])
+    times = table.column("effectiveDateTime").combine_chunks()
+    if pa.types.is_timestamp(times.type):
+        times = pc.cast(pc.cast(times, pa.timestamp("ms", tz=times.type.tz)), pa.int64())
+    else:
+        times = parse_date_times(times)
+    valid = pc.and_(pc.is_valid(times), pc.is_valid(values))
+    if start_ms is not None:
+        valid = pc.and_(valid, pc.greater_equal(times, start_ms))
+    if end_ms is not None:
+        valid = pc.and_(valid, pc.less(times, end_ms))
+    times = pc.filter(times, valid).to_numpy(zero_copy_only=False)
+    values = pc.cast(pc.filter(values, valid), pa.float64()).to_numpy(zero_copy_only=False)
+    order = np.argsort(times, kind="stable")
+    return times[order], values[order]
+
+
+def downsample_minmax(times: np.ndarray, values: np.ndarray, points: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Splits the series into points / 2 buckets of equal size and keeps the minimum and maximum of every
+    bucket, in time order
+
+    :param times:
+    :param values:
+    :param points:
+    :return:
+    """
+    if len(times) <= points:
+        return times, values
+    buckets = max(points // 2, 1)
+    starts = np.linspace(0, len(times), buckets + 1).astype(np.int64)[:-1]
+    bucket_ids = np.repeat(np.arange(buckets), np.diff(np.append(starts, len(times))))
+    # sorting by bucket then value puts the minimum (maximum) of every bucket first in its bucket
+    order_min = np.lexsort((values, bucket_ids))
+    order_max = np.lexsort((-values, bucket_ids))
+    first = np.searchsorted(bucket_ids[order_min], np.arange(buckets))
+    minimums, maximums = order_min[first], order_max[first]
+    selected = np.unique(np.concatenate([minimums, maximums]))
+    return times[selected], values[selected]
+
+
+def downsample_lttb(times: np.ndarray, values: np.ndarray, points: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Largest-Triangle-Three-Buckets downsampling, keeps the first and last points and from every bucket
+    the point forming the largest triangle with the previous selected point and the next bucket average
+
+    :param times:
+    :param values:
+    :param points:
+    :return:
+    """
+    size = len(times)
+    if points >= size or points < 3:
+        return times, values
+    x = times.astype(np.float64)
+    edges = np.linspace(1, size - 1, points - 1).astype(np.int64)
+    selected = np.empty(points, dtype=np.int64)
+    selected[0], selected[-1] = 0, size - 1
+    previous = 0
+    for bucket in range(points - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_start, next_end = end, edges[bucket + 2] if bucket + 2 < len(edges) else size
+        next_x, next_y = x[next_start:next_end].mean(), values[next_start:next_end].mean()
+        areas = np.abs(
+            (x[previous] - next_x) * (values[start:end] - values[previous])
+            - (x[previous] - x[start:end]) * (next_y - values[previous]))
+        previous = start + int(np.argmax(areas))
+        selected[bucket + 1] = previous
+    return times[selected], values[selected]
+
+
+def get_series(table: pa.Table, points: int, method: str = "lttb", start: str = None, end: str = None) -> Dict:
+    """
+    :param table:
+    :param points: target number of points
+    :param method: lttb or minmax
+    :param start:
+    :param end:
+    :return: compact arrays of epoch milliseconds and values
+    """
+    times, values = get_series_arrays(table, start, end)
+    total = len(times)
+    if method == "minmax":
+        times, values = downsample_minmax(times, values, points)
+    else:
+        times, values = downsample_lttb(times, values, points)
+    unit = None
+    if total and "valueQuantity" in table.schema.names:
+        quantity = table.column("valueQuantity").combine_chunks()
+        if quantity.type.get_field_index("unit") >= 0:
+            units = pc.drop_null(pc.struct_field(quantity, [quantity.type.get_field_index("unit")]))
+            unit = units[0].as_py() if len(units) else None
+    return {"t": times.tolist(), "v": values.tolist(), "unit": unit, "total": total, "count": len(times)}
@@ -0,0 +1,273 @@
+"""
+Cache shared by all the uvicorn workers of a host.
+
+A single cache daemon owns a directory on a shared memory file system (/dev/shm) and the LRU eviction
+policy of all its entries. Workers talk to it over a unix socket: a put writes the arrow IPC stream of a
+table into the directory and hands the file over to the daemon, a get returns the file name of the entry,
+which the worker memory maps, so cached tables are read without copying them out of shared memory.
+
+Only whole patient partitions are shared, see common.get_patient_data. Parquet footers are not: the scans
+read them through the delta-rs datasets, which take no external metadata, and with io_mode "mmap" the footer
+reads are served from the OS page cache that the workers already share.
+
+Run the daemon next to the workers with
+    python -m app.utility.sharedcache --socket /tmp/fhir-api-cache.sock --cache-dir /dev/shm/fhir-api-cache
+"""
+import os
+import uuid
+import struct
+import asyncio
+import hashlib
+import argparse
+import socket
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, Optional
+
+import orjson
+import pyarrow as pa
+from loguru import logger
+
+_HEADER = struct.Struct(">I")
+_TMP_PREFIX = "tmp-"
+
+
+class SharedCacheServer:
+    """
+    Cache daemon, keeps the index of the cached files and evicts the least recently used ones
+    once the cache directory grows over max_bytes.
+    """
+
+    def __init__(self, socket_path: str, cache_dir: str, max_bytes: int):
+        """
+        :param socket_path:
+        :param cache_dir:
+        :param max_bytes:
+        """
+        self.socket_path = socket_path
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._generation = 0
+
+    def dispatch(self, message: Dict) -> Dict:
+        """
+        :param message: {"op": "get"|"put"|"delete"|"clear"|"stats", "key": str, "file": str}
+        :return:
+        """
+        op = message.get("op")
+        key = message.get("key")
+        if op == "get":
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return {"hit": False}
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return {"hit": True, "file": entry[0]}
+        if op == "put":
+            return self._put(key, message["file"])
+        if op == "delete":
+            if key in self._entries:
+                self._remove(key)
+            return {"ok": True}
+        if op == "clear":
+            for entry_key in list(self._entries):
+                self._remove(entry_key)
+            return {"ok": True}
+        if op == "stats":
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+        return {"error": f"Unknown operation: {op}"}
+
+    def _put(self, key: str, file_name: str) -> Dict:
+        if os.path.basename(file_name) != file_name or not file_name.startswith(_TMP_PREFIX):
+            return {"error": f"Invalid cache file: {file_name}"}
+        tmp_path = os.path.join(self.cache_dir, file_name)
+        try:
+            size = os.path.getsize(tmp_path)
+        except OSError:
+            return {"error": f"Cache file not found: {file_name}"}
+        if size > self.max_bytes:
+            os.unlink(tmp_path)
+            return {"ok": False}
+        if key in self._entries:
+            self._remove(key)
+        while self._entries and self.current_bytes + size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+        # every put gets a new file name, readers holding a mapping of a replaced entry keep their data
+        self._generation += 1
+        entry_file = f"{hashlib.sha1(key.encode()).hexdigest()}-{self._generation}"
+        os.rename(tmp_path, os.path.join(self.cache_dir, entry_file))
+        self._entries[key] = (entry_file, size)
+        self.current_bytes += size
+        return {"ok": True}
+
+    def _remove(self, key: str):
+        entry_file, size = self._entries.pop(key)
+        self.current_bytes -= size
+        try:
+            os.unlink(os.path.join(self.cache_dir, entry_file))
+        except FileNotFoundError:
+            pass
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                (length,) = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+                response = orjson.dumps(self.dispatch(orjson.loads(await reader.readexactly(length))))
+                writer.write(_HEADER.pack(len(response)) + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        for file_name in os.listdir(self.cache_dir):
+            os.unlink(os.path.join(self.cache_dir, file_name))
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = await asyncio.start_unix_server(self.handle, path=self.socket_path)
+        logger.info(f'Shared cache listening on {self.socket_path}, cache dir: {self.cache_dir}')
+        async with server:
+            await server.serve_forever()
+
+
+class SharedCacheClient:
+    """
+    Worker side of the shared cache. The cache is best effort, when the daemon can not be reached
+    every call is a miss and the connection is retried after retry_interval seconds.
+    """
+
+    def __init__(self, socket_path: str, cache_dir: str, timeout: float = 0.5, retry_interval: float = 5.0):
+        """
+        :param socket_path:
+        :param cache_dir:
+        :param timeout: socket timeout in seconds
+        :param retry_interval:
+        """
+        self.socket_path = socket_path
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+        self._local = threading.local()
+        self._unavailable_until = 0.0
+
+    def _connection(self) -> Optional[socket.socket]:
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            return connection
+        if time.monotonic() < self._unavailable_until:
+            return None
+        try:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.settimeout(self.timeout)
+            connection.connect(self.socket_path)
+        except OSError as e:
+            logger.warning(f'Shared cache unavailable: {e}')
+            self._unavailable_until = time.monotonic() + self.retry_interval
+            return None
+        self._local.connection = connection
+        return connection
+
+    def _request(self, message: Dict) -> Optional[Dict]:
+        connection = self._connection()
+        if connection is None:
+            return None
+        payload = orjson.dumps(message)
+        try:
+            connection.sendall(_HEADER.pack(len(payload)) + payload)
+            (length,) = _HEADER.unpack(self._recv(connection, _HEADER.size))
+            return orjson.loads(self._recv(connection, length))
+        except OSError as e:
+            logger.warning(f'Shared cache request failed: {e}')
+            connection.close()
+            self._local.connection = None
+            return None
+
+    @staticmethod
+    def _recv(connection: socket.socket, length: int) -> bytes:
+        data = bytearray()
+        while len(data) < length:
+            chunk = connection.recv(length - len(data))
+            if not chunk:
+                raise ConnectionResetError("Shared cache closed the connection")
+            data.extend(chunk)
+        return bytes(data)
+
+    def get_table(self, key: str) -> Optional[pa.Table]:
+        """
+        :param key:
+        :return: the cached table, memory mapped from the shared cache directory, or None
+        """
+        response = self._request({"op": "get", "key": key})
+        if not response or not response.get("hit"):
+            return None
+        try:
+            source = pa.memory_map(os.path.join(self.cache_dir, response["file"]))
+        except FileNotFoundError:
+            # evicted between the lookup and the open
+            return None
+        return pa.ipc.open_stream(source).read_all()
+
+    def put_table(self, key: str, table: pa.Table) -> bool:
+        """
+        :param key:
+        :param table:
+        :return: whether the table was cached
+        """
+        if self._connection() is None:
+            return False
+        file_name = f"{_TMP_PREFIX}{uuid.uuid4().hex}"
+        tmp_path = os.path.join(self.cache_dir, file_name)
+        try:
+            with pa.OSFile(tmp_path, "wb") as sink:
+                with pa.ipc.new_stream(sink, table.schema) as writer:
+                    writer.write_table(table)
+        except OSError as e:
+            # the cache directory is full or gone, the read is served without the cache
+            logger.warning(f'Shared cache write failed: {e}')
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            return False
+        response = self._request({"op": "put", "key": key, "file": file_name})
+        if not response or not response.get("ok"):
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            return False
+        return True
+
+    def delete(self, key: str):
+        self._request({"op": "delete", "key": key})
+
+    def stats(self) -> Optional[Dict]:
+        return self._request({"op": "stats"})
+
+
+@lru_cache
+def get_shared_cache(socket_path: str, cache_dir: str) -> SharedCacheClient:
+    return SharedCacheClient(socket_path=socket_path, cache_dir=cache_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shared cache daemon of the FHIR api workers")
+    parser.add_argument("--socket", default="/tmp/fhir-api-cache.sock")
+    parser.add_argument("--cache-dir", default="/dev/shm/fhir-api-cache")
+    parser.add_argument("--max-bytes", type=int, default=2 * 1024 * 1024 * 1024)
+    args = parser.parse_args()
+    asyncio.run(SharedCacheServer(args.socket, args.cache_dir, args.max_bytes).serve())
@@ -0,0 +1,80 @@
+"""
+Coalescing of identical concurrent reads
+"""
+import asyncio
+from functools import lru_cache
+from typing import Callable, Dict, Hashable
+
+from prometheus_client import Counter
+from starlette.concurrency import run_in_threadpool
+
+from .cancellation import CancelToken, set_cancel_token
+
+SINGLE_FLIGHT_REQUESTS = Counter(
+    "fhir_single_flight_requests_total", "Reads by single flight role, coalesced reads shared a running scan",
+    ["role"])
+
+
+class _Call:
+    def __init__(self, task: asyncio.Future, token: CancelToken):
+        self.task = task
+        self.token = token
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time. Calls made with a key while a call with the same key is
+    running wait for it and share its result. The call runs in the thread pool as its own task with its
+    own cancel token, so a cancelled caller does not cancel the scan the other callers wait for. The
+    scan is cancelled once every caller is gone.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = {}
+
+    async def do(self, key: Hashable, function: Callable, *args, **kwargs):
+        """
+        :param key: normalized call key, calls with equal keys must return equal results
+        :param function: blocking function
+        :param args:
+        :param kwargs:
+        :return:
+        """
+        call = self._calls.get(key)
+        if call is None:
+            token = CancelToken()
+
+            def run():
+                set_cancel_token(token)
+                return function(*args, **kwargs)
+
+            call = _Call(asyncio.ensure_future(run_in_threadpool(run)), token)
+            self._calls[key] = call
+            call.task.add_done_callback(lambda done: self._done(key, done))
+            SINGLE_FLIGHT_REQUESTS.labels("leader").inc()
+        else:
+            SINGLE_FLIGHT_REQUESTS.labels("coalesced").inc()
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if not call.waiters and not call.task.done():
+                call.token.cancel("abandoned")
+
+    def _done(self, key: Hashable, task: asyncio.Future):
+        call = self._calls.get(key)
+        if call is not None and call.task is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # marks the exception as retrieved when every caller was cancelled
+            task.exception()
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+
+@lru_cache
+def get_single_flight() -> SingleFlight:
+    return SingleFlight()
@@ -0,0 +1,241 @@
+"""
+Local terminology of the code:in and code:below searches. CodeSystem and ValueSet resources are loaded
+from the JSON and NDJSON files of a directory, single resources or Bundles of them. ValueSet expansions
+and subsumption closures are compiled into arrow arrays of "system|code" keys, the value sets of the
+vectorized is_in filters of utility.tokens, and kept in an LRU.
+"""
+import glob
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, Hashable, Iterable, List, Optional, Set
+
+import orjson
+import pyarrow as pa
+from loguru import logger
+
+
+class TerminologyError(Exception):
+    """Raised when a ValueSet or code system of a search is unknown or not supported"""
+
+
+def iter_resources(path: str) -> Iterable[Dict]:
+    """
+    :param path: JSON file of a resource or Bundle, or NDJSON file of resources
+    :return: the CodeSystem and ValueSet resources of the file
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+    resources = [orjson.loads(line) for line in data.splitlines() if line.strip()] if path.endswith(".ndjson") \
+        else [orjson.loads(data)]
+    for resource in resources:
+        if resource.get("resourceType") == "Bundle":
+            resources.extend(entry["resource"] for entry in resource.get("entry", []) if "resource" in entry)
+        elif resource.get("resourceType") in ("CodeSystem", "ValueSet"):
+            yield resource
+
+
+class CodeSystem:
+    """
+    Codes of a CodeSystem and their is-a hierarchy, from nested concepts and parent or child properties
+    """
+
+    def __init__(self, resource: Dict):
+        self.url = resource["url"]
+        self.codes: Set[str] = set()
+        self.children: Dict[str, List[str]] = {}
+        self.add_concepts(resource.get("concept", []), None)
+
+    def add_concepts(self, concepts: List[Dict], parent: Optional[str]):
+        for concept in concepts:
+            code = concept["code"]
+            self.codes.add(code)
+            if parent is not None:
+                self.children.setdefault(parent, []).append(code)
+            for concept_property in concept.get("property", []):
+                if concept_property.get("code") == "parent" and "valueCode" in concept_property:
+                    self.children.setdefault(concept_property["valueCode"], []).append(code)
+                elif concept_property.get("code") == "child" and "valueCode" in concept_property:
+                    self.children.setdefault(code, []).append(concept_property["valueCode"])
+            self.add_concepts(concept.get("concept", []), code)
+
+    def get_descendants(self, code: str) -> Set[str]:
+        """
+        :param code:
+        :return: the code and the codes below it, the hierarchy may have several parents per code
+        """
+        descendants, stack = {code}, [code]
+        while stack:
+            for child in self.children.get(stack.pop(), []):
+                if child not in descendants:
+                    descendants.add(child)
+                    stack.append(child)
+        return descendants
+
+
+class Terminology:
+    """
+    Code systems and ValueSets of a terminology directory
+
+    Args:
+        resources (Iterable[Dict]): CodeSystem and ValueSet resources
+
+        cache_size (int): Expansions and closures kept in the LRU
+    """
+
+    def __init__(self, resources: Iterable[Dict], cache_size: int = 1024):
+        self.code_systems: Dict[str, CodeSystem] = {}
+        self.value_sets: Dict[str, Dict] = {}
+        for resource in resources:
+            if resource["resourceType"] == "CodeSystem" and "url" in resource:
+                self.code_systems[resource["url"]] = CodeSystem(resource)
+            elif resource["resourceType"] == "ValueSet":
+                if "url" in resource:
+                    self.value_sets[resource["url"]] = resource
+                    if "version" in resource:
+                        self.value_sets[f"{resource['url']}|{resource['version']}"] = resource
+                if "id" in resource:
+                    self.value_sets[f"ValueSet/{resource['id']}"] = resource
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[Hashable, pa.Array]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_cached(self, key: Hashable, compute) -> pa.Array:
+        with self._lock:
+            keys = self._cache.get(key)
+            if keys is not None:
+                self._cache.move_to_end(key)
+                return keys
+        keys = pa.array(sorted(compute()), pa.string())
+        with self._lock:
+            self._cache[key] = keys
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return keys
+
+    def precompute(self):
+        """
+        Expands the ValueSets up to the size of the LRU, so the first searches find their expansions
+        """
+        for url in [url for url, value_set in self.value_sets.items() if url == value_set.get("url")][
+                :self.cache_size]:
+            try:
+                self.expand(url)
+            except TerminologyError as e:
+                logger.warning(f'ValueSet {url} not expanded: {e}')
+
+    def get_code_system(self, url: str) -> CodeSystem:
+        code_system = self.code_systems.get(url)
+        if code_system is None:
+            raise TerminologyError(f"CodeSystem {url} not found")
+        return code_system
+
+    def expand(self, url: str) -> pa.Array:
+        """
+        :param url: ValueSet url, url|version or ValueSet/id
+        :return: "system|code" keys of the expansion
+        """
+        return self.get_cached(("in", url), lambda: self.get_expansion(url, ()))
+
+    def below(self, token: str) -> pa.Array:
+        """
+        :param token: "system|code", or "code" in every code system having it
+        :return: "system|code" keys of the code and its descendants
+        """
+        system, separator, code = token.rpartition("|")
+        code_systems = [self.get_code_system(system)] if separator else \
+            [code_system for code_system in self.code_systems.values() if code in code_system.codes]
+        return self.get_cached(("below", token), lambda: {
+            f"{code_system.url}|{descendant}" for code_system in code_systems
+            for descendant in code_system.get_descendants(code)})
+
+    def get_expansion(self, url: str, seen: tuple) -> Set[str]:
+        """
+        :param url:
+        :param seen: urls of the ValueSets including this one, a ValueSet including itself is an error
+        :return: "system|code" keys of the ValueSet, from its expansion or else from its compose
+        """
+        value_set = self.value_sets.get(url)
+        if value_set is None:
+            raise TerminologyError(f"ValueSet {url} not found")
+        if url in seen:
+            raise TerminologyError(f"ValueSet {url} includes itself")
+        contains = (value_set.get("expansion") or {}).get("contains")
+        if contains:
+            return set(self.iter_contains(contains))
+        compose = value_set.get("compose") or {}
+        keys = set()
+        for include in compose.get("include", []):
+            keys |= self.get_include(include, seen + (url,))
+        for exclude in compose.get("exclude", []):
+            keys -= self.get_include(exclude, seen + (url,))
+        return keys
+
+    def iter_contains(self, contains: List[Dict]) -> Iterable[str]:
+        for item in contains:
+            if "code" in item and not item.get("abstract"):
+                yield f"{item.get('system')}|{item['code']}"
+            yield from self.iter_contains(item.get("contains", []))
+
+    def get_include(self, include: Dict, seen: tuple) -> Set[str]:
+        """
+        :param include: include or exclude of a ValueSet compose
+        :param seen:
+        :return: "system|code" keys of the codes of its system that are in all of its ValueSets
+        """
+        sets = [self.get_expansion(url, seen) for url in include.get("valueSet", [])]
+        system = include.get("system")
+        if system and include.get("concept"):
+            sets.append({f"{system}|{concept['code']}" for concept in include["concept"]})
+        elif system:
+            code_system = self.get_code_system(system)
+            codes = set(code_system.codes)
+            for concept_filter in include.get("filter", []):
+                codes &= self.get_filter_codes(code_system, concept_filter)
+            sets.append({f"{system}|{code}" for code in codes})
+        return set.intersection(*sets) if sets else set()
+
+    @staticmethod
+    def get_filter_codes(code_system: CodeSystem, concept_filter: Dict) -> Set[str]:
+        """
+        :param code_system:
+        :param concept_filter: filter of a ValueSet include, on the concept property
+        :return: the codes of the code system matching the filter
+        """
+        op, value = concept_filter.get("op"), concept_filter.get("value", "")
+        if concept_filter.get("property") != "concept":
+            raise TerminologyError(f"Filters on {concept_filter.get('property')} are not supported")
+        if op == "is-a":
+            return code_system.get_descendants(value)
+        if op == "descendent-of":
+            return code_system.get_descendants(value) - {value}
+        if op == "=":
+            return {value}
+        if op == "in":
+            return set(value.split(","))
+        if op == "is-not-a":
+            return code_system.codes - code_system.get_descendants(value)
+        raise TerminologyError(f"Filter op {op} is not supported")
+
+
+@lru_cache
+def get_terminology(terminology_dir: str, cache_size: int = 1024) -> Terminology:
+    """
+    :param terminology_dir: directory of the CodeSystem and ValueSet files, read once
+    :param cache_size:
+    :return:
+    """
+    paths = sorted(glob.glob(os.path.join(terminology_dir, "**", "*.json"), recursive=True) +
+                   glob.glob(os.path.join(terminology_dir, "**", "*.ndjson"), recursive=True))
+    resources = []
+    for path in paths:
+        try:
+            resources.extend(iter_resources(path))
+        except (OSError, ValueError) as e:
+            logger.warning(f'Terminology file {path} skipped: {e}')
+    terminology = Terminology(resources, cache_size)
+    terminology.precompute()
+    logger.info(f'Loaded {len(terminology.code_systems)} code systems and {len(resources)} terminology resources '
+                f'from {terminology_dir}')
+    return terminology
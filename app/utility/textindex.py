@@ -0,0 +1,442 @@
+"""
+Inverted index of the _text and _content searches. _text matches the narrative of the resources, _content
+their whole content with the text attachments of DocumentReference and DiagnosticReport, ranked with BM25.
+
+The index of a delta table is a list of immutable segments stored as sidecar numpy files in a local
+directory, every segment indexes the files added by a range of commits. New commits add a segment, built
+in a background thread while the searches read the segments already written. Past max_segments the
+segments are merged in one from their postings. Postings of files removed by a later commit are skipped
+at query time and dropped by the merges, the segments are memory mapped.
+"""
+import base64
+import binascii
+import html
+import json
+import math
+import os
+import re
+import shutil
+import threading
+import uuid
+from collections import Counter as TermCounter
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import orjson
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from deltalake import DeltaTable
+from loguru import logger
+from prometheus_client import Counter
+
+from .changes import read_commit
+from .hashring import get_hash
+from .rawjson import RESOURCE_JSON
+from .writer import PARTITION_COLUMN, get_partition_files
+
+class TextIndexNotReady(Exception):
+    """Raised by the searches of a table whose text index is built for the first time"""
+
+
+TEXT_INDEX_DOCUMENTS = Counter(
+    "fhir_text_index_documents_total", "Resources indexed for _text and _content", ["kind"])
+
+# index fields, the terms of a field are hashed with its prefix
+TEXT, CONTENT = 0, 1
+FIELD_PREFIXES = ("t:", "c:")
+# BM25 parameters
+K1, B = 1.2, 0.75
+
+MANIFEST = "manifest.json"
+TOKEN_PATTERN = re.compile(r"\w+")
+TAG_PATTERN = re.compile(r"<[^>]+>")
+# string elements that are identifiers rather than content
+SKIPPED_KEYS = {"id", "resourceType", "reference", "system", "url", "fullUrl", PARTITION_COLUMN, RESOURCE_JSON}
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.casefold())
+
+
+def get_narrative(resource: Dict) -> str:
+    """
+    :param resource:
+    :return: the text of the narrative div, without its markup
+    """
+    narrative = resource.get("text")
+    div = narrative.get("div") if isinstance(narrative, dict) else None
+    return html.unescape(TAG_PATTERN.sub(" ", div)) if div else ""
+
+
+def get_attachment_text(attachment: Dict) -> str:
+    """
+    :param attachment: FHIR Attachment
+    :return: the decoded data of text attachments, empty for the other content types
+    """
+    data = attachment.get("data")
+    if not data or not str(attachment.get("contentType") or "").startswith("text/"):
+        return ""
+    try:
+        data = base64.b64decode(data) if isinstance(data, str) else data
+        return data.decode("utf-8", errors="replace")
+    except (binascii.Error, ValueError):
+        return ""
+
+
+def iter_content(value) -> Iterable[str]:
+    """
+    :param value: resource or element
+    :return: the strings of the element, attachments decoded and narratives without their markup
+    """
+    if isinstance(value, dict):
+        if "contentType" in value and "data" in value:
+            yield get_attachment_text(value)
+        for name, item in value.items():
+            if name in SKIPPED_KEYS or name == "data":
+                continue
+            if name == "div" and isinstance(item, str):
+                yield html.unescape(TAG_PATTERN.sub(" ", item))
+            else:
+                yield from iter_content(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from iter_content(item)
+    elif isinstance(value, str):
+        yield value
+
+
+def read_documents(table_path: str, path: str) -> Iterable[Tuple[str, List[str], List[str]]]:
+    """
+    :param table_path:
+    :param path: data file of the table, relative to it
+    :return: id, narrative terms and content terms of every resource of the file
+    """
+    table = pq.read_table(os.path.join(table_path, path))
+    raw = table.column(RESOURCE_JSON).to_pylist() if RESOURCE_JSON in table.schema.names else None
+    for index, row in enumerate(table.drop([RESOURCE_JSON]).to_pylist() if raw else table.to_pylist()):
+        resource = orjson.loads(raw[index]) if raw and raw[index] else row
+        yield str(row.get("id")), tokenize(get_narrative(resource)), tokenize(" ".join(iter_content(resource)))
+
+
+def write_segment(segment_path: str, table_path: str, files: List[Tuple[str, str]]) -> int:
+    """
+    Indexes data files into a new segment
+
+    :param segment_path: directory of the segment, see save_segment
+    :param table_path:
+    :param files: path and patient partition of the files
+    :return: number of indexed resources
+    """
+    ids, patients, doc_files, lengths = [], [], [], []
+    terms, docs, freqs = [], [], []
+    for path, patient_id in files:
+        for resource_id, *fields in read_documents(table_path, path):
+            doc = len(ids)
+            ids.append(resource_id)
+            patients.append(patient_id)
+            doc_files.append(path)
+            lengths.append([len(tokens) for tokens in fields])
+            for prefix, tokens in zip(FIELD_PREFIXES, fields):
+                for term, freq in TermCounter(tokens).items():
+                    terms.append(get_hash(prefix + term))
+                    docs.append(doc)
+                    freqs.append(freq)
+    documents = pa.table({
+        "id": pa.array(ids, pa.string()),
+        "patient": pa.array(patients, pa.string()),
+        "file": pa.array(doc_files, pa.string()),
+    })
+    save_segment(segment_path, documents, np.array(lengths, dtype=np.int32).reshape(-1, 2),
+                 np.array(terms, dtype=np.uint64), np.array(docs, dtype=np.int32), np.array(freqs, dtype=np.int32))
+    return len(ids)
+
+
+def merge_segments(segment_path: str, paths: List[str], files: pa.Array) -> int:
+    """
+    Merges segments in a new one from their postings, without reading the data files again. The documents
+    of files that are no longer in the table are dropped.
+
+    :param segment_path: directory of the merged segment, see save_segment
+    :param paths: directories of the segments
+    :param files: data files of the table
+    :return: number of documents of the merged segment
+    """
+    documents, lengths, terms, docs, freqs = [], [], [], [], []
+    count = 0
+    for path in paths:
+        segment = load_segment(path)
+        live = segment.get_live_mask(files)
+        # doc numbers of the live documents in the merged segment
+        renumbered = np.cumsum(live, dtype=np.int64) - 1 + count
+        keep = live[segment.docs]
+        terms.append(np.repeat(np.asarray(segment.terms), np.diff(segment.offsets))[keep])
+        docs.append(renumbered[segment.docs[keep]].astype(np.int32))
+        freqs.append(np.asarray(segment.freqs)[keep])
+        documents.append(segment.documents.filter(pa.array(live)))
+        lengths.append(np.asarray(segment.lengths)[live])
+        count += int(live.sum())
+    save_segment(segment_path, pa.concat_tables(documents), np.concatenate(lengths).reshape(-1, 2),
+                 np.concatenate(terms), np.concatenate(docs), np.concatenate(freqs))
+    return count
+
+
+def save_segment(segment_path: str, documents: pa.Table, lengths: np.ndarray, terms: np.ndarray, docs: np.ndarray,
+                 freqs: np.ndarray):
+    """
+    Sorts the postings by term and doc and writes the segment
+
+    :param segment_path: directory of the segment, written under a temporary name and renamed
+    :param documents: id, patient and data file of every doc
+    :param lengths: narrative and content terms of every doc
+    :param terms: term hash of every posting
+    :param docs:
+    :param freqs:
+    """
+    order = np.lexsort((docs, terms))
+    terms, docs, freqs = terms[order], docs[order], freqs[order]
+    unique_terms, starts = np.unique(terms, return_index=True)
+
+    temp_path = f"{segment_path}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(temp_path)
+    np.save(os.path.join(temp_path, "terms.npy"), unique_terms)
+    np.save(os.path.join(temp_path, "offsets.npy"), np.append(starts, len(terms)).astype(np.int64))
+    np.save(os.path.join(temp_path, "docs.npy"), docs)
+    np.save(os.path.join(temp_path, "freqs.npy"), freqs)
+    np.save(os.path.join(temp_path, "lengths.npy"), lengths)
+    pq.write_table(documents, os.path.join(temp_path, "documents.parquet"))
+    try:
+        os.rename(temp_path, segment_path)
+    except OSError:
+        # another worker wrote the same segment
+        shutil.rmtree(temp_path, ignore_errors=True)
+
+
+class Segment:
+    """
+    Memory mapped segment, the postings of a term are the docs and freqs between its offsets
+    """
+
+    def __init__(self, path: str):
+        self.terms = np.load(os.path.join(path, "terms.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.docs = np.load(os.path.join(path, "docs.npy"), mmap_mode="r")
+        self.freqs = np.load(os.path.join(path, "freqs.npy"), mmap_mode="r")
+        self.lengths = np.load(os.path.join(path, "lengths.npy"), mmap_mode="r")
+        self.documents = pq.read_table(os.path.join(path, "documents.parquet"), memory_map=True)
+
+    def get_postings(self, term: int) -> Tuple[np.ndarray, np.ndarray]:
+        index = np.searchsorted(self.terms, np.uint64(term))
+        if index == len(self.terms) or self.terms[index] != term:
+            return np.empty(0, np.int32), np.empty(0, np.int32)
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.docs[start:end], self.freqs[start:end]
+
+    def get_live_mask(self, files: pa.Array) -> np.ndarray:
+        return pc.is_in(self.documents.column("file"), value_set=files).to_numpy(zero_copy_only=False)
+
+
+@lru_cache(maxsize=1024)
+def load_segment(path: str) -> Segment:
+    return Segment(path)
+
+
+class TextIndex:
+    """
+    Text index of a delta table
+
+    Args:
+        index_path (str): Directory of the segments and their manifest
+
+        table_path (str): Local path of the delta table
+
+        max_segments (int): Segments before the index is merged in one
+    """
+
+    def __init__(self, index_path: str, table_path: str, max_segments: int = 8):
+        self.index_path = index_path
+        self.table_path = table_path
+        self.max_segments = max_segments
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._refresh_thread: Optional[threading.Thread] = None
+        self._wanted_version = -1
+
+    def read_manifest(self) -> Optional[Dict]:
+        try:
+            with open(os.path.join(self.index_path, MANIFEST), "rb") as file:
+                return orjson.loads(file.read())
+        except FileNotFoundError:
+            return None
+
+    def write_manifest(self, manifest: Dict):
+        temp_path = os.path.join(self.index_path, f"{MANIFEST}.{uuid.uuid4().hex}.tmp")
+        with open(temp_path, "w") as file:
+            json.dump(manifest, file)
+        os.replace(temp_path, os.path.join(self.index_path, MANIFEST))
+
+    def get_added_files(self, start_version: int, end_version: int) -> List[Tuple[str, str]]:
+        """
+        :param start_version: exclusive
+        :param end_version: inclusive
+        :return: path and patient partition of the files added by the commits, compacted files included
+        """
+        files = []
+        for version in range(start_version + 1, end_version + 1):
+            for action in read_commit(self.table_path, version):
+                add = action.get("add")
+                if add is not None:
+                    files.append((add["path"], (add.get("partitionValues") or {}).get(PARTITION_COLUMN)))
+        return files
+
+    def update(self, delta_table: DeltaTable) -> Dict:
+        """
+        Indexes the commits up to the version of the table handle
+
+        :param delta_table:
+        :return: the manifest of the index
+        """
+        version = delta_table.version()
+        manifest = self.read_manifest()
+        if manifest is not None and manifest["version"] >= version:
+            return manifest
+        with self._lock:
+            manifest = self.read_manifest()
+            if manifest is not None and manifest["version"] >= version:
+                return manifest
+            os.makedirs(self.index_path, exist_ok=True)
+            files = None
+            if manifest is not None:
+                try:
+                    files = self.get_added_files(manifest["version"], version)
+                except FileNotFoundError:
+                    # commits before the last checkpoint may be cleaned up
+                    files = None
+            if files is not None:
+                kind, name = "incremental", f"{manifest['version'] + 1:020d}-{version:020d}"
+                segments = manifest["segments"] + [name]
+            else:
+                files = [(path, patient_id) for patient_id, partition in get_partition_files(delta_table).items()
+                         for path, _ in partition]
+                kind, name = "rebuild", f"full-{version:020d}"
+                segments = [name]
+            count = write_segment(os.path.join(self.index_path, name), self.table_path, files)
+            TEXT_INDEX_DOCUMENTS.labels(kind).inc(count)
+            if len(segments) > self.max_segments:
+                name = f"merged-{version:020d}"
+                merge_segments(os.path.join(self.index_path, name),
+                               [os.path.join(self.index_path, segment) for segment in segments],
+                               pa.array(delta_table.files(), pa.string()))
+                segments = [name]
+            manifest = {"version": version, "segments": segments}
+            self.write_manifest(manifest)
+            if len(segments) == 1:
+                for entry in os.scandir(self.index_path):
+                    if entry.is_dir() and entry.name not in segments and not entry.name.endswith(".tmp"):
+                        shutil.rmtree(entry.path, ignore_errors=True)
+            return manifest
+
+    def refresh(self, version: int) -> threading.Thread:
+        """
+        Indexes the commits up to version in a background thread, one thread per index at a time
+
+        :param version: version of the table to index
+        :return: the thread
+        """
+        with self._refresh_lock:
+            self._wanted_version = max(self._wanted_version, version)
+            if self._refresh_thread is None or not self._refresh_thread.is_alive():
+                self._refresh_thread = threading.Thread(
+                    target=self._refresh, name=f"text-index-{os.path.basename(self.index_path)}", daemon=True)
+                self._refresh_thread.start()
+            return self._refresh_thread
+
+    def _refresh(self):
+        try:
+            while True:
+                # a handle of its own, the handles of the requests move to other versions meanwhile
+                manifest = self.update(DeltaTable(self.table_path))
+                with self._refresh_lock:
+                    if manifest["version"] >= self._wanted_version:
+                        return
+        except Exception:
+            logger.exception(f'Text index of {self.table_path} not updated')
+
+    def search(self, delta_table: DeltaTable, field: int, query: str,
+               patient_id: Optional[str] = None, wait: float = 0.0) -> Dict[str, float]:
+        """
+        Finds the resources having every term of the query in the field. When the index is behind the table
+        version, it is refreshed in the background and the search waits for it at most wait seconds, then
+        searches the commits indexed so far.
+
+        :param delta_table: handle of the table version searched
+        :param field: TEXT or CONTENT
+        :param query: _text or _content value
+        :param patient_id: only the resources of this patient partition
+        :param wait: seconds the search waits for the refresh
+        :return: BM25 score of the matching resource ids, raises TextIndexNotReady while the first build of
+        the index runs
+        """
+        terms = [get_hash(FIELD_PREFIXES[field] + term) for term in dict.fromkeys(tokenize(query))]
+        if not terms:
+            return {}
+        manifest = self.read_manifest()
+        if manifest is None or manifest["version"] < delta_table.version():
+            self.refresh(delta_table.version()).join(wait)
+            manifest = self.read_manifest()
+        if manifest is None:
+            raise TextIndexNotReady(f"The text index of {os.path.basename(self.table_path)} is being built")
+        files = pa.array(delta_table.files(), pa.string())
+        try:
+            return self.get_scores(manifest, files, field, terms, patient_id)
+        except FileNotFoundError:
+            # a rebuild of another worker removed the segments of the manifest
+            return self.get_scores(self.read_manifest(), files, field, terms, patient_id)
+
+    def get_scores(self, manifest: Dict, files: pa.Array, field: int, terms: List[int],
+                   patient_id: Optional[str]) -> Dict[str, float]:
+        # collection statistics are taken over the live resources of all the partitions
+        segments, total_docs, total_length, frequencies = [], 0, 0, np.zeros(len(terms))
+        for name in manifest["segments"]:
+            segment = load_segment(os.path.join(self.index_path, name))
+            live = segment.get_live_mask(files)
+            postings = []
+            for index, term in enumerate(terms):
+                docs, freqs = segment.get_postings(term)
+                keep = live[docs]
+                docs, freqs = docs[keep], freqs[keep]
+                frequencies[index] += len(docs)
+                postings.append((docs, freqs))
+            total_docs += int(live.sum())
+            total_length += int(segment.lengths[live, field].sum())
+            segments.append((segment, postings))
+        if not total_docs or not frequencies.all():
+            return {}
+        average_length = total_length / total_docs
+        idf = [math.log(1 + (total_docs - frequency + 0.5) / (frequency + 0.5)) for frequency in frequencies]
+
+        scores: Dict[str, float] = {}
+        for segment, postings in segments:
+            # docs holding every term, postings are sorted by doc
+            matches = postings[0][0]
+            for docs, _ in postings[1:]:
+                matches = np.intersect1d(matches, docs, assume_unique=True)
+            if patient_id is not None and len(matches):
+                patients = segment.documents.column("patient").take(pa.array(matches)).to_numpy(zero_copy_only=False)
+                matches = matches[patients == patient_id]
+            if not len(matches):
+                continue
+            lengths = segment.lengths[matches, field]
+            score = np.zeros(len(matches))
+            for weight, (docs, freqs) in zip(idf, postings):
+                freq = freqs[np.searchsorted(docs, matches)]
+                score += weight * freq * (K1 + 1) / (freq + K1 * (1 - B + B * lengths / average_length))
+            for resource_id, value in zip(segment.documents.column("id").take(pa.array(matches)).to_pylist(), score):
+                scores[resource_id] = max(value, scores.get(resource_id, 0.0))
+        return scores
+
+
+@lru_cache(maxsize=None)
+def get_text_index(index_dir: str, table_path: str, max_segments: int = 8) -> TextIndex:
+    return TextIndex(os.path.join(index_dir, f"{get_hash(table_path):016x}"), table_path, max_segments)
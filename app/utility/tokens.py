@@ -0,0 +1,108 @@
+"""
+Vectorized token search over CodeableConcept columns
+"""
+from typing import Iterable, Optional, Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+def _field(array: pa.Array, name: str):
+    index = array.type.get_field_index(name)
+    return pc.struct_field(array, [index]) if index >= 0 else None
+
+
+def get_codings(table: pa.Table, element: str) -> Optional[Tuple[pa.Array, np.ndarray]]:
+    """
+    :param table:
+    :param element: CodeableConcept, or list of CodeableConcept, column
+    :return: the codings of the column and the row of every coding, None when the column has no codings
+    """
+    if element not in table.schema.names or table.num_rows == 0:
+        return None
+    column = table.column(element).combine_chunks()
+    concept_parents = None
+    if pa.types.is_list(column.type) or pa.types.is_large_list(column.type):
+        concept_parents = pc.list_parent_indices(column).to_numpy()
+        column = pc.list_flatten(column)
+    if not pa.types.is_struct(column.type):
+        return None
+    coding = _field(column, "coding")
+    if coding is None:
+        return None
+    rows = pc.list_parent_indices(coding).to_numpy()
+    if concept_parents is not None:
+        rows = concept_parents[rows]
+    return pc.list_flatten(coding), rows
+
+
+def get_coding_mask(table: pa.Table, element: str, tokens: Iterable[str]) -> pa.Array:
+    """
+    Matches the codings of a CodeableConcept, or list of CodeableConcept, column against token values
+
+    :param table:
+    :param element: ex: code, category
+    :param tokens: "code", "system|code" or "system|" values
+    :return: boolean mask of the rows having at least one matching coding
+    """
+    mask = np.zeros(table.num_rows, dtype=bool)
+    codings = get_codings(table, element)
+    if codings is None:
+        return pa.array(mask)
+    codings, rows = codings
+    codes, systems, system_codes = set(), set(), set()
+    for token in tokens:
+        system, separator, code = token.rpartition("|")
+        if not separator:
+            codes.add(code)
+        elif code:
+            system_codes.add(token)
+        else:
+            systems.add(system)
+    code, system = _field(codings, "code"), _field(codings, "system")
+
+    matches = np.zeros(len(codings), dtype=bool)
+    if code is not None and codes:
+        matches |= pc.fill_null(pc.is_in(code, value_set=pa.array(list(codes), code.type)), False).to_numpy(
+            zero_copy_only=False)
+    if system is not None and systems:
+        matches |= pc.fill_null(pc.is_in(system, value_set=pa.array(list(systems), system.type)), False).to_numpy(
+            zero_copy_only=False)
+    if system_codes:
+        matches |= get_system_code_matches(codings, pa.array(list(system_codes), pa.string()))
+
+    mask[rows[matches]] = True
+    return pa.array(mask)
+
+
+def get_system_code_matches(codings: pa.Array, keys: pa.Array) -> np.ndarray:
+    """
+    :param codings: Coding values
+    :param keys: "system|code" values
+    :return: boolean mask of the codings matching a key
+    """
+    code, system = _field(codings, "code"), _field(codings, "system")
+    if code is None or system is None:
+        return np.zeros(len(codings), dtype=bool)
+    codings_keys = pc.binary_join_element_wise(system, code, "|")
+    return pc.fill_null(pc.is_in(codings_keys, value_set=keys.cast(codings_keys.type)), False).to_numpy(
+        zero_copy_only=False)
+
+
+def get_value_set_mask(table: pa.Table, element: str, keys: pa.Array) -> pa.Array:
+    """
+    Matches the codings of a CodeableConcept column against a ValueSet expansion or a subsumption closure
+
+    :param table:
+    :param element: ex: code
+    :param keys: "system|code" values, see utility.terminology
+    :return: boolean mask of the rows having at least one coding in the keys
+    """
+    mask = np.zeros(table.num_rows, dtype=bool)
+    codings = get_codings(table, element)
+    if codings is None or not len(keys):
+        return pa.array(mask)
+    codings, rows = codings
+    mask[rows[get_system_code_matches(codings, keys)]] = True
+    return pa.array(mask)
@@ -0,0 +1,214 @@
+"""
+_sort executed as a bounded top-k over the scan
+"""
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+from .cancellation import get_cancel_token, check_batches
+from .memory import get_memory_budget, get_memory_pool, check_budget
+
+# date element sorted by _sort=date, per resource type
+DATE_ELEMENTS = {
+    "observation": "effectiveDateTime",
+    "diagnosticreport": "effectiveDateTime",
+    "condition": "recordedDate",
+    "allergyintolerance": "recordedDate",
+    "encounter": "period.start",
+    "episodeofcare": "period.start",
+    "careplan": "period.start",
+    "medicationrequest": "authoredOn",
+    "servicerequest": "authoredOn",
+    "documentreference": "date",
+    "procedure": "performedDateTime",
+    "immunization": "occurrenceDateTime",
+    "medicationadministration": "effectiveDateTime",
+    "medicationstatement": "effectiveDateTime",
+    "medicationdispense": "whenHandedOver",
+    "communication": "sent",
+    "claim": "created",
+    "coverage": "period.start",
+}
+DEFAULT_DATE_ELEMENT = "meta.lastUpdated"
+
+# element paths of the sort parameters, list elements along a path resolve to their first item
+SORT_ELEMENTS = {
+    "code": "code.coding.code",
+    "status": "status",
+}
+
+
+def parse_sort(resource_type: str, sort: str) -> List[Tuple[str, str]]:
+    """
+    :param resource_type:
+    :param sort: _sort value, ex: -date,code
+    :return: element path and order of every sort key
+    """
+    keys = []
+    for name in sort.split(","):
+        name = name.strip()
+        order = "descending" if name.startswith("-") else "ascending"
+        name = name.lstrip("-")
+        if name == "date":
+            keys.append((DATE_ELEMENTS.get(resource_type.lower(), DEFAULT_DATE_ELEMENT), order))
+        elif name in SORT_ELEMENTS:
+            keys.append((SORT_ELEMENTS[name], order))
+    return keys
+
+
+def _first_item(column: pa.Array) -> pa.Array:
+    parents = pc.list_parent_indices(column).to_numpy()
+    items = pc.list_flatten(column)
+    rows, first = np.unique(parents, return_index=True)
+    indices = np.zeros(len(column), dtype=np.int64)
+    indices[rows] = first
+    mask = np.ones(len(column), dtype=bool)
+    mask[rows] = False
+    return items.take(pa.array(indices, mask=mask))
+
+
+def get_key_column(table: pa.Table, path: str) -> pa.Array:
+    """
+    :param table:
+    :param path: dotted element path
+    :return: the values of the element, null where it is missing
+    """
+    names = path.split(".")
+    if names[0] not in table.schema.names:
+        return pa.nulls(table.num_rows)
+    column = table.column(names[0]).combine_chunks()
+    for name in names[1:]:
+        if pa.types.is_list(column.type) or pa.types.is_large_list(column.type):
+            column = _first_item(column)
+        if not pa.types.is_struct(column.type) or column.type.get_field_index(name) < 0:
+            return pa.nulls(table.num_rows)
+        column = pc.struct_field(column, [column.type.get_field_index(name)])
+    if pa.types.is_list(column.type) or pa.types.is_large_list(column.type):
+        column = _first_item(column)
+    return column
+
+
+def top_k(table: pa.Table, keys: List[Tuple[str, str]], k: Optional[int]) -> pa.Table:
+    """
+    :param table:
+    :param keys: element path and order of every sort key
+    :param k: number of rows to keep, None sorts the whole table
+    :return: the first k rows in sort order, missing values sort last and ties are ordered by id, so pages
+    of equal keys neither repeat nor skip rows
+    """
+    key_table = pa.table({f"key_{index}": get_key_column(table, path) for index, (path, _) in enumerate(keys)})
+    # a key missing from every row does not order them, the kernels do not take null columns
+    sort_keys = [(f"key_{index}", order) for index, (_, order) in enumerate(keys)
+                 if not pa.types.is_null(key_table.column(f"key_{index}").type)]
+    if "id" in table.schema.names:
+        key_table = key_table.append_column("id", table.column("id"))
+        sort_keys.append(("id", "ascending"))
+    if not sort_keys:
+        return table if k is None else table.slice(0, k)
+    if k is None or k >= table.num_rows:
+        return table.take(pc.sort_indices(key_table, sort_keys=sort_keys, null_placement="at_end"))
+    indices = pc.select_k_unstable(key_table, k=k, sort_keys=sort_keys)
+    order = pc.sort_indices(key_table.take(indices), sort_keys=sort_keys, null_placement="at_end")
+    return table.take(indices.take(order))
+
+
+def get_statistics_path(schema: pa.Schema, path: str) -> Optional[str]:
+    """
+    :param schema:
+    :param path:
+    :return: the parquet column path of a sort key that has row group statistics, nested in structs only
+    """
+    names = path.split(".")
+    if names[0] not in schema.names:
+        return None
+    field_type = schema.field(names[0]).type
+    for name in names[1:]:
+        if not pa.types.is_struct(field_type) or field_type.get_field_index(name) < 0:
+            return None
+        field_type = field_type[field_type.get_field_index(name)].type
+    if pa.types.is_nested(field_type):
+        return None
+    return path
+
+
+def _get_row_groups(dataset: ds.Dataset, column_path: str, descending: bool):
+    """
+    Lists the row groups of the dataset with the best key value they can hold, in the order they can
+    enter the top k. Row groups without statistics come first, they are always read.
+    """
+    row_groups, total = [], 0
+    for fragment in dataset.get_fragments():
+        metadata = fragment.metadata
+        column_index = next(
+            (index for index in range(metadata.num_columns) if metadata.schema.column(index).path == column_path),
+            None)
+        for row_group in range(metadata.num_row_groups):
+            row_group_metadata = metadata.row_group(row_group)
+            total += row_group_metadata.num_rows
+            statistics = row_group_metadata.column(column_index).statistics if column_index is not None else None
+            best = None
+            if statistics is not None and statistics.has_min_max:
+                best = statistics.max if descending else statistics.min
+            row_groups.append((best, fragment, row_group))
+    known = [row_group for row_group in row_groups if row_group[0] is not None]
+    try:
+        known.sort(key=lambda row_group: row_group[0], reverse=descending)
+    except TypeError:
+        return row_groups, total
+    return [row_group for row_group in row_groups if row_group[0] is None] + known, total
+
+
+def scan_top_k(dataset: ds.Dataset, keys: List[Tuple[str, str]], k: Optional[int],
+               filter_expression: pc.Expression = None) -> Tuple[Optional[pa.Table], int]:
+    """
+    Keeps the top k rows while scanning the dataset, memory is bounded by k rows plus one batch.
+    With a single sort key on a primitive element, row groups are read in the order of their min/max
+    statistics and the scan stops at the first row group that can not hold a row of the top k.
+
+    :param dataset:
+    :param keys:
+    :param k:
+    :param filter_expression:
+    :return: the sorted top k rows and the number of rows in the dataset, after the filter
+    """
+    result = None
+    column_path = get_statistics_path(dataset.schema, keys[0][0]) if len(keys) == 1 else None
+    if k is None or column_path is None or filter_expression is not None:
+        total, tables = 0, []
+        batches = dataset.to_batches(filter=filter_expression, memory_pool=get_memory_pool())
+        for batch in check_budget(check_batches(batches)):
+            total += batch.num_rows
+            batch_table = pa.Table.from_batches([batch])
+            if k is None:
+                # the whole dataset is sorted, once all of it is read
+                tables.append(batch_table)
+            else:
+                result = top_k(batch_table if result is None else pa.concat_tables([result, batch_table]), keys, k)
+        if tables:
+            result = top_k(pa.concat_tables(tables), keys, None)
+        return result, total
+
+    descending = keys[0][1] == "descending"
+    row_groups, total = _get_row_groups(dataset, column_path, descending)
+    token, budget = get_cancel_token(), get_memory_budget()
+    for best, fragment, row_group in row_groups:
+        if token is not None:
+            token.check()
+        if budget is not None:
+            budget.check()
+        if result is not None and result.num_rows >= k and best is not None:
+            kth = get_key_column(result.slice(k - 1, 1), keys[0][0])[0].as_py()
+            try:
+                if kth is not None and (best < kth if descending else best > kth):
+                    break
+            except TypeError:
+                pass
+        row_group_table = fragment.format.make_fragment(
+            fragment.path, fragment.filesystem, partition_expression=fragment.partition_expression,
+            row_groups=[row_group]).to_table(schema=dataset.schema, memory_pool=get_memory_pool())
+        result = top_k(
+            row_group_table if result is None else pa.concat_tables([result, row_group_table]), keys, k)
+    return result, total
@@ -0,0 +1,499 @@
+"""
+Write path, resources buffered and group committed into the patient partitioned delta tables
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from deltalake import DeltaTable, PyDeltaTableError, write_deltalake
+from deltalake.writer import DeltaJSONEncoder, get_file_stats_from_metadata
+from loguru import logger
+from prometheus_client import Counter, Histogram
+from starlette.concurrency import run_in_threadpool
+
+from .changes import CHANGE_TYPE, get_commit_path, read_commit
+from .parquetio import get_local_path
+from .rawjson import RESOURCE_JSON, has_resource_json, get_json_value
+
+PARTITION_COLUMN = "yy__patient_id"
+
+WRITE_COMMITS = Counter("fhir_write_commits_total", "Delta commits of the write path", ["mode", "result"])
+WRITE_BATCH_ROWS = Histogram(
+    "fhir_write_batch_rows", "Rows group committed in one flush", buckets=(1, 2, 5, 10, 50, 100, 500, 1000, 5000))
+
+
+# commits between checkpoints, when the table does not set delta.checkpointInterval
+CHECKPOINT_INTERVAL = 10
+
+
+class WriteConflict(Exception):
+    """Raised when a partition kept changing under an upsert for every retry"""
+
+
+class UnknownElements(ValueError):
+    """Raised when resources have elements that are not columns or fields of their table"""
+
+    def __init__(self, elements: List[str]):
+        super().__init__(f"Elements not in the table schema: {', '.join(elements)}")
+        self.elements = elements
+
+
+def get_resource_patient(resource: Dict) -> Optional[str]:
+    """
+    :param resource: FHIR resource
+    :return: id of the patient the resource belongs to, its partition column or its subject, patient or
+    beneficiary reference
+    """
+    if resource.get(PARTITION_COLUMN):
+        return resource[PARTITION_COLUMN]
+    if resource.get("resourceType") == "Patient":
+        return resource.get("id")
+    for name in ("subject", "patient", "beneficiary"):
+        element = resource.get(name)
+        reference = element.get("reference") if isinstance(element, dict) else None
+        if reference:
+            return reference.rstrip("/").split("/")[-1]
+    return None
+
+
+def iter_unknown_elements(value, data_type: pa.DataType, path: str = "") -> Iterable[str]:
+    """
+    :param value: element of a resource
+    :param data_type: type of its column or field
+    :param path: dotted path of the element
+    :return: paths of the elements with a value that the type has no field for
+    """
+    if isinstance(value, dict) and pa.types.is_struct(data_type):
+        for name, item in value.items():
+            index = data_type.get_field_index(name)
+            if index >= 0:
+                yield from iter_unknown_elements(item, data_type[index].type, f"{path}{name}.")
+            elif item is not None:
+                yield f"{path}{name}"
+    elif isinstance(value, list) and (pa.types.is_list(data_type) or pa.types.is_large_list(data_type)):
+        for item in value:
+            yield from iter_unknown_elements(item, data_type.value_type, path)
+
+
+def get_unknown_elements(resource: Dict, schema: Optional[pa.Schema]) -> List[str]:
+    """
+    :param resource: FHIR resource
+    :param schema: schema of the delta table, None for a new table
+    :return: sorted paths of the elements of the resource that pyarrow would drop when converting it
+    """
+    if schema is None:
+        return []
+    return sorted(set(iter_unknown_elements(resource, pa.struct(list(schema)))))
+
+
+def to_table(resources: List[Dict], patient_id: str, schema: Optional[pa.Schema]) -> pa.Table:
+    """
+    :param resources: FHIR resources
+    :param patient_id: partition of the resources
+    :param schema: schema of the delta table, None for a new table
+    :return: the resources as rows of the table, raises UnknownElements when they have elements the schema
+    has no column or field for, and pyarrow.ArrowInvalid / ArrowTypeError when they do not fit its types
+    """
+    unknown = sorted({element for resource in resources for element in get_unknown_elements(resource, schema)})
+    if unknown:
+        raise UnknownElements(unknown)
+    rows = [{**resource, PARTITION_COLUMN: patient_id} for resource in resources]
+    if has_resource_json(schema):
+        field_type = schema.field(RESOURCE_JSON).type
+        for row, resource in zip(rows, resources):
+            row[RESOURCE_JSON] = get_json_value(resource, field_type)
+    return pa.Table.from_pylist(rows, schema=schema)
+
+
+def keep_last(table: pa.Table, key: str = "id") -> pa.Table:
+    """
+    :param table:
+    :param key:
+    :return: the last row of every key, in table order
+    """
+    if key not in table.schema.names or not table.num_rows:
+        return table
+    keys = table.column(key).to_numpy(zero_copy_only=False)[::-1].astype(str)
+    _, first = np.unique(keys, return_index=True)
+    return table.take(pa.array(np.sort(table.num_rows - 1 - first)))
+
+
+def get_partition_files(delta_table: DeltaTable, patient_ids: Iterable[str] = None) -> Dict[str, List[Tuple[str, int]]]:
+    """
+    :param delta_table:
+    :param patient_ids: partitions to list, all of them when None
+    :return: path and size of the files of every patient partition
+    """
+    actions = delta_table.get_add_actions(flatten=True)
+    if patient_ids is not None:
+        actions = actions.filter(pc.is_in(
+            actions.column(f"partition.{PARTITION_COLUMN}"), value_set=pa.array(list(patient_ids), pa.string())))
+    partitions = {}
+    for path, size, patient_id in zip(actions.column("path").to_pylist(), actions.column("size_bytes").to_pylist(),
+                                      actions.column(f"partition.{PARTITION_COLUMN}").to_pylist()):
+        partitions.setdefault(patient_id, []).append((path, size))
+    return partitions
+
+
+def write_commit(table_path: str, version: int, actions: List[Dict]) -> bool:
+    """
+    Writes a commit of the local delta table if no other writer made this version
+
+    :param table_path: local path
+    :param version:
+    :param actions:
+    :return: False when the version exists
+    """
+    temp_path = os.path.join(table_path, "_delta_log", f".{version:020d}.json.{uuid.uuid4()}.tmp")
+    with open(temp_path, "w") as file:
+        file.write("\n".join(json.dumps(action, cls=DeltaJSONEncoder) for action in actions))
+    try:
+        # the link fails when the version exists, like the put if absent of the delta writers
+        os.link(temp_path, get_commit_path(table_path, version))
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(temp_path)
+
+
+def create_checkpoint(table_path: str, version: int):
+    """
+    Checkpoints the table every delta.checkpointInterval commits, so opening it does not replay the whole log.
+    A failed checkpoint only costs the readers a longer replay.
+
+    :param table_path:
+    :param version: version just committed
+    """
+    try:
+        delta_table = DeltaTable(table_path, version=version)
+        interval = int(delta_table.metadata().configuration.get("delta.checkpointInterval") or CHECKPOINT_INTERVAL)
+        if version % interval == 0:
+            delta_table.create_checkpoint()
+    except Exception as e:
+        logger.warning(f'Checkpoint of {table_path} at version {version} failed: {e}')
+
+
+def get_commit_partitions(table_path: str, version: int) -> Set[str]:
+    """
+    :param table_path: local path
+    :param version:
+    :return: the partitions the commit added or removed files of
+    """
+    patient_ids = set()
+    for action in read_commit(table_path, version):
+        file_action = action.get("add") or action.get("remove")
+        if file_action:
+            patient_ids.add((file_action.get("partitionValues") or {}).get(PARTITION_COLUMN))
+    return patient_ids
+
+
+def commit_touches(table_path: str, version: int, patient_ids: Iterable[str]) -> bool:
+    """
+    :param table_path: local path
+    :param version:
+    :param patient_ids:
+    :return: True when the commit added or removed files of one of the partitions
+    """
+    return not get_commit_partitions(table_path, version).isdisjoint(patient_ids)
+
+
+def write_data_file(table_path: str, name: str, table: pa.Table, patient_id: str, now: int) -> Dict:
+    """
+    :param table_path: local path
+    :param name: path of the file, relative to the table
+    :param table: rows of the partition, without the partition column
+    :param patient_id:
+    :param now: epoch milliseconds
+    :return: add action of the file
+    """
+    path = os.path.join(table_path, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pq.write_table(table, path)
+    return {"add": {
+        "path": name, "size": os.path.getsize(path), "partitionValues": {PARTITION_COLUMN: patient_id},
+        "modificationTime": now, "dataChange": True,
+        "stats": json.dumps(get_file_stats_from_metadata(pq.read_metadata(path)), cls=DeltaJSONEncoder)}}
+
+
+def with_change_type(table: pa.Table, change_type: str) -> pa.Table:
+    return table.append_column(CHANGE_TYPE, pa.array([change_type] * table.num_rows, pa.string()))
+
+
+def get_partition_actions(delta_table: DeltaTable, table_path: str, version: int, patient_id: str,
+                          table: pa.Table, upsert: bool, files: List[Tuple[str, int]], now: int,
+                          change_data: bool = False) -> List[Dict]:
+    """
+    Writes the data file of a partition in a commit, and its change data file. The change data of an upsert
+    holds the replaced rows and their new version, the rewritten rows of the partition are not changes.
+
+    :param delta_table: handle of the version read
+    :param table_path: local path
+    :param version: version of the commit
+    :param patient_id:
+    :param table: rows of to_table
+    :param upsert: the partition is rewritten without the rows with the ids of the table
+    :param files: files of the partition at the version read
+    :param now: epoch milliseconds
+    :param change_data: write a change data file, always done for upserts. Readers of the change feed only
+    read the change data files of the commits having some
+    :return: actions of the partition
+    """
+    rows = table.drop([PARTITION_COLUMN])
+    actions, changes = [], None
+    if upsert:
+        rows = keep_last(rows)
+        current = delta_table.to_pyarrow_dataset(
+            partitions=[(PARTITION_COLUMN, "=", patient_id)]).to_table().select(rows.schema.names).cast(rows.schema)
+        replaced = pc.is_in(current.column("id"), value_set=rows.column("id"))
+        preimage = current.filter(replaced)
+        updated = pc.is_in(rows.column("id"), value_set=preimage.column("id"))
+        changes = pa.concat_tables([
+            with_change_type(preimage, "update_preimage"),
+            with_change_type(rows.filter(updated), "update_postimage"),
+            with_change_type(rows.filter(pc.invert(updated)), "insert")])
+        rows = pa.concat_tables([current.filter(pc.invert(replaced)), rows])
+        actions += [{"remove": {
+            "path": path, "deletionTimestamp": now, "dataChange": True, "extendedFileMetadata": True,
+            "partitionValues": {PARTITION_COLUMN: patient_id}, "size": size}} for path, size in files]
+    elif change_data:
+        changes = with_change_type(rows, "insert")
+    name = f"{PARTITION_COLUMN}={patient_id}/part-{version}-{uuid.uuid4()}.parquet"
+    actions.append(write_data_file(table_path, name, rows, patient_id, now))
+    if changes is not None:
+        name = f"_change_data/{PARTITION_COLUMN}={patient_id}/cdc-{version}-{uuid.uuid4()}.parquet"
+        path = os.path.join(table_path, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pq.write_table(changes, path)
+        actions.append({"cdc": {
+            "path": name, "partitionValues": {PARTITION_COLUMN: patient_id}, "size": os.path.getsize(path),
+            "dataChange": False}})
+    return actions
+
+
+def commit_partitions(table_path: str, partitions: Dict[str, Tuple[pa.Table, bool]], retries: int) -> int:
+    """
+    Commits rows of patient partitions in a single commit. The table is read at a version and the commit
+    claims the next one. When another commit took it, the commit moves to the following version if the other
+    commit left the upserted partitions alone, else the partitions are read again and the commit retried.
+    Appends never conflict.
+
+    :param table_path:
+    :param partitions: rows and upsert flag of every partition, see get_partition_actions
+    :param retries: rebuilds of the commit on conflict
+    :return: version of the commit
+    """
+    local_path = get_local_path(table_path)
+    upserted = [patient_id for patient_id, (_, upsert) in partitions.items() if upsert]
+    mode = "upsert" if upserted else "append"
+    try:
+        delta_table = DeltaTable(table_path)
+    except PyDeltaTableError:
+        # the first commit creates the table, there are no rows to replace
+        write_deltalake(table_path, pa.concat_tables([table for table, _ in partitions.values()]),
+                        partition_by=[PARTITION_COLUMN], mode="append")
+        WRITE_COMMITS.labels("create", "committed").inc()
+        return DeltaTable(table_path).version()
+    for attempt in range(retries + 1):
+        if attempt:
+            delta_table.update_incremental()
+        read_version = delta_table.version()
+        files = get_partition_files(delta_table, upserted) if upserted else {}
+        now = int(time.time() * 1000)
+        actions = [{"commitInfo": {
+            "timestamp": now, "operation": "MERGE" if upserted else "WRITE", "readVersion": read_version}}]
+        for patient_id, (table, upsert) in partitions.items():
+            actions += get_partition_actions(delta_table, local_path, read_version + 1, patient_id, table, upsert,
+                                             files.get(patient_id, []), now, change_data=bool(upserted))
+        version = read_version + 1
+        while not write_commit(local_path, version, actions):
+            if upserted and commit_touches(local_path, version, upserted):
+                break
+            version += 1
+        else:
+            WRITE_COMMITS.labels(mode, "committed").inc()
+            create_checkpoint(table_path, version)
+            return version
+        for action in actions:
+            file_action = action.get("add") or action.get("cdc")
+            if file_action:
+                os.remove(os.path.join(local_path, file_action["path"]))
+        WRITE_COMMITS.labels(mode, "conflict").inc()
+        logger.info(f'Partitions {upserted} of {table_path} changed, retrying the commit ({attempt + 1})')
+    raise WriteConflict(f"Partitions {upserted} of {table_path} kept changing, write abandoned")
+
+
+class PendingWrite:
+    def __init__(self, patient_id: str, table: pa.Table, upsert: bool):
+        self.patient_id = patient_id
+        self.table = table
+        self.upsert = upsert
+        self.version: Optional[int] = None
+        self.future = asyncio.get_running_loop().create_future()
+
+
+def commit_writes(table_path: str, writes: List[PendingWrite], retries: int) -> List[Union[int, Exception]]:
+    """
+    Commits a group of writes of a table. The partitions without upserts are appended in a single commit,
+    the partitions with upserts are committed one by one. A failed commit fails only its own writes.
+
+    :param table_path:
+    :param writes:
+    :param retries: retries on conflict
+    :return: per write, the version that committed it or the exception of its failed commit
+    """
+    upserted = {write.patient_id for write in writes if write.upsert}
+    groups = [[write for write in writes if write.patient_id not in upserted]] + \
+        [[write for write in writes if write.patient_id == patient_id] for patient_id in upserted]
+    outcomes: Dict[int, Union[int, Exception]] = {}
+    for group in groups:
+        if not group:
+            continue
+        partitions = {}
+        for write in group:
+            partitions.setdefault(write.patient_id, []).append(write.table)
+        try:
+            outcome = commit_partitions(table_path, {
+                patient_id: (pa.concat_tables(tables), patient_id in upserted)
+                for patient_id, tables in partitions.items()}, retries)
+        except Exception as e:
+            logger.warning(f'Commit of {len(group)} writes to {table_path} failed: {e}')
+            WRITE_COMMITS.labels("group", "failed").inc()
+            outcome = e
+        for write in group:
+            outcomes[id(write)] = outcome
+    return [outcomes[id(write)] for write in writes]
+
+
+class WriteOverlay:
+    """
+    Rows written by this worker that the reads may not see yet, the table versions read are cached for
+    table_version_ttl. Rows are served until a read sees the version that committed them.
+    """
+
+    def __init__(self):
+        self._writes: Dict[str, List[PendingWrite]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, table_path: str, write: PendingWrite):
+        with self._lock:
+            self._writes.setdefault(table_path, []).append(write)
+
+    def discard(self, table_path: str, write: PendingWrite):
+        with self._lock:
+            if write in self._writes.get(table_path, []):
+                self._writes[table_path].remove(write)
+
+    def has_pending(self, table_path: str) -> bool:
+        return bool(self._writes.get(table_path))
+
+    def prune(self, table_path: str, read_version: int):
+        """
+        Drops the writes committed in or before read_version, once the reads see it
+
+        :param table_path:
+        :param read_version: version of the table read
+        """
+        with self._lock:
+            writes = self._writes.get(table_path)
+            if writes is None:
+                return
+            writes[:] = [write for write in writes if write.version is None or write.version > read_version]
+            if not writes:
+                del self._writes[table_path]
+
+    def get(self, table_path: str, patient_id: str, read_version: Optional[int]) -> Optional[pa.Table]:
+        """
+        :param table_path:
+        :param patient_id:
+        :param read_version: version of the table read, None when the table does not exist yet
+        :return: the rows of the partition that are not in the read version
+        """
+        if read_version is not None:
+            self.prune(table_path, read_version)
+        with self._lock:
+            writes = self._writes.get(table_path)
+            if not writes:
+                return None
+            tables = [write.table for write in writes if write.patient_id == patient_id]
+        return keep_last(pa.concat_tables(tables)) if tables else None
+
+
+class GroupCommitter:
+    """
+    Buffers the writes of every table and commits them together, when max_rows rows are buffered or
+    max_delay seconds after the first buffered write. One group of a table is committed at a time.
+    Used from the event loop thread.
+    """
+
+    def __init__(self, max_rows: int, max_delay: float, retries: int, overlay: WriteOverlay):
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.retries = retries
+        self.overlay = overlay
+        self._buffers: Dict[str, List[PendingWrite]] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    async def write(self, table_path: str, patient_id: str, table: pa.Table, upsert: bool = False) -> int:
+        """
+        :param table_path:
+        :param patient_id:
+        :param table: rows of to_table
+        :param upsert: replace the rows with the same ids
+        :return: version of the table once the rows are committed
+        """
+        write = PendingWrite(patient_id, table, upsert)
+        self.overlay.add(table_path, write)
+        buffer = self._buffers.setdefault(table_path, [])
+        buffer.append(write)
+        if sum(pending.table.num_rows for pending in buffer) >= self.max_rows:
+            self._schedule(table_path, 0)
+        elif table_path not in self._timers:
+            self._schedule(table_path, self.max_delay)
+        return await asyncio.shield(write.future)
+
+    def _schedule(self, table_path: str, delay: float):
+        timer = self._timers.pop(table_path, None)
+        if timer is not None:
+            timer.cancel()
+        loop = asyncio.get_running_loop()
+        self._timers[table_path] = loop.call_later(delay, lambda: asyncio.ensure_future(self._flush(table_path)))
+
+    async def _flush(self, table_path: str):
+        async with self._locks.setdefault(table_path, asyncio.Lock()):
+            self._timers.pop(table_path, None)
+            writes = self._buffers.pop(table_path, [])
+            if not writes:
+                return
+            WRITE_BATCH_ROWS.observe(sum(write.table.num_rows for write in writes))
+            try:
+                outcomes = await run_in_threadpool(commit_writes, table_path, writes, self.retries)
+            except Exception as e:
+                outcomes = [e] * len(writes)
+            for write, outcome in zip(writes, outcomes):
+                if isinstance(outcome, Exception):
+                    self.overlay.discard(table_path, write)
+                    write.future.set_exception(outcome)
+                else:
+                    write.version = outcome
+                    write.future.set_result(outcome)
+
+
+@lru_cache
+def get_write_overlay() -> WriteOverlay:
+    return WriteOverlay()
+
+
+@lru_cache
+def get_group_committer(max_rows: int, max_delay: float, retries: int) -> GroupCommitter:
+    return GroupCommitter(max_rows, max_delay, retries, get_write_overlay())
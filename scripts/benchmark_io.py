@@ -0,0 +1,88 @@
+"""
+Compares the io modes of common.get_resource_data, the reads of the searches, on a local delta table
+
+run from the repository root: python -m scripts.benchmark_io /data/ambulatory_ehr1/observation --patient <id> --runs 10
+"""
+import os
+import sys
+import time
+import resource
+import argparse
+import traceback
+
+from app.common import get_resource_data
+from app.core.settings import AppSettings
+
+MODES = (("default", False), ("mmap", False), ("mmap", True))
+
+
+def run_mode(table_path: str, patient_id: str, runs: int, io_mode: str, pre_buffer: bool, hole_size_limit: int,
+             range_size_limit: int) -> str:
+    """
+    Reads the table through common.get_resource_data, the scanner of the searches
+
+    :return: min and median latency in ms and peak RSS in KB, comma separated
+    """
+    partitions = [("yy__patient_id", "=", patient_id)] if patient_id else None
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        table = get_resource_data(
+            os.path.dirname(table_path.rstrip("/")), os.path.basename(table_path.rstrip("/")), partitions,
+            io_mode=io_mode, pre_buffer=pre_buffer, hole_size_limit=hole_size_limit,
+            range_size_limit=range_size_limit)
+        if table is None:
+            raise ValueError(f"{table_path} is not a delta table")
+        table.column(0).to_pylist()
+        timings.append((time.perf_counter() - start) * 1000)
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return f"{min(timings):.3f},{sorted(timings)[len(timings) // 2]:.3f},{peak_rss_kb}"
+
+
+def benchmark(table_path: str, patient_id: str, runs: int, hole_size_limit: int, range_size_limit: int) -> bool:
+    """
+    Compares latency and peak RSS of the default delta-rs reads against memory mapped reads.
+    Every mode runs in its own process, so peak RSS is not shared between the modes.
+
+    :return: False when a mode failed
+    """
+    results = {}
+    for io_mode, pre_buffer in MODES:
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            try:
+                os.write(write_fd, run_mode(
+                    table_path, patient_id, runs, io_mode, pre_buffer, hole_size_limit, range_size_limit).encode())
+            except BaseException:
+                traceback.print_exc()
+                os._exit(1)
+            os._exit(0)
+        os.close(write_fd)
+        _, status = os.waitpid(pid, 0)
+        with os.fdopen(read_fd) as pipe:
+            output = pipe.read()
+        results[f"{io_mode}{'+pre_buffer' if pre_buffer else ''}"] = \
+            output.split(",") if os.waitstatus_to_exitcode(status) == 0 else None
+
+    print(f"{'mode':<20}{'min ms':>12}{'median ms':>12}{'peak rss MB':>14}")
+    for name, result in results.items():
+        if result is None:
+            print(f"{name:<20}{'failed':>12}")
+            continue
+        min_ms, median_ms, peak_rss_kb = result
+        print(f"{name:<20}{min_ms:>12}{median_ms:>12}{int(peak_rss_kb) / 1024:>14.1f}")
+    return all(result is not None for result in results.values())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark delta table read modes")
+    parser.add_argument("table_path", help="local delta table directory, ex: /data/ambulatory_ehr1/observation")
+    parser.add_argument("--patient", default=None, help="yy__patient_id partition to read")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--hole-size-limit", type=int, default=AppSettings.__fields__["io_hole_size_limit"].default)
+    parser.add_argument("--range-size-limit", type=int, default=AppSettings.__fields__["io_range_size_limit"].default)
+    args = parser.parse_args()
+    sys.exit(0 if benchmark(args.table_path, args.patient, args.runs, args.hole_size_limit, args.range_size_limit)
+             else 1)
@@ -0,0 +1,37 @@
+import os
+
+os.environ.setdefault("CUSTOMER", "test1")
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.core.settings import get_settings
+from app.main import app
+
+SYSTEM_NAME = "ehr"
+
+
+@pytest.fixture
+def config(tmp_path):
+    """Settings of a system whose delta database is a temporary directory"""
+    return get_settings().copy(update={
+        "system_config": {"paths": {"base_path": str(tmp_path)}, "systems": {SYSTEM_NAME: {"db_name": "db"}}},
+        "write_max_delay": 0.0,
+        "table_version_ttl": 0.0,
+        "text_index_dir": str(tmp_path / "text-index"),
+    })
+
+
+@pytest.fixture
+def database_dir(config):
+    path = os.path.join(config.system_config["paths"]["base_path"], "db")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+@pytest.fixture
+def client(config, database_dir):
+    app.dependency_overrides[get_settings] = lambda: config
+    with TestClient(app) as client:
+        yield client
+    app.dependency_overrides.clear()
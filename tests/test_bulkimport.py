@@ -0,0 +1,92 @@
+import time
+
+import orjson
+import pyarrow as pa
+import pytest
+from deltalake import DeltaTable
+
+from app.utility import bulkimport
+from app.utility.bulkimport import create_import_job, get_import_job
+from app.utility.writer import PARTITION_COLUMN
+from .conftest import SYSTEM_NAME
+from .test_write import observation
+
+
+@pytest.fixture
+def import_dir(config, tmp_path):
+    path = tmp_path / "import"
+    path.mkdir()
+    with open(path / "observation.ndjson", "wb") as file:
+        for index in range(10):
+            file.write(orjson.dumps(observation(f"o{index}", patient=f"p{index % 3}")) + b"\n")
+    config.import_dir = str(path)
+    config.import_processes = 1
+    return path
+
+
+def run_import(client, resource_type="Observation"):
+    response = client.post(f"/$import?system_name={SYSTEM_NAME}", json={
+        "input": [{"type": resource_type, "url": "*.ndjson"}]})
+    if response.status_code != 202:
+        return response
+    while response.status_code == 202:
+        time.sleep(0.1)
+        response = client.get(f"/$import/{response.json()['id']}")
+    return response
+
+
+def test_import_runs_again_without_duplicates(client, import_dir):
+    for _ in range(2):
+        response = run_import(client)
+        assert response.json()["status"] == "completed"
+    data = client.get(f"/Observation?patient=p1&system_name={SYSTEM_NAME}").json()["data"]
+    assert sorted(row["id"] for row in data) == ["o1", "o4", "o7"]
+
+
+def test_import_of_an_unknown_type_is_rejected(client, import_dir, database_dir):
+    assert run_import(client, "../evil").status_code == 400
+
+
+def test_finished_jobs_are_evicted():
+    finished = create_import_job(SYSTEM_NAME, [], retention=60.0)
+    finished.finished_at = time.time() - 120.0
+    running = create_import_job(SYSTEM_NAME, [], retention=60.0)
+    create_import_job(SYSTEM_NAME, [], retention=60.0)
+    assert get_import_job(finished.id) is None
+    assert get_import_job(running.id) is running
+
+
+def test_batches_append_new_partitions_and_upsert_the_others(tmp_path, monkeypatch):
+    table_path = str(tmp_path / "observation")
+    commits = []
+    commit = bulkimport.commit_partitions
+
+    def recording_commit(path, partitions, retries):
+        commits.append({patient_id: upsert for patient_id, (_, upsert) in partitions.items()})
+        return commit(path, partitions, retries)
+
+    monkeypatch.setattr(bulkimport, "commit_partitions", recording_commit)
+
+    def batch(*rows):
+        return [pa.Table.from_pylist([{"id": resource_id, PARTITION_COLUMN: patient_id, "value": value}
+                                      for resource_id, patient_id, value in rows])]
+
+    bulkimport.write_batch(table_path, batch(("o1", "p1", 0), ("o2", "p2", 0)), retries=0)
+    version = bulkimport.write_batch(table_path, batch(("o1", "p1", 1), ("o3", "p3", 0), ("o3", "p3", 1)), retries=0)
+    assert commits == [{"p1": False, "p2": False}, {"p3": False}, {"p1": True}]
+    table = DeltaTable(table_path).to_pyarrow_table()
+    assert version == DeltaTable(table_path).version()
+    assert sorted(zip(table.column("id").to_pylist(), table.column("value").to_pylist())) == [
+        ("o1", 1), ("o2", 0), ("o3", 1)]
+
+
+def test_elements_outside_the_inferred_schema_are_reported(client, import_dir, config):
+    config.import_sample_lines = 2
+    with open(import_dir / "observation.ndjson", "ab") as file:
+        file.write(orjson.dumps(observation("late", valueString="after the sample")) + b"\n")
+    response = run_import(client)
+    assert response.json()["status"] == "completed"
+    assert response.json()["errors"] == 1
+    assert response.json()["error_messages"] == [
+        "observation.ndjson: Observation late: elements not in the table schema: valueString"]
+    assert response.json()["resources"] == {"Observation": 10}
@@ -0,0 +1,31 @@
+import asyncio
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from app.middleware.cancellation import CancellationMiddleware
+
+
+async def slow(request):
+    await asyncio.sleep(0.2)
+    return JSONResponse({"committed": True})
+
+
+def test_writes_and_admin_requests_run_past_the_deadline():
+    app = CancellationMiddleware(Starlette(routes=[
+        Route("/Observation", slow, methods=["GET", "POST"]), Route("/admin/vacuum", slow, methods=["GET"])]),
+        deadline=0.05)
+    client = TestClient(app)
+    assert client.get("/Observation").status_code == 504
+    assert client.post("/Observation").status_code == 200
+    assert client.get("/admin/vacuum").status_code == 200
+
+
+def test_strict_handling_rejects_a_wait_over_the_maximum():
+    app = CancellationMiddleware(Starlette(routes=[Route("/Observation", slow)]), deadline=0.05, max_deadline=1.0)
+    client = TestClient(app)
+    assert client.get("/Observation", headers={"Prefer": "handling=strict, wait=5"}).status_code == 400
+    assert client.get("/Observation", headers={"Prefer": "handling=lenient, wait=5"}).status_code == 200
+    assert client.get("/Observation", headers={"Prefer": "handling=strict, wait=0.5"}).status_code == 200
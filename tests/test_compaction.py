@@ -0,0 +1,66 @@
+import os
+
+import pyarrow as pa
+from deltalake import DeltaTable, write_deltalake
+
+from app.utility import compaction
+from app.utility.compaction import CompactionRun, run_compaction
+from app.utility.writer import PARTITION_COLUMN
+
+
+def append(table_path, patient_id, *ids):
+    write_deltalake(table_path, pa.Table.from_pylist([
+        {"id": resource_id, "status": "final", "effectiveDateTime": f"2023-01-{index + 1:02d}",
+         PARTITION_COLUMN: patient_id} for index, resource_id in enumerate(ids)]),
+        partition_by=[PARTITION_COLUMN], mode="append")
+
+
+def read(table_path):
+    return sorted(DeltaTable(table_path).to_pyarrow_table().to_pylist(), key=lambda row: row["id"])
+
+
+def compact(table_path):
+    run = CompactionRun(os.path.dirname(table_path), [(table_path, "observation")])
+    run_compaction(run, min_files=2, max_partitions=100, zorder=True, row_group_rows=16384, bytes_per_second=0)
+    return run
+
+
+def test_compaction_keeps_the_rows(tmp_path):
+    table_path = str(tmp_path / "observation")
+    for index in range(3):
+        append(table_path, "p1", f"a{index}", f"b{index}")
+        append(table_path, "p2", f"c{index}")
+    rows = read(table_path)
+
+    run = compact(table_path)
+    assert run.status == "completed"
+    assert (run.partitions, run.files_removed) == (2, 6)
+    assert read(table_path) == rows
+    assert len(DeltaTable(table_path).files()) == 2
+
+
+def test_compaction_lists_the_table_once_and_sees_other_writers(tmp_path, monkeypatch):
+    table_path = str(tmp_path / "observation")
+    for index in range(2):
+        append(table_path, "p1", f"a{index}")
+        append(table_path, "p2", f"b{index}")
+    get_partition_files = compaction.get_partition_files
+    listed = []
+    compact_partition = compaction.compact_partition
+
+    def listing_partition_files(delta_table, patient_ids=None):
+        listed.append(patient_ids)
+        return get_partition_files(delta_table, patient_ids)
+
+    def racing_compact_partition(table_files, resource_type, patient_id, *args):
+        if patient_id == "p2":
+            # another writer appends to the next partition after the first one was compacted
+            append(table_path, "p2", "b2")
+        return compact_partition(table_files, resource_type, patient_id, *args)
+
+    monkeypatch.setattr(compaction, "get_partition_files", listing_partition_files)
+    monkeypatch.setattr(compaction, "compact_partition", racing_compact_partition)
+    assert compact(table_path).status == "completed"
+    assert listed == [None, ["p2"]]
+    assert [row["id"] for row in read(table_path)] == ["a0", "a1", "b0", "b1", "b2"]
+    assert len(DeltaTable(table_path).files()) == 2
@@ -0,0 +1,32 @@
+from starlette.applications import Starlette
+from starlette.responses import StreamingResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from app.middleware import compression
+from app.middleware.compression import CompressionMiddleware
+
+
+def test_streamed_chunks_move_to_the_thread_pool_once_the_body_is_large(monkeypatch):
+    chunk = b"x" * 64 * 1024
+    offloaded = []
+
+    async def run_in_threadpool(function, *args):
+        offloaded.append(len(args[0]))
+        return function(*args)
+
+    async def stream(request):
+        async def chunks():
+            for _ in range(6):
+                yield chunk
+        return StreamingResponse(chunks(), media_type="application/javascript")
+
+    monkeypatch.setattr(compression, "run_in_threadpool", run_in_threadpool)
+    app = CompressionMiddleware(Starlette(routes=[Route("/", stream)]), threadpool_size=256 * 1024,
+                                encodings=["gzip"])
+    response = TestClient(app).get("/", headers={"accept-encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.content == chunk * 6
+    # the chunks from the fourth on, and the end of the stream
+    assert offloaded == [len(chunk)] * 3 + [0]
+    assert app.get_level("application/javascript", "gzip") == 6
@@ -0,0 +1,37 @@
+import pytest
+
+from app.core.configwatch import SystemConfigWatcher, load_system_config
+from .conftest import SYSTEM_NAME
+
+
+def write_config(path, base_path, **systems):
+    path.write_text(f'[paths]\nbase_path = "{base_path}"\n' + "".join(
+        f'\n[systems.{system}]\ndb_name = "{db_name}"\n' for system, db_name in systems.items()))
+
+
+def test_invalid_config_is_rejected(tmp_path):
+    path = tmp_path / "test.toml"
+    path.write_text('[paths]\nbase_path = ""\n')
+    with pytest.raises(ValueError):
+        load_system_config(str(path))
+
+
+def test_reload_swaps_the_config_and_only_touches_changed_databases(tmp_path, config):
+    path = tmp_path / "test.toml"
+    write_config(path, "/data", **{SYSTEM_NAME: "db", "lab": "lab"})
+    config.system_config = load_system_config(str(path))
+    opened, closed = [], []
+    watcher = SystemConfigWatcher(config, str(path), 0.0, open_databases=opened.extend,
+                                  close_databases=closed.extend)
+    snapshot = config.system_config
+
+    write_config(path, "/data", **{SYSTEM_NAME: "db", "radiology": "radiology"})
+    assert watcher.reload()
+    assert config.system_config is not snapshot
+    assert sorted(config.system_config["systems"]) == [SYSTEM_NAME, "radiology"]
+    assert (opened, closed) == (["/data/radiology"], ["/data/lab"])
+    assert snapshot["systems"]["lab"]["db_name"] == "lab"
+
+    path.write_text("[paths\n")
+    assert not watcher.reload()
+    assert sorted(config.system_config["systems"]) == [SYSTEM_NAME, "radiology"]
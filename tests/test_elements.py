@@ -0,0 +1,12 @@
+import pyarrow as pa
+
+from app.utility.elements import get_projection, project_table
+
+
+def test_missing_parents_stay_missing():
+    table = pa.Table.from_pylist([
+        {"id": "o1", "valueQuantity": {"value": 1.0, "unit": "%"}},
+        {"id": "o2", "valueQuantity": None},
+    ])
+    projected = project_table(table, get_projection(table.schema, ["id", "valueQuantity.value"]))
+    assert projected.to_pylist() == [{"id": "o1", "valueQuantity": {"value": 1.0}}, {"id": "o2", "valueQuantity": None}]
@@ -0,0 +1,27 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from app.utility.formats import ARROW_STREAM_MEDIA_TYPE, PARQUET_MEDIA_TYPE, get_output_format
+from .conftest import SYSTEM_NAME
+from .test_write import observation
+
+
+def test_format_values():
+    assert get_output_format(" Arrow ") == ARROW_STREAM_MEDIA_TYPE
+    assert get_output_format("application/parquet") == PARQUET_MEDIA_TYPE
+    assert get_output_format("json") is None and get_output_format(None) is None
+
+
+def test_binary_formats_hold_the_json_rows(client):
+    for index in range(3):
+        client.post(f"/Observation?system_name={SYSTEM_NAME}", json=observation(f"o{index}"))
+    search = f"/Observation?patient=p1&system_name={SYSTEM_NAME}"
+    ids = sorted(row["id"] for row in client.get(search).json()["data"])
+
+    response = client.get(f"{search}&_format=arrow")
+    assert response.headers["content-type"] == ARROW_STREAM_MEDIA_TYPE
+    assert sorted(pa.ipc.open_stream(response.content).read_all().column("id").to_pylist()) == ids
+
+    response = client.get(f"{search}&_format=parquet")
+    assert response.headers["content-type"] == PARQUET_MEDIA_TYPE
+    assert sorted(pq.read_table(pa.BufferReader(response.content)).column("id").to_pylist()) == ids
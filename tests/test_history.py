@@ -0,0 +1,35 @@
+import os
+
+from deltalake import DeltaTable
+
+from .conftest import SYSTEM_NAME
+from .test_write import observation
+
+
+def test_history_after_a_vacuum(client, database_dir):
+    for resource_id in ("o1", "o2"):
+        assert client.post(f"/Observation?system_name={SYSTEM_NAME}",
+                           json=observation(resource_id, valueString="before")).status_code == 201
+    response = client.put(f"/Observation/o1?system_name={SYSTEM_NAME}", json=observation("o1", valueString="after"))
+    version = int(response.headers["etag"][3:-1])
+    DeltaTable(os.path.join(database_dir, "observation")).vacuum(
+        retention_hours=0, enforce_retention_duration=False, dry_run=False)
+
+    history = client.get(f"/Observation/_history?patient=p1&system_name={SYSTEM_NAME}")
+    assert history.status_code == 200
+    assert sorted((row["id"], row["_change_type"], row["_commit_version"]) for row in history.json()["data"]) == [
+        ("o1", "insert", version), ("o2", "insert", version)]
+    assert client.get(f"/Observation/_history?patient=p1&system_name={SYSTEM_NAME}&_since=0").status_code == 410
+    assert client.get(f"/Observation?patient=p1&system_name={SYSTEM_NAME}&_since=0").status_code == 410
+    recent = client.get(f"/Observation/_history?patient=p1&system_name={SYSTEM_NAME}&_since={version - 1}")
+    assert [row["id"] for row in recent.json()["data"]] == ["o1", "o1"]
+
+
+def test_history_since_an_instant_before_a_log_cleanup(client, database_dir):
+    for resource_id in ("o1", "o2"):
+        assert client.post(f"/Observation?system_name={SYSTEM_NAME}", json=observation(resource_id)).status_code == 201
+    os.remove(os.path.join(database_dir, "observation", "_delta_log", f"{0:020d}.json"))
+
+    since = "2000-01-01T00:00:00Z"
+    assert client.get(f"/Observation/_history?patient=p1&system_name={SYSTEM_NAME}&_since={since}").status_code == 410
+    assert client.get(f"/Observation?patient=p1&system_name={SYSTEM_NAME}&_since={since}").status_code == 410
@@ -0,0 +1,44 @@
+import pyarrow as pa
+
+from app.utility.hotstore import HotStore, get_hot_store
+from .conftest import SYSTEM_NAME
+from .test_write import observation
+
+
+def rows(*ids):
+    return pa.Table.from_pylist([{"id": resource_id, "status": "final"} for resource_id in ids])
+
+
+def test_a_new_table_version_drops_the_entry():
+    store = HotStore(max_bytes=1 << 20)
+    store.put(("observation", "p1"), 1, rows("o1"))
+    assert store.get(("observation", "p1"), 1).column("id").to_pylist() == ["o1"]
+    assert store.get(("observation", "p1"), 2) is None
+    assert store.stats()["entries"] == 0
+
+
+def test_least_recently_used_entries_are_evicted():
+    size = rows("o1").combine_chunks().get_total_buffer_size()
+    store = HotStore(max_bytes=size * 2, max_entry_bytes=size)
+    store.put(("observation", "p1"), 1, rows("o1"))
+    store.put(("observation", "p2"), 1, rows("o2"))
+    store.get(("observation", "p1"), 1)
+    store.put(("observation", "p3"), 1, rows("o3"))
+    assert store.get(("observation", "p2"), 1) is None
+    assert store.get(("observation", "p1"), 1) is not None
+    assert store.stats()["evictions"] == 1
+    store.put(("observation", "p4"), 1, rows("o4", "o5", "o6", "o7"))
+    assert store.get(("observation", "p4"), 1) is None
+
+
+def test_searches_see_the_writes_after_a_cached_read(client, config):
+    config.hot_store_enabled = True
+    get_hot_store.cache_clear()
+    client.post(f"/Observation?system_name={SYSTEM_NAME}", json=observation("o1"))
+    search = f"/Observation?patient=p1&system_name={SYSTEM_NAME}"
+    assert [row["id"] for row in client.get(search).json()["data"]] == ["o1"]
+    assert get_hot_store(config.hot_store_max_bytes, config.tenant).stats()["entries"] == 1
+
+    client.post(f"/Observation?system_name={SYSTEM_NAME}", json=observation("o2"))
+    assert sorted(row["id"] for row in client.get(search).json()["data"]) == ["o1", "o2"]
+    get_hot_store.cache_clear()
@@ -0,0 +1,28 @@
+import os
+
+import pyarrow as pa
+from deltalake import write_deltalake
+
+from app.utility.include import get_included
+from app.utility.writer import PARTITION_COLUMN
+from .conftest import SYSTEM_NAME
+
+
+def test_include_reads_shared_targets_by_id(client, database_dir):
+    write_deltalake(os.path.join(database_dir, "medication"), pa.Table.from_pylist([
+        {"id": "m1", "resourceType": "Medication", PARTITION_COLUMN: "shared"}]), partition_by=[PARTITION_COLUMN])
+    assert client.post(f"/MedicationRequest?system_name={SYSTEM_NAME}", json={
+        "resourceType": "MedicationRequest", "id": "mr1", "subject": {"reference": "Patient/p1"},
+        "medicationReference": {"reference": "Medication/m1"}}).status_code == 201
+
+    response = client.get(f"/MedicationRequest?patient=p1&system_name={SYSTEM_NAME}"
+                          f"&_include=MedicationRequest:medication").json()
+    assert [(row["resourceType"], row["id"]) for row in response["included"]] == [("Medication", "m1")]
+
+
+def test_include_of_large_string_ids():
+    page = pa.Table.from_pylist([{"id": "o1", "encounter": {"reference": "Encounter/e1"}}])
+    encounters = pa.table({"id": pa.array(["e1", "e2"], pa.large_string())})
+    included = get_included("Observation", page, ["Observation:encounter"], [],
+                            read_table=lambda target: encounters, read_ids=lambda target, ids: None)
+    assert [(row["resourceType"], row["id"]) for row in included] == [("Encounter", "e1")]
@@ -0,0 +1,20 @@
+from .conftest import SYSTEM_NAME
+from .test_write import observation
+
+
+def coded(resource_id, code, date):
+    resource = observation(resource_id, effectiveDateTime=date)
+    resource["code"]["coding"][0]["code"] = code
+    return resource
+
+
+def test_lastn_returns_the_latest_observations_of_every_code(client):
+    for resource in [coded("a1", "4548-4", "2023-01-01"), coded("a2", "4548-4", "2023-03-01"),
+                     coded("a3", "4548-4", "2023-02-01"), coded("b1", "2345-7", "2022-12-01")]:
+        client.post(f"/Observation?system_name={SYSTEM_NAME}", json=resource)
+    lastn = f"/Observation/$lastn?patient=p1&system_name={SYSTEM_NAME}"
+
+    assert sorted(row["id"] for row in client.get(lastn).json()["data"]) == ["a2", "b1"]
+    assert sorted(row["id"] for row in client.get(f"{lastn}&max=2").json()["data"]) == ["a2", "a3", "b1"]
+    data = client.get(f"{lastn}&max=5&code=http://loinc.org|2345-7").json()
+    assert [row["id"] for row in data["data"]] == ["b1"] and data["count"] == 1
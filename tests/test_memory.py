@@ -0,0 +1,41 @@
+import pyarrow as pa
+import pytest
+
+from app.utility.memory import MemoryBudget, MemoryBudgetExceeded, check_budget, set_memory_budget
+from .conftest import SYSTEM_NAME
+from .test_write import observation
+
+
+@pytest.fixture
+def over_budget(client, config):
+    for index in range(3):
+        assert client.post(f"/Observation?system_name={SYSTEM_NAME}", json=observation(f"o{index}")).status_code == 201
+    # every partition is estimated over the budget of the requests
+    config.memory_expansion_ratio = float(config.memory_budget)
+    return client
+
+
+def test_partition_over_the_budget_is_streamed_or_rejected(over_budget):
+    search = f"/Observation?patient=p1&system_name={SYSTEM_NAME}"
+    response = over_budget.get(f"{search}&page_size=2")
+    assert response.status_code == 200
+    assert [row["id"] for row in response.json()["data"]] == ["o0", "o1"]
+    arrow = over_budget.get(f"{search}&_format=arrow")
+    assert arrow.status_code == 200
+    assert pa.ipc.open_stream(arrow.content).read_all().num_rows == 3
+    parquet = over_budget.get(f"{search}&_format=parquet")
+    assert parquet.status_code == 413
+    assert "memory budget" in parquet.json()["message"]
+
+
+def test_scan_stops_once_over_the_budget():
+    budget = MemoryBudget(limit=1024)
+    set_memory_budget(budget)
+    try:
+        batches = check_budget(iter([pa.record_batch([pa.array(range(1024), memory_pool=budget.pool)], ["n"])] * 2))
+        with pytest.raises(MemoryBudgetExceeded):
+            list(batches)
+        assert budget.peak > budget.limit
+    finally:
+        set_memory_budget(None)
+        budget.release()
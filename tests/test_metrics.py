@@ -0,0 +1,34 @@
+import os
+
+import orjson
+
+from app.utility.metrics import RequestMetrics, RequestMetricsCollector, get_request_metrics
+from .conftest import SYSTEM_NAME
+from .test_write import observation
+
+
+def get_requests(method, route):
+    return {key[2:]: value for key, value in get_request_metrics().requests.items() if key[:2] == (method, route)}
+
+
+def test_generic_routes_are_labelled_with_their_resource_type(client):
+    before = get_requests("POST", "/{resource_type}").get(("Observation", "201"), 0)
+    assert client.post(f"/Observation?system_name={SYSTEM_NAME}", json=observation()).status_code == 201
+    assert client.post(f"/Widget?system_name={SYSTEM_NAME}", json=observation()).status_code == 404
+    requests = get_requests("POST", "/{resource_type}")
+    assert requests[("Observation", "201")] == before + 1
+    assert ("Widget", "404") not in requests and ("none", "404") in requests
+
+
+def test_snapshots_of_dead_workers_are_dropped(tmp_path):
+    worker = RequestMetrics()
+    worker.observe(("GET", "/Observation", "Observation"), "200", 0.01)
+    snapshot = orjson.dumps(worker.snapshot())
+    (tmp_path / f"requests_{os.getppid()}.json").write_bytes(snapshot)
+    dead = tmp_path / "requests_999999999.json"
+    dead.write_bytes(snapshot)
+
+    collector = RequestMetricsCollector(RequestMetrics(), str(tmp_path))
+    requests = next(collector.collect())
+    assert [sample.value for sample in requests.samples if sample.name == "fhir_requests_total"] == [1]
+    assert not dead.exists()
@@ -0,0 +1,32 @@
+import pyarrow as pa
+from deltalake import DeltaTable
+
+from app.utility.rawjson import RESOURCE_JSON, fill_resource_json, join_resource_json
+from .conftest import SYSTEM_NAME
+from .test_bulkimport import import_dir, run_import  # noqa: F401
+
+
+def search(client, query=""):
+    return client.get(f"/Observation?patient=p1&system_name={SYSTEM_NAME}{query}").json()
+
+
+def test_raw_json_search_returns_the_decoded_resources(client, config, import_dir, database_dir):
+    config.import_resource_json = True
+    assert run_import(client).json()["status"] == "completed"
+    assert RESOURCE_JSON in DeltaTable(f"{database_dir}/observation").schema().to_pyarrow().names
+
+    raw = search(client)
+    config.resource_json_enabled = False
+    decoded = search(client)
+    assert sorted(row["id"] for row in raw["data"]) == ["o1", "o4", "o7"]
+    assert raw == decoded
+
+
+def test_missing_resource_json_values_are_built_from_the_columns():
+    table = pa.Table.from_pylist([
+        {"id": "o1", "status": None, RESOURCE_JSON: '{"id":"o1","status":"final"}'},
+        {"id": "o2", "status": "final", RESOURCE_JSON: None}])
+    filled = fill_resource_json(table)
+    assert filled.column(RESOURCE_JSON).to_pylist() == ['{"id":"o1","status":"final"}', '{"id":"o2","status":"final"}']
+    assert join_resource_json(filled.column(RESOURCE_JSON)) == \
+        b'{"id":"o1","status":"final"},{"id":"o2","status":"final"}'
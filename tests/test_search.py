@@ -0,0 +1,57 @@
+import os
+
+import pyarrow as pa
+from deltalake import DeltaTable, write_deltalake
+
+from app import common
+from app.utility.writer import PARTITION_COLUMN
+from .conftest import SYSTEM_NAME
+from .test_write import observation
+
+
+def test_code_in_without_value_sets_is_rejected(client):
+    assert client.post(f"/Observation?system_name={SYSTEM_NAME}", json=observation()).status_code == 201
+    for search in ("code:in=,", "code:below=,,"):
+        response = client.get(f"/Observation?patient=p1&system_name={SYSTEM_NAME}&{search}")
+        assert response.status_code == 400
+
+
+def test_summary_count_counts_the_selected_resources(client):
+    for index in range(3):
+        assert client.post(f"/Observation?system_name={SYSTEM_NAME}", json=observation(f"o{index}")).status_code == 201
+    response = client.put(f"/Observation/o1?system_name={SYSTEM_NAME}", json=observation("o1", status="amended"))
+    version = int(response.headers["etag"][3:-1])
+    search = f"/Observation?patient=p1&system_name={SYSTEM_NAME}&_summary=count"
+    assert client.get(search).json()["total"] == 3
+    assert client.get(f"{search}&_since={version - 1}").json()["total"] == 1
+    assert client.get(f"{search}&_content=amended").json()["total"] == 1
+
+
+def test_summary_count_sees_the_commits_of_other_writers(client, database_dir):
+    search = f"/Observation?patient=p1&system_name={SYSTEM_NAME}&_summary=count"
+    assert client.post(f"/Observation?system_name={SYSTEM_NAME}", json=observation("o1")).status_code == 201
+    assert client.get(search).json()["total"] == 1
+    table_path = os.path.join(database_dir, "observation")
+    rows = pa.Table.from_pylist([{"id": "o2", "status": "final", PARTITION_COLUMN: "p1"}],
+                                schema=DeltaTable(table_path).schema().to_pyarrow())
+    write_deltalake(table_path, rows, partition_by=[PARTITION_COLUMN], mode="append")
+    assert client.get(search).json()["total"] == 2
+
+
+def test_partition_sizes_are_listed_once_per_table_version(client, database_dir, monkeypatch):
+    assert client.post(f"/Observation?system_name={SYSTEM_NAME}", json=observation("o1")).status_code == 201
+    get_partition_sizes = common.get_partition_sizes
+    calls = []
+
+    def counting_partition_sizes(delta_table):
+        calls.append(delta_table.version())
+        return get_partition_sizes(delta_table)
+
+    monkeypatch.setattr(common, "get_partition_sizes", counting_partition_sizes)
+    table_path = os.path.join(database_dir, "observation")
+    size = common.get_partition_size(table_path, "p1")
+    assert size > 0 and common.get_partition_size(table_path, "p1") == size
+    assert common.get_partition_size(table_path, "p2") == 0
+    assert client.post(f"/Observation?system_name={SYSTEM_NAME}", json=observation("o2")).status_code == 201
+    assert common.get_partition_size(table_path, "p1") > size
+    assert len(calls) == 2
@@ -0,0 +1,29 @@
+import pyarrow as pa
+import pytest
+
+from app.utility.series import get_series_arrays
+
+
+def observations(*rows):
+    return pa.Table.from_pylist([
+        {"effectiveDateTime": time, "valueQuantity": {"value": value, "unit": "%"}} for time, value in rows])
+
+
+def test_times_with_offsets_and_partial_precision():
+    table = observations(("2020-01-15T10:00:00+02:00", 1.0), ("2020-01-15T09:00:00Z", 2.0), ("2020", 3.0),
+                         ("2020-02", 4.0), ("not a date", 5.0))
+    times, values = get_series_arrays(table, start="2020", end="2020-02-01")
+    # 10:00+02:00 is 08:00 UTC, an hour before 09:00Z
+    assert values.tolist() == [3.0, 1.0, 2.0]
+    assert times[2] - times[1] == 60 * 60 * 1000
+
+
+def test_quantity_without_value():
+    table = pa.Table.from_pylist([{"effectiveDateTime": "2020-01-01", "valueQuantity": {"unit": "%"}}])
+    times, values = get_series_arrays(table)
+    assert len(times) == len(values) == 0
+
+
+def test_bad_bounds_are_rejected():
+    with pytest.raises(ValueError):
+        get_series_arrays(observations(("2020-01-01", 1.0)), start="yesterday")
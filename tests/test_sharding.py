@@ -0,0 +1,86 @@
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from app.middleware.sharding import FORWARDED_HEADER, ShardingMiddleware, ShardMembership
+
+SELF_NODE = "http://node-a:8000"
+OTHER_NODE = "http://node-b:8000"
+
+
+async def serve(request):
+    body = await request.body()
+    return JSONResponse({"served_by": "local", "body": body.decode()})
+
+
+@pytest.fixture
+def membership():
+    return ShardMembership([SELF_NODE, OTHER_NODE], SELF_NODE)
+
+
+@pytest.fixture
+def patients(membership):
+    """A patient owned by this node and one owned by the other node"""
+    owners = {}
+    for index in range(100):
+        owners.setdefault(membership.get_owner(f"p{index}"), f"p{index}")
+    return owners[SELF_NODE], owners[OTHER_NODE]
+
+
+@pytest.fixture
+def proxied(membership, monkeypatch):
+    requests = []
+
+    async def proxy(self, owner, scope, body, send):
+        requests.append((owner, scope["method"], scope["path"], body))
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    monkeypatch.setattr(ShardingMiddleware, "proxy", proxy)
+    return requests
+
+
+@pytest.fixture
+def client(membership):
+    app = Starlette(routes=[
+        Route("/Observation", serve, methods=["GET", "POST"]), Route("/fhirresource", serve),
+        Route("/bundle", serve, methods=["POST"])])
+    app.add_middleware(ShardingMiddleware, membership=membership)
+    return TestClient(app)
+
+
+def observation(patient_id):
+    return {"resourceType": "Observation", "subject": {"reference": f"Patient/{patient_id}"}}
+
+
+def test_reads_are_routed_by_their_patient_parameter(client, patients, proxied):
+    own, other = patients
+    assert client.get(f"/Observation?patient=Patient/{own}").json()["served_by"] == "local"
+    assert client.get(f"/Observation?patient={other}").status_code == 200
+    assert client.get(f"/fhirresource?yy__patient_id={other}").status_code == 200
+    assert [(owner, path) for owner, _, path, _ in proxied] == [(OTHER_NODE, "/Observation"),
+                                                                 (OTHER_NODE, "/fhirresource")]
+    assert client.get(f"/Observation?patient={other}", headers={FORWARDED_HEADER: SELF_NODE}).json()[
+        "served_by"] == "local"
+
+
+def test_writes_are_routed_by_the_patient_of_their_body(client, patients, proxied):
+    own, other = patients
+    response = client.post(f"/Observation?patient={other}", json=observation(own))
+    assert response.json()["served_by"] == "local" and own in response.json()["body"]
+    assert client.post("/Observation", json=observation(other)).status_code == 200
+    assert [(owner, method) for owner, method, _, _ in proxied] == [(OTHER_NODE, "POST")]
+    assert other in proxied[0][3].decode()
+
+
+def test_transactions_across_nodes_are_rejected(client, patients, proxied):
+    own, other = patients
+    transaction = {"resourceType": "Bundle", "type": "transaction", "entry": [
+        {"request": {"method": "POST", "url": "Observation"}, "resource": observation(own)},
+        {"request": {"method": "POST", "url": "Observation"}, "resource": observation(other)}]}
+    assert client.post("/bundle", json=transaction).status_code == 400
+    transaction["entry"].pop(0)
+    assert client.post("/bundle", json=transaction).status_code == 200
+    assert [owner for owner, _, _, _ in proxied] == [OTHER_NODE]
@@ -0,0 +1,12 @@
+import os
+
+import pyarrow as pa
+
+from app.utility.sharedcache import SharedCacheClient
+
+
+def test_failed_cache_write_is_a_miss(tmp_path, monkeypatch):
+    client = SharedCacheClient(str(tmp_path / "cache.sock"), str(tmp_path / "missing"))
+    monkeypatch.setattr(client, "_connection", lambda: object())
+    assert client.put_table("key", pa.table({"id": ["o1"]})) is False
+    assert not os.path.exists(tmp_path / "missing")
@@ -0,0 +1,55 @@
+import asyncio
+import threading
+import time
+
+from app.utility.cancellation import get_cancel_token
+from app.utility.singleflight import SingleFlight
+
+
+def test_concurrent_reads_run_once():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def read(key):
+        calls.append(key)
+        started.set()
+        release.wait(5)
+        return {"data": key}
+
+    async def reads():
+        first = asyncio.ensure_future(flight.do("a", read, "a"))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+        others = [asyncio.ensure_future(flight.do("a", read, "a")) for _ in range(3)]
+        other_key = asyncio.ensure_future(flight.do("b", read, "b"))
+        await asyncio.sleep(0.05)
+        release.set()
+        return await asyncio.gather(first, *others, other_key)
+
+    results = asyncio.run(reads())
+    assert sorted(calls) == ["a", "b"]
+    assert results[:4] == [{"data": "a"}] * 4 and results[0] is results[3]
+    assert flight.in_flight() == 0
+
+
+def test_scan_is_cancelled_once_every_caller_is_gone():
+    flight = SingleFlight()
+    started, tokens = threading.Event(), []
+
+    def read():
+        tokens.append(get_cancel_token())
+        started.set()
+        while not tokens[0].cancelled:
+            time.sleep(0.01)
+
+    async def abandon():
+        callers = [asyncio.ensure_future(flight.do("a", read)) for _ in range(2)]
+        await asyncio.get_running_loop().run_in_executor(None, started.wait, 5)
+        callers[0].cancel()
+        await asyncio.sleep(0.05)
+        assert not tokens[0].cancelled
+        callers[1].cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+
+    asyncio.run(abandon())
+    assert tokens[0].reason == "abandoned"
@@ -0,0 +1,48 @@
+import asyncio
+
+from app.core import tenants
+from app.core.tenants import load_tenant_settings
+from app.middleware.tenant import TenantMiddleware
+from app.utility.scheduler import FairScheduler
+from .test_configwatch import write_config
+
+
+def test_every_valid_toml_is_a_tenant(tmp_path, monkeypatch, config):
+    write_config(tmp_path / "Clinic.toml", "/data/clinic", ehr="db")
+    write_config(tmp_path / "lab.toml", "/data/lab", lis="db")
+    (tmp_path / "broken.toml").write_text("[paths\n")
+    monkeypatch.setattr(tenants, "CONFIG_DIR", str(tmp_path))
+    config.tenant_overrides = {"lab": {"tenant_max_concurrency": 2}}
+
+    loaded = load_tenant_settings(config)
+    assert sorted(loaded) == ["clinic", "lab"]
+    assert loaded["clinic"].system_config["paths"]["base_path"] == "/data/clinic"
+    assert (loaded["lab"].tenant, loaded["lab"].tenant_max_concurrency) == ("lab", 2)
+    assert loaded["clinic"].tenant_max_concurrency == config.tenant_max_concurrency
+
+
+def test_requests_are_routed_by_header_or_path_prefix():
+    seen = []
+
+    async def app(scope, receive, send):
+        seen.append((scope.get("tenant"), scope["path"]))
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    middleware = TenantMiddleware(app, ["clinic"], FairScheduler(concurrency=2, quota=1))
+
+    async def request(path, headers=()):
+        statuses = []
+
+        async def send(message):
+            if message["type"] == "http.response.start":
+                statuses.append(message["status"])
+
+        await middleware({"type": "http", "path": path, "headers": list(headers)}, None, send)
+        return statuses[0]
+
+    assert asyncio.run(request("/Observation", [(b"x-tenant", b"Clinic")])) == 200
+    assert asyncio.run(request("/tenants/clinic/Observation")) == 200
+    assert asyncio.run(request("/metrics")) == 200
+    assert asyncio.run(request("/tenants/other/Observation")) == 404
+    assert seen == [("clinic", "/Observation"), ("clinic", "/Observation"), (None, "/metrics")]
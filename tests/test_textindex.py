@@ -0,0 +1,60 @@
+import os
+import threading
+
+import pyarrow as pa
+import pytest
+from deltalake import DeltaTable, write_deltalake
+
+from app.utility import textindex
+from app.utility.textindex import CONTENT, TextIndex, TextIndexNotReady
+from app.utility.writer import PARTITION_COLUMN, commit_partitions
+
+
+def notes(*rows, patient="p1"):
+    return pa.Table.from_pylist([
+        {"id": resource_id, "status": status, PARTITION_COLUMN: patient} for resource_id, status in rows])
+
+
+def test_segments_are_merged_without_reading_the_data_files(tmp_path, monkeypatch):
+    table_path = str(tmp_path / "observation")
+    write_deltalake(table_path, notes(("o0", "preliminary")), partition_by=[PARTITION_COLUMN])
+    index = TextIndex(str(tmp_path / "index"), table_path, max_segments=2)
+    index.update(DeltaTable(table_path))
+    write_deltalake(table_path, notes(("o1", "final"), patient="p2"), partition_by=[PARTITION_COLUMN], mode="append")
+    index.update(DeltaTable(table_path))
+    read_documents = textindex.read_documents
+    read_paths = []
+
+    def tracked_read_documents(table_path, path):
+        read_paths.append(path)
+        return read_documents(table_path, path)
+
+    monkeypatch.setattr(textindex, "read_documents", tracked_read_documents)
+    # replaces o0, the merge drops the postings of the removed file
+    commit_partitions(table_path, {"p1": (notes(("o0", "amended")), True)}, retries=0)
+    delta_table = DeltaTable(table_path)
+    manifest = index.update(delta_table)
+
+    assert len(manifest["segments"]) == 1
+    assert len(read_paths) == 1
+    assert index.search(delta_table, CONTENT, "amended").keys() == {"o0"}
+    assert index.search(delta_table, CONTENT, "preliminary") == {}
+    assert index.search(delta_table, CONTENT, "final").keys() == {"o1"}
+    assert sorted(os.listdir(index.index_path)) == ["manifest.json", manifest["segments"][0]]
+
+
+def test_search_refreshes_the_index_in_the_background(tmp_path, monkeypatch):
+    table_path = str(tmp_path / "observation")
+    write_deltalake(table_path, notes(("o0", "final")), partition_by=[PARTITION_COLUMN])
+    index = TextIndex(str(tmp_path / "index"), table_path)
+    write_segment, indexing = textindex.write_segment, threading.Event()
+
+    def blocked_write_segment(*args):
+        indexing.wait()
+        return write_segment(*args)
+
+    monkeypatch.setattr(textindex, "write_segment", blocked_write_segment)
+    with pytest.raises(TextIndexNotReady):
+        index.search(DeltaTable(table_path), CONTENT, "final", wait=0.0)
+    indexing.set()
+    assert index.search(DeltaTable(table_path), CONTENT, "final", wait=5.0).keys() == {"o0"}
@@ -0,0 +1,28 @@
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from app.utility.topk import parse_sort, scan_top_k, top_k
+
+
+def test_pages_of_equal_keys_neither_repeat_nor_skip_rows(tmp_path):
+    ids = [f"o{index:02d}" for index in range(20)]
+    table = pa.table({"id": ids[::-1], "status": ["final"] * 20})
+    pq.write_table(table, tmp_path / "part-0.parquet", row_group_size=3)
+    dataset = ds.dataset(str(tmp_path), format="parquet")
+    for sort in ("status", "-status"):
+        keys = parse_sort("Observation", sort)
+        pages = []
+        for offset in range(0, 20, 6):
+            result, total = scan_top_k(dataset, keys, offset + 6)
+            assert total == 20
+            pages.extend(result.slice(offset, 6).column("id").to_pylist())
+        assert pages == ids
+
+
+def test_whole_table_sort_orders_ties_by_id(tmp_path):
+    table = pa.table({"id": ["c", "a", "b"], "status": ["final", "amended", "final"]})
+    pq.write_table(table, tmp_path / "part-0.parquet", row_group_size=1)
+    result, _ = scan_top_k(ds.dataset(str(tmp_path), format="parquet"), parse_sort("Observation", "-status"), None)
+    assert result.column("id").to_pylist() == ["b", "c", "a"]
+    assert top_k(table, parse_sort("Observation", "code"), 2).column("id").to_pylist() == ["a", "b"]
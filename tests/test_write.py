@@ -0,0 +1,97 @@
+import os
+
+from app.utility import writer
+from app.utility.writer import get_write_overlay
+from .conftest import SYSTEM_NAME
+
+
+def observation(resource_id=None, patient="p1", **elements):
+    resource = {"resourceType": "Observation", "status": "final", "subject": {"reference": f"Patient/{patient}"},
+                "code": {"coding": [{"system": "http://loinc.org", "code": "4548-4"}]}, **elements}
+    if resource_id:
+        resource["id"] = resource_id
+    return resource
+
+
+def test_unknown_resource_type_is_rejected(client, database_dir):
+    response = client.post(f"/Widget?system_name={SYSTEM_NAME}", json={
+        "resourceType": "Widget", "subject": {"reference": "Patient/p1"}})
+    assert response.status_code == 404
+    assert not os.path.exists(os.path.join(database_dir, "widget"))
+
+
+def test_create_and_read(client):
+    response = client.post(f"/Observation?system_name={SYSTEM_NAME}", json=observation())
+    assert response.status_code == 201
+    resource_id = response.json()["id"]
+    data = client.get(f"/Observation?patient=p1&system_name={SYSTEM_NAME}").json()["data"]
+    assert [row["id"] for row in data] == [resource_id]
+
+
+def test_committed_writes_leave_the_overlay(client, database_dir):
+    assert client.post(f"/Observation?system_name={SYSTEM_NAME}", json=observation()).status_code == 201
+    assert not get_write_overlay().has_pending(os.path.join(database_dir, "observation"))
+
+
+def test_put_reports_only_the_replaced_resource_as_changed(client):
+    for index in range(5):
+        assert client.post(f"/Observation?system_name={SYSTEM_NAME}",
+                           json=observation(f"o{index}", valueString="before")).status_code == 201
+    response = client.put(f"/Observation/o1?system_name={SYSTEM_NAME}", json=observation("o1", valueString="after"))
+    assert response.status_code == 200
+    version = int(response.headers["etag"][3:-1])
+
+    history = client.get(f"/Observation/_history?patient=p1&system_name={SYSTEM_NAME}&_since={version - 1}").json()
+    assert [(row["id"], row["_change_type"]) for row in history["data"]] == [
+        ("o1", "update_preimage"), ("o1", "update_postimage")]
+    changed = client.get(f"/Observation?patient=p1&system_name={SYSTEM_NAME}&_since={version - 1}").json()
+    assert [(row["id"], row["valueString"]) for row in changed["data"]] == [("o1", "after")]
+    current = client.get(f"/Observation?patient=p1&system_name={SYSTEM_NAME}&page_size=10").json()
+    assert sorted(row["id"] for row in current["data"]) == [f"o{index}" for index in range(5)]
+
+
+def transaction(*entries):
+    return {"resourceType": "Bundle", "id": "b1", "type": "transaction", "entry": [
+        {"request": {"method": method, "url": url}, "resource": resource} for method, url, resource in entries]}
+
+
+def test_transaction_commits_all_entries_at_once(client):
+    response = client.post(f"/bundle?system_name={SYSTEM_NAME}", json=transaction(
+        ("POST", "Observation", observation("t1")), ("PUT", "Observation/t2", observation("t2", patient="p2"))))
+    assert response.status_code == 200
+    etags = {entry["response"]["etag"] for entry in response.json()["entry"]}
+    assert len(etags) == 1
+
+
+def test_transaction_with_a_failing_entry_commits_nothing(client, monkeypatch):
+    get_partition_actions = writer.get_partition_actions
+
+    def failing_partition_actions(delta_table, table_path, version, patient_id, *args, **kwargs):
+        if patient_id == "p2":
+            raise writer.WriteConflict(f"partition {patient_id} changed")
+        return get_partition_actions(delta_table, table_path, version, patient_id, *args, **kwargs)
+
+    assert client.post(f"/Observation?system_name={SYSTEM_NAME}", json=observation("o1")).status_code == 201
+    monkeypatch.setattr(writer, "get_partition_actions", failing_partition_actions)
+    response = client.post(f"/bundle?system_name={SYSTEM_NAME}", json=transaction(
+        ("POST", "Observation", observation("t1")), ("PUT", "Observation/t2", observation("t2", patient="p2"))))
+    assert response.status_code == 409
+    data = client.get(f"/Observation?patient=p1&system_name={SYSTEM_NAME}").json()["data"]
+    assert [row["id"] for row in data] == ["o1"]
+
+
+def test_transaction_across_tables_is_rejected(client):
+    response = client.post(f"/bundle?system_name={SYSTEM_NAME}", json=transaction(
+        ("POST", "Observation", observation("t1")),
+        ("POST", "Condition", {"resourceType": "Condition", "subject": {"reference": "Patient/p1"}})))
+    assert response.status_code == 400
+
+
+def test_elements_outside_the_schema_are_rejected(client, database_dir):
+    assert client.post(f"/Observation?system_name={SYSTEM_NAME}", json=observation("o1")).status_code == 201
+    response = client.put(f"/Observation/o1?system_name={SYSTEM_NAME}", json=observation(
+        "o1", valueString="after", code={"coding": [{"system": "http://loinc.org", "code": "4548-4", "display": "A1c"}]}))
+    assert response.status_code == 422
+    assert "code.coding.display, valueString" in response.json()["detail"]
+    data = client.get(f"/Observation?patient=p1&system_name={SYSTEM_NAME}").json()["data"]
+    assert [row["id"] for row in data] == ["o1"]
@@ -0,0 +1,94 @@
+import asyncio
+import os
+
+import pyarrow as pa
+from deltalake import DeltaTable, write_deltalake
+
+from app.utility import writer
+from app.utility.writer import PARTITION_COLUMN, GroupCommitter, WriteConflict, WriteOverlay, commit_partitions
+
+
+def rows(*ids, patient="p1", value=0.0):
+    return pa.Table.from_pylist([{"id": resource_id, "value": value, PARTITION_COLUMN: patient} for resource_id in ids])
+
+
+def read(table_path):
+    table = DeltaTable(table_path).to_pyarrow_table()
+    return dict(zip(table.column("id").to_pylist(), table.column("value").to_pylist()))
+
+
+def test_upsert_keeps_a_commit_landing_after_its_read(tmp_path, monkeypatch):
+    table_path = str(tmp_path / "observation")
+    write_deltalake(table_path, rows("a", "b"), partition_by=[PARTITION_COLUMN])
+    get_partition_actions = writer.get_partition_actions
+    calls = []
+
+    def racing_partition_actions(*args, **kwargs):
+        if not calls:
+            # another writer commits to the partition after the upsert read it
+            write_deltalake(table_path, rows("c"), partition_by=[PARTITION_COLUMN], mode="append")
+        calls.append(args)
+        return get_partition_actions(*args, **kwargs)
+
+    monkeypatch.setattr(writer, "get_partition_actions", racing_partition_actions)
+    version = commit_partitions(table_path, {"p1": (rows("a", value=1.0), True)}, retries=2)
+
+    assert len(calls) == 2
+    assert version == DeltaTable(table_path).version()
+    assert read(table_path) == {"a": 1.0, "b": 0.0, "c": 0.0}
+    # the data file of the lost attempt is removed
+    assert len(os.listdir(os.path.join(table_path, f"{PARTITION_COLUMN}=p1"))) == 3
+
+
+def test_append_moves_past_a_concurrent_commit(tmp_path, monkeypatch):
+    table_path = str(tmp_path / "observation")
+    write_deltalake(table_path, rows("a"), partition_by=[PARTITION_COLUMN])
+    write_commit = writer.write_commit
+    calls = []
+
+    def racing_write_commit(local_path, version, actions):
+        if not calls:
+            write_deltalake(table_path, rows("b", patient="p2"), partition_by=[PARTITION_COLUMN], mode="append")
+        calls.append(version)
+        return write_commit(local_path, version, actions)
+
+    monkeypatch.setattr(writer, "write_commit", racing_write_commit)
+    assert commit_partitions(table_path, {"p1": (rows("c"), False)}, retries=0) == 2
+    assert calls == [1, 2]
+    assert read(table_path) == {"a": 0.0, "b": 0.0, "c": 0.0}
+
+
+def test_failed_upsert_does_not_fail_the_committed_appends(tmp_path, monkeypatch):
+    table_path = str(tmp_path / "observation")
+    write_deltalake(table_path, rows("a"), partition_by=[PARTITION_COLUMN])
+    commit = writer.commit_partitions
+
+    def failing_upserts(local_path, partitions, retries):
+        if any(upsert for _, upsert in partitions.values()):
+            raise WriteConflict("partition p2 changed")
+        return commit(local_path, partitions, retries)
+
+    monkeypatch.setattr(writer, "commit_partitions", failing_upserts)
+
+    async def write_group():
+        committer = GroupCommitter(max_rows=100, max_delay=60.0, retries=0, overlay=WriteOverlay())
+        writes = [asyncio.ensure_future(committer.write(table_path, "p1", rows("b"))),
+                  asyncio.ensure_future(committer.write(table_path, "p2", rows("c", patient="p2"), upsert=True))]
+        await asyncio.sleep(0)
+        await committer._flush(table_path)
+        return await asyncio.gather(*writes, return_exceptions=True)
+
+    appended, upserted = asyncio.run(write_group())
+    assert appended == 1
+    assert isinstance(upserted, WriteConflict)
+    assert read(table_path) == {"a": 0.0, "b": 0.0}
+
+
+def test_commits_are_checkpointed(tmp_path):
+    table_path = str(tmp_path / "observation")
+    write_deltalake(table_path, rows("a"), partition_by=[PARTITION_COLUMN])
+    for index in range(writer.CHECKPOINT_INTERVAL):
+        commit_partitions(table_path, {"p1": (rows("a", value=float(index)), True)}, retries=0)
+    log = os.listdir(os.path.join(table_path, "_delta_log"))
+    assert f"{writer.CHECKPOINT_INTERVAL:020d}.checkpoint.parquet" in log
+    assert read(table_path) == {"a": float(writer.CHECKPOINT_INTERVAL - 1)}